@@ -9,8 +9,11 @@ from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from chatbot.auth_cache import TokenUserCache
+
 # Set up logger
 logger = logging.getLogger(__name__)
 
@@ -372,6 +375,19 @@ def jwt_logout(request):
                 f"User {request.user.username} logged out - no refresh token found in cookies"
             )
 
+        # Access-токен этого входа больше не открывает веб-сокеты
+        if request.auth is not None and TokenUserCache.is_enabled():
+            try:
+                TokenUserCache.revoke_token(
+                    str(request.auth),
+                    request.auth[api_settings.JTI_CLAIM],
+                    request.auth["exp"],
+                )
+            except Exception as revoke_error:
+                logger.warning(
+                    f"Failed to revoke WebSocket auth for user {request.user.username}: {revoke_error}"
+                )
+
         # Create response with cookie deletion
         response = Response(
             {"success": True, "message": "Successfully logged out"},
@@ -8,3 +8,7 @@ class ChatbotConfig(AppConfig):
 
     default_auto_field = "django.db.models.BigAutoField"
     name = "chatbot"
+
+    def ready(self):
+        """Подключает обработчики сигналов."""
+        from chatbot import signals  # noqa: F401
@@ -0,0 +1,190 @@
+"""Кеш пользователей, проверенных по JWT при подключении веб-сокетов."""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+
+from chatbot.redis_client import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+TOKEN_USER_KEY = "chatbot:auth:token:{digest}"
+USER_TOKENS_KEY = "chatbot:auth:user:{user_id}"
+REVOKED_KEY = "chatbot:auth:revoked:{jti}"
+
+# Поля пользователя, достаточные консьюмерам; из них собирается User без БД
+CACHED_USER_FIELDS = (
+    "id",
+    "username",
+    "email",
+    "first_name",
+    "last_name",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+)
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def dump_user(user) -> Dict[str, Any]:
+    return {field: getattr(user, field) for field in CACHED_USER_FIELDS}
+
+
+def load_user(fields: Dict[str, Any]):
+    from django.contrib.auth import get_user_model
+
+    return get_user_model()(**fields)
+
+
+class TokenUserCache:
+    """
+    Двухуровневый кеш "токен -> пользователь" для рукопожатий веб-сокетов.
+
+    Первый уровень - LRU в памяти процесса с коротким TTL
+    (WS_AUTH_CACHE_LOCAL_TTL), второй - Redis, общий для воркеров
+    (WS_AUTH_CACHE_TTL). Запись никогда не живет дольше самого токена.
+    Подпись и срок токена проверяются при каждом подключении, кеш только
+    избавляет от запроса пользователя в БД. Выход из системы отзывает
+    токен по jti, деактивация пользователя удаляет его записи; локальные
+    копии других процессов доживают свой короткий TTL.
+    """
+
+    _local: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+    # Инвалидация приходит из синхронных потоков (сигналы, views)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, "WS_AUTH_CACHE_ENABLED", True)
+
+    @staticmethod
+    def _ttl(expires_at: float) -> int:
+        ttl = getattr(settings, "WS_AUTH_CACHE_TTL", 300)
+        return int(min(ttl, expires_at - time.time()))
+
+    @classmethod
+    def _get_local(cls, digest: str) -> Optional[Dict[str, Any]]:
+        with cls._lock:
+            entry = cls._local.get(digest)
+            if entry is None:
+                return None
+            expires_at, fields = entry
+            if expires_at <= time.monotonic():
+                del cls._local[digest]
+                return None
+            cls._local.move_to_end(digest)
+            return fields
+
+    @classmethod
+    def _set_local(cls, digest: str, fields: Dict[str, Any], ttl: float):
+        ttl = min(ttl, getattr(settings, "WS_AUTH_CACHE_LOCAL_TTL", 5))
+        max_size = getattr(settings, "WS_AUTH_CACHE_SIZE", 1024)
+        with cls._lock:
+            cls._local[digest] = (time.monotonic() + ttl, fields)
+            cls._local.move_to_end(digest)
+            while len(cls._local) > max_size:
+                cls._local.popitem(last=False)
+
+    @classmethod
+    def _drop_local(cls, user_id=None, digest: Optional[str] = None):
+        with cls._lock:
+            if digest is not None:
+                cls._local.pop(digest, None)
+            if user_id is not None:
+                for key in [
+                    key
+                    for key, (_, fields) in cls._local.items()
+                    if str(fields["id"]) == str(user_id)
+                ]:
+                    del cls._local[key]
+
+    @classmethod
+    async def get(cls, token: str, jti: str) -> Tuple[Optional[Dict], bool]:
+        """
+        Ищет пользователя токена сначала в памяти процесса, затем в Redis.
+
+        Возвращает (поля пользователя или None, отозван ли токен).
+        """
+        digest = token_digest(token)
+        fields = cls._get_local(digest)
+        if fields is not None:
+            return fields, False
+
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.get(TOKEN_USER_KEY.format(digest=digest))
+                pipe.ttl(TOKEN_USER_KEY.format(digest=digest))
+                pipe.exists(REVOKED_KEY.format(jti=jti))
+                raw, ttl, revoked = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to read auth cache: {e}")
+            return None, False
+
+        if revoked:
+            return None, True
+        if raw is None:
+            return None, False
+        fields = json.loads(raw)
+        cls._set_local(digest, fields, ttl if ttl and ttl > 0 else 0)
+        return fields, False
+
+    @classmethod
+    async def set(cls, token: str, user, expires_at: float):
+        """Сохраняет пользователя токена в оба уровня кеша до истечения токена."""
+        ttl = cls._ttl(expires_at)
+        if ttl <= 0:
+            return
+        digest = token_digest(token)
+        fields = dump_user(user)
+        cls._set_local(digest, fields, ttl)
+
+        user_key = USER_TOKENS_KEY.format(user_id=user.id)
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.set(
+                    TOKEN_USER_KEY.format(digest=digest), json.dumps(fields), ex=ttl
+                )
+                pipe.sadd(user_key, digest)
+                pipe.expire(user_key, getattr(settings, "WS_AUTH_CACHE_TTL", 300))
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to write auth cache: {e}")
+
+    @classmethod
+    def revoke_token(cls, token: str, jti: str, expires_at: float):
+        """Отзывает токен при выходе из системы (синхронный вызов)."""
+        digest = token_digest(token)
+        cls._drop_local(digest=digest)
+        ttl = int(expires_at - time.time())
+        if ttl <= 0:
+            return
+        redis = get_sync_redis()
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(REVOKED_KEY.format(jti=jti), 1, ex=ttl)
+        pipe.delete(TOKEN_USER_KEY.format(digest=digest))
+        pipe.execute()
+
+    @classmethod
+    def invalidate_user(cls, user_id):
+        """Удаляет все записи пользователя (синхронный вызов)."""
+        cls._drop_local(user_id=user_id)
+        redis = get_sync_redis()
+        user_key = USER_TOKENS_KEY.format(user_id=user_id)
+        digests = redis.smembers(user_key)
+        keys = [TOKEN_USER_KEY.format(digest=digest) for digest in digests]
+        redis.delete(user_key, *keys)
+
+    @classmethod
+    def clear_local(cls):
+        """Очищает кеш в памяти процесса."""
+        with cls._lock:
+            cls._local.clear()
@@ -0,0 +1,116 @@
+"""Кеш ответов AI на точные повторы промптов."""
+
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+
+from chatbot.metrics import RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+from chatbot.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_KEY = "chatbot:response:{digest}"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Приводит промпт к виду, в котором сравниваются повторы."""
+    return " ".join(prompt.split()).casefold()
+
+
+class ResponseCache:
+    """
+    Двухуровневый кеш ответов: LRU в памяти процесса перед Redis с TTL.
+
+    Ключ - нормализованный промпт, модель и системный промпт. Кешируются
+    только ответы на запросы без состояния диалога: если в запрос попал
+    context Ollama или история чата, кеш обходится (см. is_cacheable).
+    """
+
+    _local: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, "AI_RESPONSE_CACHE_ENABLED", False)
+
+    @staticmethod
+    def _ttl() -> int:
+        return int(getattr(settings, "AI_RESPONSE_CACHE_TTL", 3600))
+
+    @classmethod
+    def is_cacheable(
+        cls, original_prompt: str, prompt: str, context: Optional[list]
+    ) -> bool:
+        """Запрос без контекста и истории - ответ не зависит от диалога."""
+        return cls.is_enabled() and not context and prompt == original_prompt
+
+    @staticmethod
+    def make_key(prompt: str, model: str, system_prompt: Optional[str]) -> str:
+        raw = json.dumps([normalize_prompt(prompt), model, system_prompt or ""])
+        digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+        return RESPONSE_KEY.format(digest=digest)
+
+    @classmethod
+    def _get_local(cls, key: str) -> Optional[str]:
+        entry = cls._local.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at <= time.monotonic():
+            del cls._local[key]
+            return None
+        cls._local.move_to_end(key)
+        return response
+
+    @classmethod
+    def _set_local(cls, key: str, response: str, ttl: float):
+        cls._local[key] = (time.monotonic() + ttl, response)
+        cls._local.move_to_end(key)
+        max_size = getattr(settings, "AI_RESPONSE_CACHE_SIZE", 256)
+        while len(cls._local) > max_size:
+            cls._local.popitem(last=False)
+
+    @classmethod
+    async def get(cls, key: str) -> Optional[str]:
+        """Ищет ответ сначала в памяти процесса, затем в Redis."""
+        response = cls._get_local(key)
+        if response is not None:
+            RESPONSE_CACHE_HITS.labels(tier="memory").inc()
+            return response
+
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.ttl(key)
+                response, ttl = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to read response cache: {e}")
+            response = None
+
+        if response is None:
+            RESPONSE_CACHE_MISSES.inc()
+            return None
+
+        RESPONSE_CACHE_HITS.labels(tier="redis").inc()
+        # Локальная копия живет не дольше записи в Redis
+        cls._set_local(key, response, ttl if ttl and ttl > 0 else cls._ttl())
+        return response
+
+    @classmethod
+    async def set(cls, key: str, response: str):
+        """Сохраняет ответ в оба уровня кеша."""
+        ttl = cls._ttl()
+        cls._set_local(key, response, ttl)
+        try:
+            await get_redis().set(key, response, ex=ttl)
+        except Exception as e:
+            logger.error(f"Failed to write response cache: {e}")
+
+    @classmethod
+    def clear_local(cls):
+        """Очищает кеш в памяти процесса."""
+        cls._local.clear()
@@ -1,26 +1,165 @@
 # consumer.py
-import json
+import asyncio
+import concurrent.futures
 import logging
-import urllib.error
-import urllib.request
+import signal
+import threading
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, Optional
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set, Union
+from urllib.parse import parse_qs
 
+from asgiref.sync import async_to_sync, sync_to_async
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
-from django.db import transaction
+from django.db import connections
+
+from chatbot.generation import close_ollama_session, run_generation, send_not_started
+from chatbot.metrics import AI_EXECUTOR_BUSY, AI_EXECUTOR_MAX_WORKERS
+from chatbot.presence import ChatPresence
+from chatbot.protocol import JsonProtocol, ProtocolError, negotiate
+from chatbot.redis_client import close_redis
+from chatbot.registry import GenerationLease, GenerationRegistry
+from chatbot.scheduler import AdmissionTicket, GenerationScheduler, QueueFullError
+from chatbot.streams import (
+    STREAM_START,
+    GenerationStream,
+    is_valid_offset,
+    parse_offset,
+)
+from chatbot.writes import ChatAccessDenied
 
 logger = logging.getLogger(__name__)
 
-# Глобальный пул потоков для всех генераций
+# Пул потоков для генераций, запущенных вне event loop
 _AI_EXECUTOR = ThreadPoolExecutor(
     max_workers=getattr(settings, "AI_MAX_WORKERS", 3), thread_name_prefix="ai_worker"
 )
+AI_EXECUTOR_MAX_WORKERS.set(getattr(settings, "AI_MAX_WORKERS", 3))
+
+# Сильные ссылки на фоновые задачи генерации, чтобы их не собрал GC.
+# Задачи, запущенные из потоков DRF, хранятся как concurrent.futures.Future
+_GENERATION_TASKS: Set[Union[asyncio.Future, concurrent.futures.Future]] = set()
+
+# Event loop ASGI-сервера, запомненный на lifespan.startup: в нем идут
+# генерации, запущенные из синхронных DRF-представлений
+_SERVER_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+# Процесс останавливается: новые генерации не принимаются
+_DRAINING = threading.Event()
+
+# Отложенные проверки брошенных генераций, см. cancel_if_abandoned
+_ABANDON_CHECKS: Set[asyncio.Task] = set()
+
+# Ожидающие начала остановки (SSE-ответы), см. drain_waiter
+_DRAIN_WAITERS: Set[asyncio.Future] = set()
+
+
+def set_server_loop(loop: Optional[asyncio.AbstractEventLoop]):
+    """Запоминает event loop ASGI-сервера (вызывается на lifespan.startup)."""
+    global _SERVER_LOOP
+    _SERVER_LOOP = loop
+
+
+def get_server_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """Работающий event loop сервера или None вне ASGI (manage.py, Celery)."""
+    loop = _SERVER_LOOP
+    if loop is None or loop.is_closed() or not loop.is_running():
+        return None
+    return loop
+
+
+def is_draining() -> bool:
+    """Процесс получил SIGTERM и дорабатывает идущие генерации."""
+    return _DRAINING.is_set()
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def begin_draining():
+    """Переводит процесс в режим остановки и будит ждущих ее."""
+    _DRAINING.set()
+    for waiter in list(_DRAIN_WAITERS):
+        waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+
+@contextmanager
+def drain_waiter() -> Iterator[asyncio.Future]:
+    """Future, который завершится, когда процесс начнет останавливаться."""
+    waiter = asyncio.get_running_loop().create_future()
+    _DRAIN_WAITERS.add(waiter)
+    if is_draining():
+        _wake(waiter)
+    try:
+        yield waiter
+    finally:
+        _DRAIN_WAITERS.discard(waiter)
+
+
+def install_drain_signal():
+    """
+    Начинает остановку уже по SIGTERM, а не на lifespan.shutdown.
+
+    uvicorn шлет lifespan.shutdown только после того, как закроются все
+    HTTP-ответы, поэтому открытые SSE-потоки узнают об остановке из
+    сигнала. Обработчик сервера вызывается следом за нашим.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    # Без обработчика сервера SIGTERM просто завершит процесс
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
+        return
+
+    def handler(signum, frame):
+        begin_draining()
+        previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def _track(future):
+    """Учитывает задачу генерации в _GENERATION_TASKS с момента ее создания."""
+    _GENERATION_TASKS.add(future)
+    future.add_done_callback(_GENERATION_TASKS.discard)
+    return future
+
+
+async def cancel_if_abandoned(chat_id: str, grace: Optional[float] = None) -> bool:
+    """
+    Отменяет генерацию чата, если за grace секунд к нему никто не вернулся.
+
+    Клиент, переподключившийся за это время, дочитывает ответ из стрима
+    воспроизведения. Возвращает True, если отмена была отправлена.
+    """
+    if grace is None:
+        grace = getattr(settings, "AI_RESUME_GRACE", 10)
+    await asyncio.sleep(grace)
+    try:
+        if await ChatPresence.count(chat_id):
+            return False
+        if not await GenerationRegistry.is_generating(chat_id):
+            return False
+        logger.info(f"Nobody returned to chat {chat_id}, cancelling generation")
+        await GenerationRegistry.cancel(chat_id)
+        return True
+    except Exception as e:
+        logger.error(f"Failed to cancel abandoned generation in chat {chat_id}: {e}")
+        return False
+
+
+def _track_check(task: asyncio.Task):
+    """Держит сильную ссылку на отложенную проверку до ее завершения."""
+    _ABANDON_CHECKS.add(task)
+    task.add_done_callback(_ABANDON_CHECKS.discard)
 
 
 class OllamaClient:
-    """Клиент для работы с Ollama API"""
+    """Синхронная обертка над AsyncOllamaClient для кода вне event loop"""
 
     @staticmethod
     def generate_response(
@@ -30,10 +169,16 @@ class OllamaClient:
         system_prompt: Optional[str] = None,
         channel_layer=None,
         group_name: Optional[str] = None,
+        lease_token: Optional[str] = None,
+        user_id: Optional[str] = None,
     ) -> Dict[str, Any]:
         """
         Генерирует ответ от AI модели через Ollama API.
 
+        Запускает асинхронный конвейер в собственном event loop текущего
+        потока, поэтому подходит для пула потоков, management-команд и
+        воркеров Celery.
+
         Args:
             chat_id: ID чата
             prompt: Пользовательский промпт
@@ -41,185 +186,223 @@ class OllamaClient:
             system_prompt: Системный промпт
             channel_layer: Канальный слой для отправки сообщений
             group_name: Имя группы для отправки сообщений
+            lease_token: Токен аренды, взятой другим процессом
+            user_id: ID пользователя для очереди допуска
 
         Returns:
             Dict с результатом генерации
         """
-        from asgiref.sync import async_to_sync
-
-        from chatbot.models import Message
-
-        # Настройки по умолчанию
-        if model is None:
-            model = getattr(settings, "DEFAULT_AI_MODEL", "deepseek-r1:1.5b")
-
-        if system_prompt is None:
-            system_prompt = getattr(settings, "DEFAULT_SYSTEM_PROMPT", "")
-
-        if channel_layer is None:
-            from channels.layers import get_channel_layer
-
-            channel_layer = get_channel_layer()
-
-        if group_name is None:
-            group_name = f"chat_{chat_id}"
 
-        full_response = ""
-        message_id = "error"
-        error = None
+        async def run():
+            try:
+                lease = None
+                if lease_token is not None:
+                    # None - аренда истекла в очереди, run_generation возьмет новую
+                    lease = await GenerationRegistry.adopt(chat_id, lease_token)
+                return await run_generation(
+                    lease=lease,
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    prompt=prompt,
+                    model=model,
+                    system_prompt=system_prompt,
+                    channel_layer=channel_layer,
+                    group_name=group_name,
+                )
+            finally:
+                # Event loop живет только на время вызова - ресурсы не переиспользовать
+                GenerationScheduler.discard_loop()
+                await GenerationRegistry.stop_listener()
+                await close_ollama_session()
+                await close_redis()
+
+        return asyncio.run(run())
+
+
+def _run_executor_job(**kwargs) -> Dict[str, Any]:
+    """Генерация в потоке _AI_EXECUTOR: соединения потока не переживают задачу."""
+    try:
+        with AI_EXECUTOR_BUSY.track_inprogress():
+            return OllamaClient.generate_response(**kwargs)
+    finally:
+        connections.close_all()
+
+
+def submit_generation(
+    chat_id: str,
+    prompt: str,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    channel_layer=None,
+    group_name: Optional[str] = None,
+    lease: Optional[GenerationLease] = None,
+    ticket: Optional[AdmissionTicket] = None,
+    user_id: Optional[str] = None,
+):
+    """
+    Запускает AI генерацию в фоне.
+
+    Внутри event loop (консьюмер) генерация становится задачей asyncio.
+    Из синхронного кода под ASGI (DRF view) задача планируется в главный
+    event loop сервера. Пул потоков используется только вне ASGI.
+    Если аренда в реестре или место в очереди не переданы, генерация
+    берет их сама. При AI_GENERATION_MODE = "celery" генерация уходит
+    воркерам Celery (см. enqueue_generation).
+
+    Returns:
+        asyncio.Task, concurrent.futures.Future или AsyncResult генерации
+    """
+    if is_celery_mode():
+        return enqueue_generation(
+            chat_id,
+            prompt,
+            model=model,
+            system_prompt=system_prompt,
+            lease=lease,
+            ticket=ticket,
+            user_id=user_id,
+        )
 
-        try:
-            # Подготавливаем данные для запроса
-            request_data = {"model": model, "prompt": prompt, "stream": True}
-
-            if system_prompt:
-                request_data["system"] = system_prompt
-
-            # Создаем запрос
-            req = urllib.request.Request(
-                getattr(settings, "OLLAMA_API_URL", "http://ollama:11434/api/generate"),
-                data=json.dumps(request_data).encode("utf-8"),
-                headers={
-                    "Content-Type": "application/json",
-                    "User-Agent": "Django-ChatBot/1.0",
-                },
-                method="POST",
+    kwargs = {
+        "chat_id": chat_id,
+        "prompt": prompt,
+        "model": model,
+        "system_prompt": system_prompt,
+        "channel_layer": channel_layer,
+        "group_name": group_name,
+    }
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is not None:
+        future = _track(
+            loop.create_task(
+                run_generation(lease=lease, ticket=ticket, user_id=user_id, **kwargs)
             )
+        )
+    else:
+        main_loop = get_server_loop()
+        if main_loop is not None:
+            future = _track(
+                asyncio.run_coroutine_threadsafe(
+                    run_generation(
+                        lease=lease, ticket=ticket, user_id=user_id, **kwargs
+                    ),
+                    main_loop,
+                )
+            )
+        else:
+            future = _AI_EXECUTOR.submit(_run_executor_job, **kwargs)
+
+    return future
+
+
+def is_celery_mode() -> bool:
+    """Генерации выполняют воркеры Celery, а не процесс веб-сервера."""
+    return getattr(settings, "AI_GENERATION_MODE", "inprocess") == "celery"
+
+
+def enqueue_generation(
+    chat_id: str,
+    prompt: str,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    lease: Optional[GenerationLease] = None,
+    ticket: Optional[AdmissionTicket] = None,
+    user_id: Optional[str] = None,
+):
+    """
+    Ставит генерацию в очередь Celery AI_GENERATION_QUEUE.
+
+    Воркер стримит токены через канальный слой и стрим воспроизведения,
+    как и генерация в процессе, поэтому клиенту режим не виден. Аренда
+    продлевается на AI_GENERATION_QUEUE_LEASE_TTL и передается воркеру
+    токеном: чат занят, пока задача ждет в очереди, а отмена доходит до
+    воркера через pub/sub реестра. Параллелизм задают воркеры очереди,
+    поэтому место в локальной очереди допуска сразу возвращается.
+
+    Returns:
+        asyncio.Task постановки в очередь или AsyncResult задачи
+    """
+    from chatbot.tasks import generate_ai_response
+
+    queue = getattr(settings, "AI_GENERATION_QUEUE", "generation")
+    lease_ttl = getattr(settings, "AI_GENERATION_QUEUE_LEASE_TTL", 300)
+    task_kwargs = {
+        "chat_id": chat_id,
+        "prompt": prompt,
+        "model": model,
+        "system_prompt": system_prompt,
+        "lease_token": lease.token if lease is not None else None,
+        "user_id": str(user_id) if user_id is not None else None,
+    }
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is None:
+        cancel_reservation(ticket)
+        if lease is not None:
+            async_to_sync(lease.hand_off)(lease_ttl)
+        return generate_ai_response.apply_async(kwargs=task_kwargs, queue=queue)
+
+    if ticket is not None:
+        GenerationScheduler.for_loop().cancel(ticket)
+
+    async def enqueue():
+        try:
+            if lease is not None:
+                await lease.hand_off(lease_ttl)
+            # Публикация в брокер блокирующая - не держим ей event loop
+            return await sync_to_async(
+                generate_ai_response.apply_async, thread_sensitive=False
+            )(kwargs=task_kwargs, queue=queue)
+        except Exception as e:
+            logger.error(f"Failed to enqueue generation for chat {chat_id}: {e}")
+            if lease is not None:
+                await lease.release()
+            await send_not_started(chat_id, {}, e)
+            return None
 
-            # Выполняем запрос с таймаутами
-            timeout = getattr(settings, "OLLAMA_TIMEOUT", 300)  # 5 минут по умолчанию
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                for line in resp:
-                    line = line.strip()
-                    if not line:
-                        continue
-
-                    try:
-                        data = json.loads(line.decode("utf-8"))
-                    except json.JSONDecodeError as e:
-                        logger.warning(
-                            f"Failed to decode JSON line: {line[:100]}... Error: {e}"
-                        )
-                        continue
-
-                    token = data.get("response", "")
-                    if token:
-                        full_response += token
-                        # Отправляем чанк в WebSocket группу
-                        try:
-                            async_to_sync(channel_layer.group_send)(
-                                group_name,
-                                {
-                                    "type": "ai_chunk",
-                                    "chunk": token,
-                                    "chat_id": chat_id,
-                                },
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to send chunk: {e}")
-                            # Продолжаем генерацию даже если не удалось отправить чанк
-
-                    # Проверяем завершение
-                    if data.get("done", False):
-                        # Логируем метрики генерации
-                        if data.get("total_duration"):
-                            logger.info(
-                                f"AI generation completed for chat {chat_id[:8]}... "
-                                f"Tokens: {len(full_response.split())}, "
-                                f"Duration: {data.get('total_duration')}ms"
-                            )
-                        break
-
-            # Сохраняем сообщение в БД
-            if full_response:
-                try:
-                    with transaction.atomic():
-                        ai_msg = Message.objects.create(
-                            chat_id=chat_id,
-                            content=full_response,
-                            message_type="text",
-                            sender=None,
-                        )
-                        message_id = str(ai_msg.id)
-
-                        # Обновляем время последней активности чата
-                        # ai_msg.chat.touch()  # Предполагается, что у модели Chat есть метод touch()
-
-                except Exception as e:
-                    logger.error(f"Failed to save AI message to DB: {e}", exc_info=True)
-                    error = "Ошибка сохранения сообщения"
-                    message_id = "db_error"
-            else:
-                error = "Пустой ответ от модели"
-                message_id = "empty_response"
-
-        except urllib.error.URLError as e:
-            logger.error(f"Ollama connection error for chat {chat_id}: {e}")
-            error = "Модель временно недоступна"
-            message_id = "connection_error"
-
-        except TimeoutError as e:
-            logger.error(f"Ollama timeout for chat {chat_id}: {e}")
-            error = "Превышено время ожидания ответа от модели"
-            message_id = "timeout_error"
+    return _track(loop.create_task(enqueue()))
 
-        except Exception as e:
-            logger.error(
-                f"Unexpected error during AI generation for chat {chat_id}: {e}",
-                exc_info=True,
-            )
-            error = "Внутренняя ошибка сервера"
-            message_id = "internal_error"
 
-        finally:
-            # Всегда отправляем сообщение о завершении
-            try:
-                async_to_sync(channel_layer.group_send)(
-                    group_name,
-                    {
-                        "type": "ai_complete",
-                        "message_id": message_id,
-                        "chat_id": chat_id,
-                        "error": error,
-                    },
-                )
-            except Exception as e:
-                logger.error(f"Failed to send completion message: {e}")
+def reserve_generation(user_id: str) -> Optional[AdmissionTicket]:
+    """
+    Занимает место в очереди генераций из синхронного кода (DRF view).
 
-        return {
-            "success": error is None,
-            "message_id": message_id,
-            "error": error,
-            "response_length": len(full_response),
-        }
+    Под ASGI место резервируется в главном event loop сервера, поэтому
+    переполнение очереди видно до создания чата. Вне ASGI очереди нет и
+    возвращается None.
 
+    Raises:
+        QueueFullError: очередь генераций переполнена
+    """
+    main_loop = get_server_loop()
+    if main_loop is None:
+        return None
 
-class AIResponseTracker:
-    """Трекер для отслеживания статуса AI генераций"""
+    async def reserve():
+        return GenerationScheduler.for_loop().reserve(user_id)
 
-    _active_generations = {}  # chat_id -> task_future
+    return asyncio.run_coroutine_threadsafe(reserve(), main_loop).result()
 
-    @classmethod
-    def start_generation(cls, chat_id: str, future):
-        """Начать отслеживание генерации для чата"""
-        cls._active_generations[chat_id] = future
 
-    @classmethod
-    def stop_generation(cls, chat_id: str):
-        """Остановить отслеживание генерации для чата"""
-        if chat_id in cls._active_generations:
-            future = cls._active_generations.pop(chat_id)
-            if not future.done():
-                future.cancel()
-                logger.info(f"Cancelled generation for chat {chat_id}")
+def cancel_reservation(ticket: Optional[AdmissionTicket]):
+    """Возвращает место в очереди, если генерация так и не была запущена."""
+    main_loop = get_server_loop()
+    if ticket is None or main_loop is None:
+        return
 
-    @classmethod
-    def is_generating(cls, chat_id: str) -> bool:
-        """Проверяет, идет ли генерация для чата"""
-        if chat_id in cls._active_generations:
-            future = cls._active_generations[chat_id]
-            return not future.done()
-        return False
+    async def cancel():
+        GenerationScheduler.for_loop().cancel(ticket)
+
+    asyncio.run_coroutine_threadsafe(cancel(), main_loop)
 
 
 class ServiceChatConsumer(AsyncWebsocketConsumer):
@@ -230,12 +413,21 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
         self.user = None
         self.chat_id = None
         self.room_group_name = None
+        self.stream_offset = None  # Offset последнего отправленного события генерации
+        self.presence_heartbeat: Optional[asyncio.Task] = None
+        self.protocol = JsonProtocol()  # Формат кадров, выбранный клиентом
 
     async def connect(self):
         """Обработка подключения WebSocket"""
 
         self.user = self.scope["user"]
         self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
+        self.protocol = negotiate(self.scope.get("subprotocols", []))
+
+        # Процесс останавливается - клиент переподключится к другому воркеру
+        if is_draining():
+            await self.close(code=1012)
+            return
 
         # Проверка аутентификации
         if self.user.is_anonymous:
@@ -262,22 +454,27 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
 
         try:
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.accept()
+            await self._join_presence()
+            await self.accept(subprotocol=self.protocol.name)
 
             logger.info(f"User {self.user.id} connected to chat {self.chat_id}")
 
             # Отправляем приветственное сообщение
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "connection_established",
-                        "message": "Connected to chat",
-                        "chat_id": self.chat_id,
-                        "user_id": str(self.user.id),
-                    }
-                )
+            await self.send_event(
+                {
+                    "type": "connection_established",
+                    "message": "Connected to chat",
+                    "chat_id": self.chat_id,
+                    "user_id": str(self.user.id),
+                }
             )
 
+            # Досылаем пропущенное: с offset клиента или всю идущую генерацию
+            query = parse_qs(self.scope.get("query_string", b"").decode())
+            offset = query.get("offset", [None])[0]
+            if offset is not None or await self._is_generating():
+                await self._resume(offset)
+
         except Exception as e:
             logger.error(f"Error during WebSocket connect: {e}", exc_info=True)
             await self.close(code=4002)
@@ -290,9 +487,17 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
                 await self.channel_layer.group_discard(
                     self.room_group_name, self.channel_name
                 )
-
-                # Отменяем активную генерацию для этого чата
-                AIResponseTracker.stop_generation(self.chat_id)
+                await self._leave_presence()
+
+                # Без буфера воспроизведения ответ не дочитать после
+                # переподключения - отменяем генерацию на любом воркере.
+                # Со стримом даем клиенту AI_RESUME_GRACE секунд вернуться
+                if not GenerationStream.is_enabled():
+                    await GenerationRegistry.cancel(self.chat_id)
+                elif ChatPresence.is_enabled():
+                    _track_check(
+                        asyncio.ensure_future(cancel_if_abandoned(self.chat_id))
+                    )
 
                 logger.info(
                     f"User {self.user.id if self.user else 'unknown'} "
@@ -302,51 +507,82 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
             except Exception as e:
                 logger.error(f"Error during WebSocket disconnect: {e}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Обработка входящих сообщений"""
         try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
-            logger.warning(f"Invalid JSON received from user {self.user.id}")
-            await self.send(
-                text_data=json.dumps(
-                    {"type": "error", "message": "Invalid JSON format"}
-                )
-            )
+            data = self.protocol.decode(text_data, bytes_data)
+        except ProtocolError:
+            logger.warning(f"Invalid frame received from user {self.user.id}")
+            await self.send_event({"type": "error", "message": "Invalid JSON format"})
+            return
+
+        # Управляющие сообщения генерации
+        if data.get("type") == "resume":
+            await self._resume(data.get("offset"))
+            return
+        if data.get("type") == "cancel":
+            await GenerationRegistry.cancel(self.chat_id)
             return
 
         # Получаем сообщение
         content = data.get("message", "").strip()
         if not content:
-            await self.send(
-                text_data=json.dumps(
-                    {"type": "error", "message": "Message cannot be empty"}
-                )
+            await self.send_event(
+                {"type": "error", "message": "Message cannot be empty"}
             )
             return
 
         # Проверяем длину сообщения
         max_length = getattr(settings, "MAX_MESSAGE_LENGTH", 10000)
         if len(content) > max_length:
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "error",
-                        "message": f"Message too long (max {max_length} characters)",
-                    }
-                )
+            await self.send_event(
+                {
+                    "type": "error",
+                    "message": f"Message too long (max {max_length} characters)",
+                }
             )
             return
 
-        # Проверяем, не идет ли уже генерация для этого чата
-        if AIResponseTracker.is_generating(self.chat_id):
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "error",
-                        "message": "Please wait for the current response to complete",
-                    }
-                )
+        if is_draining():
+            await self.send_event(
+                {
+                    "type": "error",
+                    "code": "draining",
+                    "message": "Server is restarting, please reconnect",
+                }
+            )
+            await self.close(code=1012)
+            return
+
+        # Берем аренду на генерацию: не пускаем вторую генерацию ни на одном воркере
+        lease = None
+        try:
+            lease = await GenerationRegistry.acquire(self.chat_id)
+        except Exception as e:
+            logger.error(f"Failed to acquire generation lease: {e}", exc_info=True)
+
+        if lease is None:
+            await self.send_event(
+                {
+                    "type": "error",
+                    "message": "Please wait for the current response to complete",
+                }
+            )
+            return
+
+        # Встаем в очередь допуска: при переполнении сразу отказываем
+        ticket = None
+        try:
+            ticket = GenerationScheduler.for_loop().reserve(self.user.id, self.chat_id)
+        except QueueFullError as e:
+            logger.warning(f"Generation rejected for chat {self.chat_id}: {e}")
+            await lease.release()
+            await self.send_event(
+                {
+                    "type": "error",
+                    "code": "queue_full",
+                    "message": "Server is busy, please try again later",
+                }
             )
             return
 
@@ -371,76 +607,107 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
                 },
             )
 
-            # 3. Запускаем AI генерацию в пуле потоков
-            future = _AI_EXECUTOR.submit(
-                OllamaClient.generate_response,
+            # 3. Запускаем AI генерацию прямо в event loop консьюмера
+            submit_generation(
                 chat_id=self.chat_id,
                 prompt=content,
                 channel_layer=self.channel_layer,
                 group_name=self.room_group_name,
+                lease=lease,
+                ticket=ticket,
             )
-
-            # Начинаем отслеживание генерации
-            AIResponseTracker.start_generation(self.chat_id, future)
+            lease = ticket = None
 
             logger.info(
                 f"Started AI generation for chat {self.chat_id}, "
                 f"message length: {len(content)}"
             )
 
+        except ChatAccessDenied:
+            logger.warning(f"User {self.user.id} lost access to chat {self.chat_id}")
+            await self.send_event({"type": "error", "message": "Access denied"})
+            await self.close(code=4003)
+
         except Exception as e:
             logger.error(
                 f"Error processing message from user {self.user.id}: {e}", exc_info=True
             )
-            await self.send(
-                text_data=json.dumps(
-                    {"type": "error", "message": "Failed to process your message"}
-                )
+            await self.send_event(
+                {"type": "error", "message": "Failed to process your message"}
             )
 
+        finally:
+            # Генерация так и не стартовала - освобождаем чат и место в очереди
+            if ticket is not None:
+                GenerationScheduler.for_loop().cancel(ticket)
+            if lease is not None:
+                await lease.release()
+
     # --- Обработчики групповых сообщений ---
 
     async def user_message(self, event):
         """Обработчик для эхо-сообщений пользователя"""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "user_message",
-                    "message_id": event["message_id"],
-                    "content": event["content"],
-                    "user_id": event.get("user_id"),
-                    "chat_id": event.get("chat_id"),
-                    "timestamp": event.get("timestamp"),
-                }
-            )
+        await self.send_event(
+            {
+                "type": "user_message",
+                "message_id": event["message_id"],
+                "content": event["content"],
+                "user_id": event.get("user_id"),
+                "chat_id": event.get("chat_id"),
+                "timestamp": event.get("timestamp"),
+            }
+        )
+
+    async def queue_position(self, event):
+        """Обработчик для позиции генерации в очереди"""
+        await self.send_event(
+            {
+                "type": "queue_position",
+                "position": event["position"],
+                "chat_id": event.get("chat_id"),
+            }
         )
 
     async def ai_chunk(self, event):
         """Обработчик для чанков AI ответа"""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "ai_chunk",
-                    "chunk": event["chunk"],
-                    "chat_id": event.get("chat_id"),
-                }
-            )
+        if self._already_sent(event):
+            return
+        await self.send_event(
+            {
+                "type": "ai_chunk",
+                "chunk": event["chunk"],
+                "chat_id": event.get("chat_id"),
+                "offset": event.get("offset"),
+            }
+        )
+
+    async def ai_thinking(self, event):
+        """Обработчик для чанков рассуждений модели"""
+        if self._already_sent(event):
+            return
+        await self.send_event(
+            {
+                "type": "ai_thinking",
+                "chunk": event["chunk"],
+                "chat_id": event.get("chat_id"),
+                "offset": event.get("offset"),
+            }
         )
 
     async def ai_complete(self, event):
         """Обработчик для сообщения о завершении генерации"""
-        # Останавливаем отслеживание генерации
-        AIResponseTracker.stop_generation(event.get("chat_id"))
-
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "ai_complete",
-                    "message_id": event["message_id"],
-                    "chat_id": event.get("chat_id"),
-                    "error": event.get("error"),
-                }
-            )
+        if self._already_sent(event):
+            return
+        await self.send_event(
+            {
+                "type": "ai_complete",
+                "message_id": event["message_id"],
+                "chat_id": event.get("chat_id"),
+                "error": event.get("error"),
+                "cancelled": event.get("cancelled", False),
+                "reason": event.get("reason"),
+                "offset": event.get("offset"),
+            }
         )
 
     async def connection_established(self, event):
@@ -448,6 +715,76 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
 
     # --- Вспомогательные методы ---
 
+    async def send_event(self, event: Dict[str, Any]):
+        """Отправляет событие клиенту в формате согласованного протокола"""
+        await self.send(**self.protocol.encode(event))
+
+    def _already_sent(self, event) -> bool:
+        """Отсекает события, уже доставленные клиенту при дочитывании стрима."""
+        offset = event.get("offset")
+        if offset is None:
+            return False
+        if self.stream_offset is not None and parse_offset(offset) <= parse_offset(
+            self.stream_offset
+        ):
+            return True
+        self.stream_offset = offset
+        return False
+
+    async def _join_presence(self):
+        """Регистрирует соединение в присутствии чата и запускает heartbeat"""
+        if not ChatPresence.is_enabled():
+            return
+        try:
+            await ChatPresence.join(self.chat_id, self.channel_name)
+        except Exception as e:
+            logger.error(f"Failed to register presence in chat {self.chat_id}: {e}")
+        self.presence_heartbeat = asyncio.ensure_future(
+            ChatPresence.heartbeat(self.chat_id, self.channel_name)
+        )
+
+    async def _leave_presence(self):
+        if self.presence_heartbeat is None:
+            return
+        self.presence_heartbeat.cancel()
+        self.presence_heartbeat = None
+        try:
+            await ChatPresence.leave(self.chat_id, self.channel_name)
+        except Exception as e:
+            logger.error(f"Failed to remove presence in chat {self.chat_id}: {e}")
+
+    async def _is_generating(self) -> bool:
+        try:
+            return await GenerationRegistry.is_generating(self.chat_id)
+        except Exception as e:
+            logger.error(f"Failed to check generation state: {e}")
+            return False
+
+    async def _resume(self, offset: Optional[str]):
+        """Досылает события генерации из стрима чата после offset."""
+        if not GenerationStream.is_enabled():
+            return
+        if not is_valid_offset(offset):
+            offset = STREAM_START
+
+        try:
+            events = await GenerationStream.read_after(self.chat_id, offset)
+        except Exception as e:
+            logger.error(f"Failed to read stream for chat {self.chat_id}: {e}")
+            return
+
+        # События ниже offset клиента у него уже есть
+        if offset != STREAM_START and self.stream_offset is None:
+            self.stream_offset = offset
+
+        for event in events:
+            if event["type"] == "ai_chunk":
+                await self.ai_chunk(event)
+            elif event["type"] == "ai_thinking":
+                await self.ai_thinking(event)
+            elif event["type"] == "ai_complete":
+                await self.ai_complete(event)
+
     @database_sync_to_async
     def _check_chat_access(self):
         """Проверяет, имеет ли пользователь доступ к чату"""
@@ -461,38 +798,17 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
 
     @database_sync_to_async
     def _save_user_message(self, content):
-        """Сохраняет сообщение пользователя в БД"""
-        from chatbot.models import Chat, Message
-
-        with transaction.atomic():
-            # Блокируем запись чата для обновления
-            chat = Chat.objects.select_for_update().get(id=self.chat_id)
-
-            # Создаем сообщение
-            message = Message.objects.create(
-                chat=chat,
-                sender=self.user,
-                content=content,
-                message_type="text",
-            )
+        """Сохраняет сообщение пользователя в БД одним оператором"""
+        from chatbot.writes import save_user_message
 
-            # Обновляем время последней активности
-            # chat.touch()
-
-            return message
+        return save_user_message(self.chat_id, self.user, content)
 
     # --- Методы для health check и управления ---
 
     @classmethod
     async def get_active_connections_count(cls, chat_id: str) -> int:
-        """Возвращает количество активных соединений для чата"""
-        from channels.layers import get_channel_layer
-
-        channel_layer = get_channel_layer()
-
-        # В реальности это сложнее, но для примера:
-        # Нужно хранить информацию о соединениях
-        return 0
+        """Возвращает количество активных соединений для чата на всех воркерах"""
+        return await ChatPresence.count(chat_id)
 
     @classmethod
     async def broadcast_to_chat(cls, chat_id: str, message: dict):
@@ -507,9 +823,7 @@ class ServiceChatConsumer(AsyncWebsocketConsumer):
 
     async def broadcast_message(self, event):
         """Обработчик для broadcast сообщений"""
-        await self.send(
-            text_data=json.dumps({"type": "broadcast", "message": event["message"]})
-        )
+        await self.send_event({"type": "broadcast", "message": event["message"]})
 
 
 # Декоратор для обработки ошибок в AI генерации
@@ -528,6 +842,46 @@ def handle_ai_errors(func):
     return wrapper
 
 
+async def drain_generations(timeout: Optional[float] = None):
+    """
+    Плавная остановка процесса по SIGTERM.
+
+    Новые генерации больше не принимаются, идущие дорабатывают до
+    AI_DRAIN_TIMEOUT секунд. Клиенты к этому моменту уже переподключены
+    сервером (код 1012) к другим воркерам и получают чанки через группу
+    чата и стрим воспроизведения. Генерации, не успевшие к дедлайну,
+    прерываются: частичный ответ сохраняется, а ai_complete уходит с
+    reason "shutdown", чтобы клиент не ждал продолжения.
+    """
+    if timeout is None:
+        timeout = getattr(settings, "AI_DRAIN_TIMEOUT", 60)
+    begin_draining()
+
+    tasks = [
+        asyncio.wrap_future(task)
+        if isinstance(task, concurrent.futures.Future)
+        else task
+        for task in list(_GENERATION_TASKS)
+        if not task.done()
+    ]
+    if tasks:
+        logger.info(f"Draining {len(tasks)} AI generation(s), deadline {timeout}s")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            interrupted = GenerationRegistry.interrupt_local("shutdown")
+            logger.warning(
+                f"Drain deadline exceeded, interrupted {interrupted} generation(s)"
+            )
+            # Даем прерванным генерациям сохранить частичные ответы
+            _, pending = await asyncio.wait(
+                pending, timeout=getattr(settings, "AI_DRAIN_PERSIST_TIMEOUT", 10)
+            )
+            for task in pending:
+                task.cancel()
+
+    await asyncio.get_running_loop().run_in_executor(None, shutdown_ai_executor)
+
+
 # Утилита для graceful shutdown
 def shutdown_ai_executor():
     """Корректное завершение работы AI executor"""
@@ -0,0 +1,232 @@
+"""Контекст многоходовых диалогов: кеш context Ollama и окно истории чата."""
+
+import json
+import logging
+import math
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from chatbot.db import generation_db
+from chatbot.redis_client import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_KEY = "chatbot:context:{chat_id}"
+VERSION_KEY = "chatbot:context:{chat_id}:version"
+HISTORY_KEY = "chatbot:history:{chat_id}"
+
+# Сохранить значение, только если чат не инвалидировали с момента чтения
+_STORE_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# Удалить контекст и окно истории и сдвинуть версию, чтобы идущая
+# генерация не записала их обратно
+_INVALIDATE_SCRIPT = """
+redis.call('del', KEYS[1], KEYS[3])
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "AI_CONTEXT_TTL", 3600))
+
+
+class ConversationContextCache:
+    """
+    Хранит массив context, который Ollama возвращает в конце генерации.
+
+    Передача context в следующий запрос позволяет модели продолжить диалог
+    без повторного prefill всей переписки. Записи живут AI_CONTEXT_TTL секунд
+    и сбрасываются при редактировании или удалении сообщений чата.
+    """
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, "AI_CONTEXT_REUSE", True)
+
+    @classmethod
+    async def get(cls, chat_id: str, model: str) -> Tuple[Optional[List[int]], str]:
+        """Возвращает контекст чата для модели и версию, на которой он прочитан."""
+        keys = CONTEXT_KEY.format(chat_id=chat_id), VERSION_KEY.format(chat_id=chat_id)
+        raw, version = await get_redis().mget(*keys)
+        version = version or "0"
+        if raw is None:
+            return None, version
+
+        entry = json.loads(raw)
+        if entry.get("model") != model:
+            return None, version
+        return entry["context"], version
+
+    @classmethod
+    async def store(cls, chat_id: str, model: str, context: List[int], version: str):
+        """Сохраняет новый контекст, если чат не менялся с момента чтения."""
+        max_tokens = getattr(settings, "AI_CONTEXT_MAX_TOKENS", 32768)
+        if len(context) > max_tokens:
+            await cls.invalidate(chat_id)
+            return
+
+        await get_redis().eval(
+            _STORE_SCRIPT,
+            2,
+            CONTEXT_KEY.format(chat_id=chat_id),
+            VERSION_KEY.format(chat_id=chat_id),
+            version,
+            json.dumps({"model": model, "context": context}),
+            _ttl(),
+        )
+
+    @classmethod
+    async def invalidate(cls, chat_id: str):
+        """Сбрасывает контекст и окно истории чата."""
+        await get_redis().eval(
+            _INVALIDATE_SCRIPT,
+            3,
+            CONTEXT_KEY.format(chat_id=chat_id),
+            VERSION_KEY.format(chat_id=chat_id),
+            HISTORY_KEY.format(chat_id=chat_id),
+            _ttl(),
+        )
+
+    @classmethod
+    def invalidate_sync(cls, chat_id: str):
+        """Сбрасывает контекст и окно истории из синхронного кода (сигналы ORM)."""
+        get_sync_redis().eval(
+            _INVALIDATE_SCRIPT,
+            3,
+            CONTEXT_KEY.format(chat_id=chat_id),
+            VERSION_KEY.format(chat_id=chat_id),
+            HISTORY_KEY.format(chat_id=chat_id),
+            _ttl(),
+        )
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без загрузки токенизатора модели."""
+    return max(1, math.ceil(len(text) / getattr(settings, "AI_CHARS_PER_TOKEN", 3)))
+
+
+def get_token_budget(model: str) -> int:
+    """Бюджет токенов истории для модели."""
+    budgets = getattr(settings, "AI_HISTORY_TOKEN_BUDGETS", {})
+    return budgets.get(model, getattr(settings, "AI_HISTORY_TOKEN_BUDGET", 2048))
+
+
+def _to_entry(message) -> Dict[str, Any]:
+    return {
+        "id": str(message.id),
+        "role": "user" if message.sender_id else "assistant",
+        "content": message.content,
+        "tokens": estimate_tokens(message.content),
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def _history_queryset(chat_id: str):
+    from chatbot.models import Message
+
+    return Message.objects.filter(
+        chat_id=chat_id, message_type="text", deleted_for_owner=False
+    ).only("id", "sender", "content", "created_at")
+
+
+@generation_db
+def _load_recent(chat_id: str, budget: int) -> List[Dict[str, Any]]:
+    """Читает историю с конца, пока не наберется бюджет токенов."""
+    entries: List[Dict[str, Any]] = []
+    total = 0
+    for message in (
+        _history_queryset(chat_id).order_by("-created_at").iterator(chunk_size=50)
+    ):
+        entry = _to_entry(message)
+        if entries and total + entry["tokens"] > budget:
+            break
+        entries.append(entry)
+        total += entry["tokens"]
+    entries.reverse()
+    return entries
+
+
+@generation_db
+def _load_newer(chat_id: str, entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Читает только сообщения, появившиеся после последнего в окне."""
+    last_created = entries[-1]["created_at"]
+    known = [e["id"] for e in entries if e["created_at"] == last_created]
+    queryset = (
+        _history_queryset(chat_id)
+        .filter(created_at__gte=datetime.fromisoformat(last_created))
+        .exclude(id__in=known)
+        .order_by("created_at")
+    )
+    return [_to_entry(message) for message in queryset]
+
+
+def trim_to_budget(entries: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    """Отбрасывает старые сообщения, пока окно не влезет в бюджет."""
+    total = sum(e["tokens"] for e in entries)
+    start = 0
+    # Последнее сообщение (текущий вопрос) остается всегда
+    while total > budget and start < len(entries) - 1:
+        total -= entries[start]["tokens"]
+        start += 1
+    return entries[start:]
+
+
+def render_history(entries: List[Dict[str, Any]]) -> str:
+    """Собирает окно истории в промпт для /api/generate."""
+    labels = {"user": "User", "assistant": "Assistant"}
+    parts = [f"{labels[e['role']]}: {e['content']}" for e in entries]
+    parts.append(f"{labels['assistant']}:")
+    return "\n\n".join(parts)
+
+
+class HistoryAssembler:
+    """
+    Собирает вход модели из сообщений чата в пределах бюджета токенов.
+
+    Окно истории кешируется в Redis и на каждом ходу только дополняется
+    новыми сообщениями, поэтому стоимость хода O(новых сообщений), а не
+    O(всей переписки). Окно сбрасывается вместе с контекстом Ollama.
+    """
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, "AI_HISTORY_ENABLED", True)
+
+    @classmethod
+    async def assemble(cls, chat_id: str, model: str) -> List[Dict[str, Any]]:
+        """Возвращает окно истории чата, заканчивающееся последним сообщением."""
+        budget = get_token_budget(model)
+        history_key = HISTORY_KEY.format(chat_id=chat_id)
+        version_key = VERSION_KEY.format(chat_id=chat_id)
+
+        redis = get_redis()
+        raw, version = await redis.mget(history_key, version_key)
+        window = json.loads(raw) if raw else None
+
+        if window and window["budget"] == budget and window["entries"]:
+            entries = window["entries"] + await _load_newer(chat_id, window["entries"])
+        else:
+            entries = await _load_recent(chat_id, budget)
+
+        entries = trim_to_budget(entries, budget)
+
+        await redis.eval(
+            _STORE_SCRIPT,
+            2,
+            history_key,
+            version_key,
+            version or "0",
+            json.dumps({"budget": budget, "entries": entries}),
+            _ttl(),
+        )
+        return entries
@@ -0,0 +1,177 @@
+"""Пул потоков с соединениями БД для конвейера генерации."""
+
+import functools
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from asgiref.sync import SyncToAsync
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from chatbot.metrics import DB_CONNECTIONS_OPEN, DB_POOL_JOBS_IN_PROGRESS
+
+logger = logging.getLogger(__name__)
+
+DB_THREAD_PREFIX = "ai_db"
+
+_DB_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class _ConnectionState:
+    __slots__ = ("opened_at", "used_at", "pool")
+
+    def __init__(self, pool: str):
+        self.opened_at = self.used_at = time.monotonic()
+        self.pool = pool
+
+
+# Соединения процесса: DatabaseWrapper -> когда открыто и каким пулом
+_connections: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_connections_lock = threading.Lock()
+
+
+def _pool_name() -> str:
+    if threading.current_thread().name.startswith(DB_THREAD_PREFIX):
+        return "generation"
+    return "other"
+
+
+def _track_connection(sender, connection, **kwargs):
+    with _connections_lock:
+        _connections[connection] = _ConnectionState(_pool_name())
+
+
+connection_created.connect(_track_connection, dispatch_uid="chatbot_db_track")
+
+
+def open_connections(pool: str) -> int:
+    """Число открытых соединений процесса в пуле generation или other."""
+    with _connections_lock:
+        return sum(
+            1
+            for wrapper, state in _connections.items()
+            if state.pool == pool and wrapper.connection is not None
+        )
+
+
+for _pool in ("generation", "other"):
+    DB_CONNECTIONS_OPEN.labels(_pool).set_function(
+        functools.partial(open_connections, _pool)
+    )
+
+
+def _close(conn, reason: str):
+    logger.info(f"Closing DB connection {conn.alias} of {_pool_name()} pool: {reason}")
+    try:
+        conn.close()
+    except Exception as e:
+        logger.warning(f"Failed to close DB connection {conn.alias}: {e}")
+
+
+def prepare_connections():
+    """
+    Проверяет соединения потока перед задачей.
+
+    Соединение, простоявшее дольше AI_DB_HEALTH_CHECK_INTERVAL секунд,
+    проверяется запросом; сломанное закрывается, и задача откроет новое.
+    """
+    interval = getattr(settings, "AI_DB_HEALTH_CHECK_INTERVAL", 10)
+    now = time.monotonic()
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is None:
+            continue
+        state = _connections.get(conn)
+        if state is not None and now - state.used_at < interval:
+            continue
+        if not conn.is_usable():
+            _close(conn, "health check failed")
+
+
+def release_connections():
+    """
+    Решает после задачи, оставить ли соединения потока открытыми.
+
+    Соединение закрывается, если задача оставила открытую транзакцию,
+    если после ошибки БД оно больше не отвечает или если оно живет
+    дольше AI_DB_CONN_MAX_AGE секунд. Иначе им воспользуется следующая
+    задача этого потока.
+    """
+    max_age = getattr(settings, "AI_DB_CONN_MAX_AGE", 300)
+    now = time.monotonic()
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is None:
+            continue
+        state = _connections.get(conn)
+        if conn.in_atomic_block:
+            _close(conn, "transaction left open")
+        elif conn.errors_occurred and not conn.is_usable():
+            _close(conn, "unusable after error")
+        elif state is not None and now - state.opened_at >= max_age:
+            _close(conn, "max age reached")
+        else:
+            conn.errors_occurred = False
+            if state is not None:
+                state.used_at = now
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Пул на AI_DB_POOL_SIZE потоков - не больше соединений генерации на процесс."""
+    global _DB_EXECUTOR
+    with _executor_lock:
+        if _DB_EXECUTOR is None:
+            _DB_EXECUTOR = ThreadPoolExecutor(
+                max_workers=getattr(settings, "AI_DB_POOL_SIZE", 4),
+                thread_name_prefix=DB_THREAD_PREFIX,
+            )
+        return _DB_EXECUTOR
+
+
+def shutdown_db_executor(wait: bool = True):
+    """Дожидается задач пула и закрывает его; следующий вызов создаст новый."""
+    global _DB_EXECUTOR
+    with _executor_lock:
+        executor, _DB_EXECUTOR = _DB_EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def _run_job(func, *args, **kwargs):
+    with DB_POOL_JOBS_IN_PROGRESS.track_inprogress():
+        prepare_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_connections()
+
+
+def generation_db(func):
+    """
+    database_sync_to_async для конвейера генерации.
+
+    Запросы выполняются в пуле get_db_executor: потоки пула держат свои
+    соединения между задачами, поэтому генерация не открывает соединение
+    на каждую запись, а число одновременных запросов и соединений
+    ограничено размером пула. При AI_DB_POOL_SIZE = 0 используется
+    обычный database_sync_to_async.
+    """
+    shared = database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if getattr(settings, "AI_DB_POOL_SIZE", 4) <= 0:
+            return await shared(*args, **kwargs)
+        job = SyncToAsync(
+            functools.partial(_run_job, func),
+            thread_sensitive=False,
+            executor=get_db_executor(),
+        )
+        return await job(*args, **kwargs)
+
+    return wrapper
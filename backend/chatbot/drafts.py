@@ -0,0 +1,184 @@
+"""Черновики ответов AI: периодическое сохранение частичного ответа."""
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from chatbot.db import generation_db
+
+logger = logging.getLogger(__name__)
+
+
+@generation_db
+def _create_message(chat_id: str, content: str, is_draft: bool, thinking: str = ""):
+    """Создает сообщение модели вместе с обновлением активности чата."""
+    from chatbot.writes import create_message
+
+    return create_message(
+        chat_id=chat_id,
+        content=content,
+        message_type="text",
+        sender=None,
+        is_draft=is_draft,
+        thinking=thinking,
+    )
+
+
+@generation_db
+def _update_message(message, content: str, is_draft: bool, thinking: str = ""):
+    """Перезаписывает содержимое сообщения одним UPDATE."""
+    from chatbot.models import Chat, Message
+    from chatbot.writes import make_preview
+
+    Message.objects.filter(id=message.id).update(
+        content=content,
+        is_draft=is_draft,
+        thinking=thinking,
+        updated_at=timezone.now(),
+    )
+    if not is_draft:
+        # Превью чата показывает окончательный ответ, если он все еще последний
+        Chat.objects.filter(
+            id=message.chat_id, last_message_at=message.created_at
+        ).update(last_message_preview=make_preview(content))
+
+
+class DraftCheckpointer:
+    """
+    Сохраняет накапливаемый ответ модели в черновик сообщения.
+
+    Черновик создается после первых AI_DRAFT_CHECKPOINT_TOKENS токенов или
+    AI_DRAFT_CHECKPOINT_INTERVAL секунд генерации и дальше обновляется одним
+    UPDATE с той же периодичностью. Одновременно в БД идет не больше одной
+    записи, поэтому медленная БД не тормозит стрим. Короткий ответ, не
+    доживший до первой контрольной точки, сохраняется одним INSERT.
+    """
+
+    def __init__(
+        self,
+        chat_id: str,
+        every_tokens: Optional[int] = None,
+        interval: Optional[float] = None,
+    ):
+        if every_tokens is None:
+            every_tokens = getattr(settings, "AI_DRAFT_CHECKPOINT_TOKENS", 64)
+        if interval is None:
+            interval = getattr(settings, "AI_DRAFT_CHECKPOINT_INTERVAL", 2.0)
+
+        self.chat_id = chat_id
+        self.every_tokens = every_tokens
+        self.interval = interval
+        self.message_id: Optional[str] = None
+        self._message = None
+        self.checkpoints = 0
+        self.finalized = False
+        self._tokens = 0
+        self._last_at = time.monotonic()
+        self._pending: Optional[asyncio.Future] = None
+
+    def on_token(self, response: str):
+        """Учитывает токен и при необходимости запускает запись черновика."""
+        self._tokens += 1
+        if self._pending is not None and not self._pending.done():
+            return
+        if (
+            self._tokens < self.every_tokens
+            and time.monotonic() - self._last_at < self.interval
+        ):
+            return
+
+        self._tokens = 0
+        self._last_at = time.monotonic()
+        self._pending = asyncio.ensure_future(self._checkpoint(response))
+
+    async def _checkpoint(self, content: str):
+        try:
+            if self._message is None:
+                await self._create(content, True)
+            else:
+                await _update_message(self._message, content, True)
+            self.checkpoints += 1
+        except Exception as e:
+            logger.error(f"Failed to checkpoint draft for chat {self.chat_id}: {e}")
+
+    async def _wait_pending(self):
+        if self._pending is not None:
+            await asyncio.shield(self._pending)
+            self._pending = None
+
+    async def finalize(self, content: str, thinking: str = "") -> str:
+        """Сохраняет окончательный ответ и возвращает ID сообщения."""
+        await self._wait_pending()
+        if self._message is None:
+            await self._create(content, False, thinking)
+        else:
+            await _update_message(self._message, content, False, thinking)
+        self.finalized = True
+        return self.message_id
+
+    async def _create(self, content: str, is_draft: bool, thinking: str = ""):
+        self._message = await _create_message(self.chat_id, content, is_draft, thinking)
+        self.message_id = str(self._message.id)
+
+    async def close(self, content: str, thinking: str = ""):
+        """Закрывает черновик, если генерация оборвалась до финального сохранения."""
+        if self.finalized:
+            return
+        await self._wait_pending()
+        if self._message is not None:
+            await _update_message(self._message, content, False, thinking)
+            self.finalized = True
+
+
+def finalize_orphaned_drafts(stale_after: Optional[float] = None) -> int:
+    """
+    Закрывает черновики генераций, оборванных падением воркера.
+
+    Черновик считается брошенным, если он не обновлялся stale_after секунд
+    (по умолчанию - TTL аренды генерации) и аренда чата в Redis не занята.
+    Превью чата обновляется до сохраненной части ответа, если черновик
+    все еще последнее сообщение. Возвращает число закрытых черновиков.
+    """
+    from chatbot.models import Chat, Message
+    from chatbot.redis_client import get_sync_redis
+    from chatbot.registry import LEASE_KEY
+    from chatbot.writes import make_preview
+
+    if stale_after is None:
+        stale_after = getattr(settings, "AI_GENERATION_LEASE_TTL", 30)
+
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    drafts = Message.objects.filter(is_draft=True, updated_at__lt=cutoff)
+
+    # Генерации, которые еще идут на других воркерах, не трогаем
+    live_chats = []
+    try:
+        redis = get_sync_redis()
+        for chat_id in set(drafts.values_list("chat_id", flat=True)):
+            if redis.exists(LEASE_KEY.format(chat_id=chat_id)):
+                live_chats.append(chat_id)
+    except Exception as e:
+        logger.error(f"Failed to check generation leases, relying on age only: {e}")
+
+    orphans = list(
+        drafts.exclude(chat_id__in=live_chats).only(
+            "id", "chat_id", "content", "created_at"
+        )
+    )
+    now = timezone.now()
+    with transaction.atomic():
+        finalized = Message.objects.filter(
+            id__in=[message.id for message in orphans], is_draft=True
+        ).update(is_draft=False, updated_at=now)
+        # update() минует сигналы: активность чата обновляем сами, как _update_message
+        for message in orphans:
+            Chat.objects.filter(
+                id=message.chat_id, last_message_at=message.created_at
+            ).update(last_message_preview=make_preview(message.content), updated_at=now)
+    return finalized
@@ -0,0 +1,828 @@
+"""Асинхронный конвейер генерации ответов AI через Ollama."""
+
+import asyncio
+import functools
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+from django.conf import settings
+
+from chatbot.cache import ResponseCache
+from chatbot.context import ConversationContextCache, HistoryAssembler, render_history
+from chatbot.drafts import DraftCheckpointer
+from chatbot.metrics import (
+    GENERATION_CANCEL_LATENCY,
+    GENERATION_CHUNKS_UNATTENDED,
+    GENERATION_EVAL_TOKENS_PER_SECOND,
+    GENERATION_INTER_TOKEN_LATENCY,
+    GENERATION_PREFILL,
+    GENERATION_TIME_TO_FIRST_TOKEN,
+    GENERATION_TOKENS,
+)
+from chatbot.presence import PresenceWatcher
+from chatbot.registry import (
+    CancelToken,
+    GenerationBusyError,
+    GenerationLease,
+    GenerationRegistry,
+)
+from chatbot.router import (
+    NoBackendAvailable,
+    OllamaBackend,
+    OllamaRouter,
+    is_backend_failure,
+)
+from chatbot.scheduler import AdmissionTicket, GenerationScheduler, QueueFullError
+from chatbot.streams import GenerationStream
+
+logger = logging.getLogger(__name__)
+
+# Теги, которыми reasoning-модели (deepseek-r1) обрамляют рассуждения
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# Keep-alive сессии к Ollama: по одной на каждый event loop процесса
+_OLLAMA_SESSIONS: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+
+def get_ollama_session() -> aiohttp.ClientSession:
+    """
+    Возвращает пуловую HTTP-сессию к Ollama для текущего event loop.
+
+    Сессия создается лениво и переиспользует TCP-соединения между
+    генерациями, поэтому каждый запрос не платит за новое подключение.
+    """
+    loop = asyncio.get_running_loop()
+    session = _OLLAMA_SESSIONS.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=getattr(settings, "OLLAMA_POOL_SIZE", 32),
+            keepalive_timeout=getattr(settings, "OLLAMA_KEEPALIVE_TIMEOUT", 60),
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            headers={
+                "Content-Type": "application/json",
+                "User-Agent": "Django-ChatBot/1.0",
+            },
+        )
+        _OLLAMA_SESSIONS[loop] = session
+    return session
+
+
+async def close_ollama_session():
+    """Закрывает HTTP-сессию к Ollama, принадлежащую текущему event loop."""
+    session = _OLLAMA_SESSIONS.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def _publish(
+    channel_layer,
+    group_name: str,
+    chat_id: str,
+    event: Dict[str, Any],
+    presence: Optional[PresenceWatcher] = None,
+):
+    """
+    Дописывает событие в стрим воспроизведения чата и рассылает в группу.
+
+    Если presence не видит подписчиков, рассылка пропускается, а
+    подключившийся позже клиент дочитает событие из стрима. Присутствие
+    проверяется после записи в стрим: клиент входит в группу до чтения
+    стрима, поэтому событие, которого он не застал в стриме, уже видит его
+    в присутствии и будет разослано.
+    """
+    if GenerationStream.is_enabled():
+        try:
+            event["offset"] = await GenerationStream.append(chat_id, event)
+        except Exception as e:
+            logger.error(f"Failed to append to stream for chat {chat_id}: {e}")
+    if presence is None or await presence.has_listeners():
+        await channel_layer.group_send(group_name, event)
+    else:
+        GENERATION_CHUNKS_UNATTENDED.inc()
+
+
+class TokenCoalescer:
+    """
+    Склеивает токены модели в чанки по окну времени или размера.
+
+    Первый токен отправляется сразу, чтобы не увеличивать время до первого
+    токена. Остальные копятся в буфере и уходят одним сообщением, когда
+    буфер достигает max_bytes или с момента буферизации проходит interval_ms.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        interval_ms: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        if interval_ms is None:
+            interval_ms = getattr(settings, "AI_CHUNK_FLUSH_INTERVAL_MS", 50)
+        if max_bytes is None:
+            max_bytes = getattr(settings, "AI_CHUNK_FLUSH_BYTES", 512)
+
+        self._send = send
+        self.interval = interval_ms / 1000
+        self.max_bytes = max_bytes
+        self.messages_sent = 0
+        self._buffer: List[str] = []
+        self._size = 0
+        self._first_sent = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_flush: Optional[asyncio.Future] = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, token: str):
+        """Добавляет токен в буфер и при необходимости отправляет чанк."""
+        self._buffer.append(token)
+        self._size += len(token.encode("utf-8"))
+
+        if not self._first_sent or self._size >= self.max_bytes or self.interval <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.interval, self._on_timer
+            )
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_flush = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Отправляет накопленный буфер одним чанком."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            if not self._buffer:
+                return
+            chunk = "".join(self._buffer)
+            self._buffer.clear()
+            self._size = 0
+            self._first_sent = True
+            self.messages_sent += 1
+            await self._send(chunk)
+
+    async def close(self):
+        """Отправляет остаток буфера и дожидается отложенной отправки."""
+        await self.flush()
+        if self._timer_flush is not None:
+            await asyncio.shield(self._timer_flush)
+            self._timer_flush = None
+
+
+def _partial_tag(text: str, tag: str) -> int:
+    """Длина хвоста text, с которого может начинаться tag."""
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-size:]):
+            return size
+    return 0
+
+
+class ThinkSplitter:
+    """
+    Потоково отделяет рассуждения модели от ответа.
+
+    Текст между <think> и </think> считается рассуждением. Тег может быть
+    разрезан границей токенов, поэтому хвост, похожий на начало тега,
+    придерживается до следующего токена. Пробелы между </think> и ответом
+    отбрасываются.
+    """
+
+    def __init__(self):
+        self.thinking = False
+        self._pending = ""
+        self._strip_answer = False
+
+    def feed(self, text: str) -> List[Tuple[bool, str]]:
+        """Разбирает токен на отрезки (рассуждение ли это, текст)."""
+        segments: List[Tuple[bool, str]] = []
+        text = self._pending + text
+        self._pending = ""
+        while text:
+            tag = THINK_CLOSE if self.thinking else THINK_OPEN
+            index = text.find(tag)
+            if index < 0:
+                cut = len(text) - _partial_tag(text, tag)
+                self._emit(segments, text[:cut])
+                self._pending = text[cut:]
+                break
+
+            self._emit(segments, text[:index])
+            end = index + len(tag)
+            text = text[end:]
+            self.thinking = not self.thinking
+            self._strip_answer = not self.thinking
+        return segments
+
+    def close(self) -> List[Tuple[bool, str]]:
+        """Отдает придержанный хвост в конце генерации."""
+        segments: List[Tuple[bool, str]] = []
+        self._emit(segments, self._pending)
+        self._pending = ""
+        return segments
+
+    def _emit(self, segments: List[Tuple[bool, str]], text: str):
+        if not self.thinking and self._strip_answer:
+            text = text.lstrip()
+            if text:
+                self._strip_answer = False
+        if text:
+            segments.append((self.thinking, text))
+
+
+class GenerationState:
+    """Накопленное состояние одной генерации"""
+
+    def __init__(
+        self,
+        checkpointer: Optional[DraftCheckpointer] = None,
+        thinking_coalescer: Optional[TokenCoalescer] = None,
+        model: str = "",
+    ):
+        self.response = ""  # Ответ модели без рассуждений
+        self.thinking = ""  # Рассуждения модели
+        self.final: Dict[str, Any] = {}  # Финальная строка Ollama с done=true
+        self.checkpointer = checkpointer
+        # None - рассуждения клиентам не отправляются (AI_THINKING_STREAM)
+        self.thinking_coalescer = thinking_coalescer
+        self.splitter = ThinkSplitter()
+        self.model = model
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self._last_token_at: Optional[float] = None
+
+    def on_token(self):
+        """Замеряет время до первого токена и интервал между токенами."""
+        now = time.monotonic()
+        if self._last_token_at is None:
+            self.first_token_at = now
+            GENERATION_TIME_TO_FIRST_TOKEN.labels(model=self.model).observe(
+                now - self.started_at
+            )
+        else:
+            GENERATION_INTER_TOKEN_LATENCY.labels(model=self.model).observe(
+                now - self._last_token_at
+            )
+        self._last_token_at = now
+
+    @property
+    def eval_rate(self) -> Optional[float]:
+        """Скорость генерации в токенах/с по статистике Ollama."""
+        eval_count = self.final.get("eval_count")
+        eval_duration = self.final.get("eval_duration")
+        if not eval_count or not eval_duration:
+            return None
+        # Длительности Ollama приходят в наносекундах
+        return eval_count / (eval_duration / 1e9)
+
+    def on_final(self, data: Dict[str, Any]):
+        """Запоминает финальную строку Ollama и выгружает ее статистику."""
+        self.final = data
+        model = self.model
+        if data.get("prompt_eval_duration"):
+            GENERATION_PREFILL.labels(model=model).observe(
+                data["prompt_eval_duration"] / 1e9
+            )
+        if data.get("prompt_eval_count"):
+            GENERATION_TOKENS.labels(model=model, kind="prompt").inc(
+                data["prompt_eval_count"]
+            )
+        if data.get("eval_count"):
+            GENERATION_TOKENS.labels(model=model, kind="eval").inc(data["eval_count"])
+        if self.eval_rate is not None:
+            GENERATION_EVAL_TOKENS_PER_SECOND.labels(model=model).observe(
+                self.eval_rate
+            )
+
+    async def add_token(
+        self, token: str, coalescer: TokenCoalescer, thinking: bool = False
+    ):
+        """Раскладывает токен модели на рассуждение и ответ."""
+        segments = [(True, token)] if thinking else self.splitter.feed(token)
+        await self._route(segments, coalescer)
+
+    async def finish(self, coalescer: TokenCoalescer):
+        """Досылает хвост, придержанный разбором тегов."""
+        await self._route(self.splitter.close(), coalescer)
+
+    async def _route(self, segments: List[Tuple[bool, str]], coalescer: TokenCoalescer):
+        for is_thinking, text in segments:
+            if is_thinking:
+                self.thinking += text
+                if self.thinking_coalescer is not None:
+                    await self.thinking_coalescer.add(text)
+                continue
+
+            # Рассуждение уходит клиенту целиком раньше первого чанка ответа
+            if self.thinking_coalescer is not None:
+                await self.thinking_coalescer.flush()
+            self.response += text
+            if self.checkpointer is not None:
+                self.checkpointer.on_token(self.response)
+            # Копим токены и отправляем в группу укрупненными чанками
+            await coalescer.add(text)
+
+
+class AsyncOllamaClient:
+    """Асинхронный клиент Ollama API, работающий прямо в event loop консьюмера"""
+
+    @staticmethod
+    async def _stream(
+        request_data: Dict[str, Any],
+        state: GenerationState,
+        coalescer: TokenCoalescer,
+    ):
+        """
+        Отправляет генерацию на сервер из пула и стримит ответ в state.
+
+        Если сервер упал до первого токена, запрос повторяется на следующем.
+        """
+        router = OllamaRouter.shared()
+        failed: List[OllamaBackend] = []
+        last_error: Optional[Exception] = None
+        while True:
+            try:
+                async with router.dispatch(request_data["model"], failed) as backend:
+                    await AsyncOllamaClient._stream_from(
+                        backend, request_data, state, coalescer
+                    )
+                return
+            except NoBackendAvailable:
+                # Исправных серверов не осталось - отдаем исходную ошибку
+                if last_error is None:
+                    raise
+                raise last_error
+            except Exception as e:
+                if state.response or state.thinking or not is_backend_failure(e):
+                    raise
+                logger.warning(f"Ollama backend {backend.url} failed, retrying: {e}")
+                failed.append(backend)
+                last_error = e
+
+    @staticmethod
+    async def _stream_from(
+        backend: OllamaBackend,
+        request_data: Dict[str, Any],
+        state: GenerationState,
+        coalescer: TokenCoalescer,
+    ):
+        """Читает NDJSON-стрим сервера Ollama, накапливая ответ в state."""
+        timeout = aiohttp.ClientTimeout(total=getattr(settings, "OLLAMA_TIMEOUT", 300))
+        session = get_ollama_session()
+        async with session.post(
+            backend.generate_url,
+            json=request_data,
+            timeout=timeout,
+        ) as resp:
+            resp.raise_for_status()
+
+            try:
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    try:
+                        data = json.loads(line.decode("utf-8"))
+                    except json.JSONDecodeError as e:
+                        logger.warning(
+                            f"Failed to decode JSON line: {line[:100]}... Error: {e}"
+                        )
+                        continue
+
+                    if data.get("thinking") or data.get("response"):
+                        state.on_token()
+                    # С "think": true Ollama сама отдает рассуждения отдельным полем
+                    if data.get("thinking"):
+                        await state.add_token(data["thinking"], coalescer, True)
+                    if data.get("response"):
+                        await state.add_token(data["response"], coalescer)
+
+                    if data.get("done", False):
+                        await state.finish(coalescer)
+                        state.on_final(data)
+                        backend.record_success(data)
+                        break
+            except asyncio.CancelledError:
+                # Рвем соединение: Ollama прерывает генерацию и освобождает слот
+                resp.close()
+                raise
+
+    @staticmethod
+    async def _build_history_prompt(chat_id: str, model: str, prompt: str) -> str:
+        """Собирает промпт из окна истории, заканчивающегося вопросом."""
+        entries = await HistoryAssembler.assemble(chat_id, model)
+        last = entries[-1] if entries else None
+        if last is None or last["role"] != "user" or last["content"] != prompt:
+            entries.append({"role": "user", "content": prompt})
+        if len(entries) == 1:
+            return prompt
+        return render_history(entries)
+
+    @staticmethod
+    async def _update_context(
+        chat_id: str,
+        model: str,
+        state: GenerationState,
+        version: Optional[str],
+        cancelled: bool,
+    ):
+        """Запоминает контекст завершенного хода или сбрасывает его."""
+        if version is None:
+            return
+
+        try:
+            new_context = state.final.get("context")
+            if new_context and not cancelled:
+                await ConversationContextCache.store(
+                    chat_id, model, new_context, version
+                )
+            else:
+                # Частичный ответ не попал в контекст модели - начинаем заново
+                await ConversationContextCache.invalidate(chat_id)
+        except Exception as e:
+            logger.error(f"Failed to update context for chat {chat_id}: {e}")
+
+    @staticmethod
+    async def generate_response(
+        chat_id: str,
+        prompt: str,
+        model: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        channel_layer=None,
+        group_name: Optional[str] = None,
+        lease: Optional[GenerationLease] = None,
+    ) -> Dict[str, Any]:
+        """
+        Генерирует ответ от AI модели через Ollama API без блокирующих потоков.
+
+        Args:
+            chat_id: ID чата
+            prompt: Пользовательский промпт
+            model: Название модели (по умолчанию из настроек)
+            system_prompt: Системный промпт
+            channel_layer: Канальный слой для отправки сообщений
+            group_name: Имя группы для отправки сообщений
+            lease: Аренда генерации в реестре, снимается перед ai_complete
+
+        Returns:
+            Dict с результатом генерации
+        """
+        # Настройки по умолчанию
+        if model is None:
+            model = getattr(settings, "DEFAULT_AI_MODEL", "deepseek-r1:1.5b")
+
+        if system_prompt is None:
+            system_prompt = getattr(settings, "DEFAULT_SYSTEM_PROMPT", "")
+
+        if channel_layer is None:
+            from channels.layers import get_channel_layer
+
+            channel_layer = get_channel_layer()
+
+        if group_name is None:
+            group_name = f"chat_{chat_id}"
+
+        # Частичный ответ периодически сохраняется в черновик сообщения
+        checkpointer = DraftCheckpointer(chat_id)
+        message_id = "error"
+        error = None
+
+        # Чанки чата без подписчиков не рассылаются, сохраняется итог
+        presence = PresenceWatcher(chat_id)
+
+        async def send_chunk(chunk: str, event_type: str = "ai_chunk"):
+            try:
+                await _publish(
+                    channel_layer,
+                    group_name,
+                    chat_id,
+                    {
+                        "type": event_type,
+                        "chunk": chunk,
+                        "chat_id": chat_id,
+                    },
+                    presence=presence,
+                )
+            except Exception as e:
+                logger.error(f"Failed to send chunk: {e}")
+
+        coalescer = TokenCoalescer(send_chunk)
+        # Рассуждения идут событиями ai_thinking со своим буфером
+        thinking_coalescer = None
+        if getattr(settings, "AI_THINKING_STREAM", True):
+            thinking_coalescer = TokenCoalescer(
+                functools.partial(send_chunk, event_type="ai_thinking")
+            )
+        state = GenerationState(checkpointer, thinking_coalescer, model)
+
+        # Стрим очищается при взятии аренды; без аренды - здесь
+        if lease is None and GenerationStream.is_enabled():
+            try:
+                await GenerationStream.reset(chat_id)
+            except Exception as e:
+                logger.error(f"Failed to reset stream for chat {chat_id}: {e}")
+
+        # Аренда могла быть запущена раньше, еще в очереди допуска
+        if lease is not None and lease.cancel_token is None:
+            lease.start(CancelToken())
+        cancel_token = lease.cancel_token if lease is not None else CancelToken()
+
+        # Контекст прошлых ходов: модель продолжает диалог без повторного prefill
+        original_prompt = prompt
+        context, context_version = None, None
+        if ConversationContextCache.is_enabled():
+            try:
+                context, context_version = await ConversationContextCache.get(
+                    chat_id, model
+                )
+            except Exception as e:
+                logger.error(f"Failed to load context for chat {chat_id}: {e}")
+
+        # Без контекста собираем историю чата в пределах бюджета токенов модели
+        if not context and HistoryAssembler.is_enabled():
+            try:
+                prompt = await AsyncOllamaClient._build_history_prompt(
+                    chat_id, model, prompt
+                )
+            except Exception as e:
+                logger.error(f"Failed to assemble history for chat {chat_id}: {e}")
+
+        # Ответ на запрос без состояния диалога можно взять из кеша
+        cache_key = None
+        if ResponseCache.is_cacheable(original_prompt, prompt, context):
+            cache_key = ResponseCache.make_key(prompt, model, system_prompt)
+
+        try:
+            cached = await ResponseCache.get(cache_key) if cache_key else None
+
+            if cached is not None:
+                # Отдаем кешированный ответ тем же потоком ai_chunk
+                state.response = cached
+                await coalescer.add(cached)
+            else:
+                request_data = {"model": model, "prompt": prompt, "stream": True}
+
+                if system_prompt:
+                    request_data["system"] = system_prompt
+
+                if context:
+                    request_data["context"] = context
+
+                # Стрим идет отдельной задачей, которую прерывает токен отмены
+                stream = asyncio.ensure_future(
+                    AsyncOllamaClient._stream(request_data, state, coalescer)
+                )
+                cancel_token.bind(stream)
+                try:
+                    await stream
+                except asyncio.CancelledError:
+                    if not cancel_token.is_cancelled:
+                        raise
+
+            await state.finish(coalescer)
+            if thinking_coalescer is not None:
+                await thinking_coalescer.close()
+            await coalescer.close()
+
+            if cancel_token.is_cancelled:
+                latency = time.monotonic() - cancel_token.cancelled_at
+                GENERATION_CANCEL_LATENCY.observe(latency)
+                logger.info(
+                    f"AI generation cancelled for chat {chat_id}, "
+                    f"stream closed in {latency * 1000:.1f}ms"
+                )
+            elif state.final.get("total_duration"):
+                rate = state.eval_rate
+                rate_text = f"{rate:.1f}" if rate else "-"
+                logger.info(
+                    f"AI generation completed for chat {chat_id[:8]}... "
+                    f"Model: {model}, "
+                    f"Tokens: {state.final.get('eval_count')}, "
+                    f"Rate: {rate_text} tok/s, "
+                    f"Chunks sent: {coalescer.messages_sent}, "
+                    f"Duration: {state.final['total_duration'] / 1e6:.0f}ms"
+                )
+
+            if cached is None:
+                await AsyncOllamaClient._update_context(
+                    chat_id, model, state, context_version, cancel_token.is_cancelled
+                )
+
+            # В кеш попадают только полные ответы
+            if (
+                cache_key
+                and cached is None
+                and state.response
+                and state.final.get("done")
+                and not cancel_token.is_cancelled
+            ):
+                await ResponseCache.set(cache_key, state.response)
+
+            # Сохраняем сообщение в БД (после отмены - то, что успели получить)
+            if state.response:
+                try:
+                    message_id = await checkpointer.finalize(
+                        state.response, state.thinking
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to save AI message to DB: {e}", exc_info=True)
+                    error = "Ошибка сохранения сообщения"
+                    message_id = "db_error"
+            elif cancel_token.is_cancelled:
+                error = "Генерация отменена"
+                message_id = "cancelled"
+            else:
+                error = "Пустой ответ от модели"
+                message_id = "empty_response"
+
+        except asyncio.CancelledError:
+            logger.info(f"AI generation task cancelled for chat {chat_id}")
+            error = "Генерация отменена"
+            message_id = "cancelled"
+            raise
+
+        except asyncio.TimeoutError as e:
+            logger.error(f"Ollama timeout for chat {chat_id}: {e}")
+            error = "Превышено время ожидания ответа от модели"
+            message_id = "timeout_error"
+
+        except NoBackendAvailable as e:
+            logger.error(f"No Ollama backend for chat {chat_id}: {e}")
+            error = "Модель временно недоступна"
+            message_id = "connection_error"
+
+        except aiohttp.ClientError as e:
+            logger.error(f"Ollama connection error for chat {chat_id}: {e}")
+            error = "Модель временно недоступна"
+            message_id = "connection_error"
+
+        except Exception as e:
+            logger.error(
+                f"Unexpected error during AI generation for chat {chat_id}: {e}",
+                exc_info=True,
+            )
+            error = "Внутренняя ошибка сервера"
+            message_id = "internal_error"
+
+        finally:
+            # Досылаем буфер, чтобы ai_complete шел строго после последнего чанка
+            try:
+                await state.finish(coalescer)
+                if thinking_coalescer is not None:
+                    await thinking_coalescer.close()
+                await coalescer.close()
+            except Exception as e:
+                logger.error(f"Failed to flush buffered chunks: {e}")
+
+            # После ошибки в черновике остается то, что модель успела выдать
+            try:
+                await checkpointer.close(state.response, state.thinking)
+            except Exception as e:
+                logger.error(f"Failed to close draft for chat {chat_id}: {e}")
+
+            # Освобождаем чат до ai_complete, чтобы клиент сразу мог писать дальше
+            if lease is not None:
+                await lease.release()
+
+            # Всегда отправляем сообщение о завершении
+            try:
+                await _publish(
+                    channel_layer,
+                    group_name,
+                    chat_id,
+                    {
+                        "type": "ai_complete",
+                        "message_id": message_id,
+                        "chat_id": chat_id,
+                        "error": error,
+                        "cancelled": cancel_token.is_cancelled,
+                        # "shutdown": воркер остановлен, продолжить на другом;
+                        # "lease_lost": аренда истекла, чат мог занять другой воркер
+                        "reason": cancel_token.reason,
+                    },
+                )
+            except Exception as e:
+                logger.error(f"Failed to send completion message: {e}")
+
+        return {
+            "success": error is None,
+            "message_id": message_id,
+            "error": error,
+            "response_length": len(state.response),
+            "thinking_length": len(state.thinking),
+            "cancelled": cancel_token.is_cancelled,
+            "eval_count": state.final.get("eval_count"),
+            "eval_duration": state.final.get("eval_duration"),
+        }
+
+
+async def run_generation(
+    lease: Optional[GenerationLease] = None,
+    ticket: Optional[AdmissionTicket] = None,
+    user_id: Optional[str] = None,
+    **kwargs,
+) -> Optional[Dict[str, Any]]:
+    """
+    Выполняет генерацию под арендой в реестре и со слотом планировщика.
+
+    Если аренда или место в очереди не переданы, берет их сама. Возвращает
+    None, если генерация не стартовала (например, для чата уже идет
+    генерация на каком-либо воркере) - клиент получает об этом ai_complete.
+    """
+    chat_id = kwargs["chat_id"]
+    if lease is None:
+        lease = await GenerationRegistry.acquire(chat_id)
+        if lease is None:
+            logger.warning(f"Generation for chat {chat_id} is already running, skipped")
+            if ticket is not None:
+                GenerationScheduler.for_loop().cancel(ticket)
+            await send_not_started(chat_id, kwargs, GenerationBusyError(chat_id))
+            return None
+
+    scheduler = GenerationScheduler.for_loop()
+    cancel_token = CancelToken()
+    lease.start(cancel_token)
+    # Отмена могла прийти, пока задача ждала воркера в брокере
+    if await lease.cancel_requested():
+        cancel_token.cancel()
+
+    try:
+        if cancel_token.is_cancelled:
+            raise asyncio.CancelledError()
+        if ticket is None:
+            ticket = scheduler.reserve(user_id or chat_id, chat_id, kwargs.get("model"))
+        ticket.chat_id = chat_id
+
+        # Ожидание в очереди прерывается той же отменой, что и стрим
+        waiter = asyncio.ensure_future(scheduler.wait(ticket))
+        cancel_token.bind(waiter)
+        await waiter
+    except (asyncio.CancelledError, Exception) as e:
+        # Иначе heartbeat продлевал бы аренду, и чат оставался бы занят
+        if ticket is not None:
+            scheduler.cancel(ticket)
+        await lease.release()
+        if isinstance(e, asyncio.CancelledError) and not cancel_token.is_cancelled:
+            raise
+        if not isinstance(e, (asyncio.CancelledError, QueueFullError)):
+            logger.error(
+                f"Failed to schedule generation for chat {chat_id}: {e}", exc_info=True
+            )
+        await send_not_started(chat_id, kwargs, e)
+        return None
+
+    result = None
+    try:
+        result = await AsyncOllamaClient.generate_response(lease=lease, **kwargs)
+        return result
+    finally:
+        # Итог генерации подстраивает лимит параллелизма модели
+        scheduler.release(ticket, result)
+
+
+async def send_not_started(chat_id: str, kwargs: Dict[str, Any], reason: Exception):
+    """Сообщает клиенту, что генерация так и не стартовала."""
+    if isinstance(reason, QueueFullError):
+        message_id, error = "queue_full", "Сервер перегружен, повторите запрос позже"
+    elif isinstance(reason, GenerationBusyError):
+        message_id, error = "busy", "Для этого чата уже идет генерация"
+    elif isinstance(reason, asyncio.CancelledError):
+        message_id, error = "cancelled", "Генерация отменена"
+    else:
+        message_id, error = "failed", "Не удалось запустить генерацию"
+
+    channel_layer = kwargs.get("channel_layer")
+    if channel_layer is None:
+        from channels.layers import get_channel_layer
+
+        channel_layer = get_channel_layer()
+
+    group_name = kwargs.get("group_name") or f"chat_{chat_id}"
+    event = {
+        "type": "ai_complete",
+        "message_id": message_id,
+        "chat_id": chat_id,
+        "error": error,
+        "cancelled": message_id == "cancelled",
+        # Генерация не стартовала: клиент отличает это от оборванного ответа
+        "reason": message_id,
+    }
+    try:
+        if isinstance(reason, GenerationBusyError):
+            # Стрим принадлежит идущей генерации - его читатели не должны
+            # принять этот отказ за ее окончание
+            await channel_layer.group_send(group_name, event)
+        else:
+            # Через стрим воспроизведения итог увидят и читатели SSE
+            await _publish(channel_layer, group_name, chat_id, event)
+    except Exception as e:
+        logger.error(f"Failed to send completion message: {e}")
@@ -0,0 +1,47 @@
+"""ASGI lifespan: плавная остановка процесса с идущими генерациями."""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LifespanApp:
+    """
+    Обработчик протокола lifespan для ProtocolTypeRouter.
+
+    uvicorn по SIGTERM перестает принимать соединения, закрывает
+    веб-сокеты с кодом 1012 и ждет окончания HTTP-ответов. Режим остановки
+    включается уже по сигналу (install_drain_signal), чтобы SSE-потоки
+    закрылись с подсказкой переподключиться. Затем приходит
+    lifespan.shutdown, на котором процесс дожидается своих генераций
+    (drain_generations) и закрывает пулы потоков.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def startup(self):
+        from chatbot.consumers import install_drain_signal, set_server_loop
+
+        # Генерации из DRF-представлений запускаются в этом event loop
+        set_server_loop(asyncio.get_running_loop())
+        install_drain_signal()
+
+    async def shutdown(self):
+        from chatbot.consumers import drain_generations
+        from chatbot.db import shutdown_db_executor
+
+        try:
+            await drain_generations()
+            await asyncio.get_running_loop().run_in_executor(None, shutdown_db_executor)
+        except Exception as e:
+            logger.error(f"Failed to drain AI generations: {e}", exc_info=True)
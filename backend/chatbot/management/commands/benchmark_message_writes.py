@@ -0,0 +1,67 @@
+"""Нагрузочный замер записи сообщений пользователя в чат."""
+
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chatbot.models import Chat, Message
+from chatbot.writes import save_user_message
+
+
+def _legacy_save(chat_id, user, content):
+    """Прежний путь записи: блокировка строки чата на всю транзакцию."""
+    with transaction.atomic():
+        chat = Chat.objects.select_for_update().get(id=chat_id)
+        return Message.objects.create(
+            chat=chat, sender=user, content=content, message_type="text"
+        )
+
+
+class Command(BaseCommand):
+    """Команда замера задержек записи сообщений под нагрузкой."""
+
+    help = "Benchmark user-message inserts into one chat under concurrent load"
+
+    def add_arguments(self, parser):
+        """Описание аргументов команды."""
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument(
+            "--legacy",
+            action="store_true",
+            help="Measure the old select_for_update path for comparison",
+        )
+
+    def handle(self, *args, **options):
+        """Запуск действий команды."""
+        save = _legacy_save if options["legacy"] else save_user_message
+        user = User.objects.create_user(username=f"bench_{uuid.uuid4().hex[:12]}")
+        chat = Chat.objects.create(owner=user, name="benchmark")
+
+        def write(i):
+            started = time.perf_counter()
+            save(str(chat.id), user, f"benchmark message {i}")
+            return time.perf_counter() - started
+
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                latencies = sorted(pool.map(write, range(options["messages"])))
+            elapsed = time.perf_counter() - started
+        finally:
+            user.delete()
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{'legacy' if options['legacy'] else 'single-statement'} path: "
+            f"{len(latencies)} messages, concurrency {options['concurrency']}, "
+            f"{len(latencies) / elapsed:.0f} msg/s\n"
+            f"p50 {quantiles[49] * 1000:.2f}ms, "
+            f"p95 {quantiles[94] * 1000:.2f}ms, "
+            f"p99 {quantiles[98] * 1000:.2f}ms"
+        )
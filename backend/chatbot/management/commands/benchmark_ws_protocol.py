@@ -0,0 +1,85 @@
+"""Сравнение JSON и msgpack протоколов веб-сокета по размеру и CPU."""
+
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from chatbot.protocol import JsonProtocol, MsgpackProtocol
+
+
+def _response_events(tokens, chunk_tokens):
+    """События одного ответа: чанки по chunk_tokens токенов и ai_complete."""
+    chat_id = str(uuid.uuid4())
+    words = [f"слово{i} " for i in range(tokens)]
+    events = []
+    for n, start in enumerate(range(0, tokens, chunk_tokens), start=1):
+        end = start + chunk_tokens
+        events.append(
+            {
+                "type": "ai_chunk",
+                "chunk": "".join(words[start:end]),
+                "chat_id": chat_id,
+                "offset": f"{1700000000000 + n}-0",
+            }
+        )
+    events.append(
+        {
+            "type": "ai_complete",
+            "message_id": str(uuid.uuid4()),
+            "chat_id": chat_id,
+            "error": None,
+            "cancelled": False,
+            "offset": f"{1700000000000 + len(events) + 1}-0",
+        }
+    )
+    return events
+
+
+def _frame_size(frame) -> int:
+    if "text_data" in frame:
+        return len(frame["text_data"].encode("utf-8"))
+    return len(frame["bytes_data"])
+
+
+class Command(BaseCommand):
+    """Команда замера размера ответа и стоимости кодирования кадров."""
+
+    help = "Benchmark bytes per response and CPU per frame of WebSocket protocols"
+
+    def add_arguments(self, parser):
+        """Описание аргументов команды."""
+        parser.add_argument("--tokens", type=int, default=500)
+        parser.add_argument(
+            "--chunk-tokens",
+            type=int,
+            default=1,
+            help="Tokens per ai_chunk frame (1 = no coalescing)",
+        )
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        """Запуск действий команды."""
+        events = _response_events(options["tokens"], options["chunk_tokens"])
+        self.stdout.write(
+            f"{len(events)} frames per response, "
+            f"{options['tokens']} tokens, {options['repeat']} repeats"
+        )
+
+        for protocol in (JsonProtocol(), MsgpackProtocol()):
+            frames = [protocol.encode(event) for event in events]
+            size = sum(_frame_size(frame) for frame in frames)
+
+            started = time.process_time()
+            for _ in range(options["repeat"]):
+                for event in events:
+                    protocol.encode(event)
+            encode_cpu = time.process_time() - started
+
+            name = protocol.name or "json"
+            per_frame = encode_cpu / (options["repeat"] * len(events))
+            self.stdout.write(
+                f"{name}: {size} bytes/response, "
+                f"{size / len(frames):.1f} bytes/frame, "
+                f"encode {per_frame * 1e6:.2f}us CPU/frame"
+            )
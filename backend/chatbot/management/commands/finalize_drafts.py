@@ -0,0 +1,25 @@
+"""Закрытие черновиков ответов AI, брошенных упавшими воркерами."""
+
+from django.core.management.base import BaseCommand
+
+from chatbot.drafts import finalize_orphaned_drafts
+
+
+class Command(BaseCommand):
+    """Команда закрытия брошенных черновиков."""
+
+    help = "Finalize AI response drafts left by crashed or restarted workers"
+
+    def add_arguments(self, parser):
+        """Описание аргументов команды."""
+        parser.add_argument(
+            "--stale-after",
+            type=float,
+            default=None,
+            help="Seconds since the last checkpoint (default: generation lease TTL)",
+        )
+
+    def handle(self, *args, **options):
+        """Запуск действий команды."""
+        count = finalize_orphaned_drafts(options["stale_after"])
+        self.stdout.write(self.style.SUCCESS(f"Finalized {count} orphaned drafts"))
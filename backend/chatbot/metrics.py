@@ -0,0 +1,141 @@
+"""Prometheus-метрики чат-бота."""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+GENERATION_CANCEL_LATENCY = Histogram(
+    "chatbot_generation_cancel_latency_seconds",
+    "Время от запроса отмены генерации до закрытия стрима Ollama",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")),
+)
+
+GENERATION_CHUNKS_UNATTENDED = Counter(
+    "chatbot_generation_chunks_unattended_total",
+    "Чанки генерации, не разосланные из-за отсутствия подписчиков чата",
+)
+
+GENERATION_QUEUE_WAIT = Histogram(
+    "chatbot_generation_queue_wait_seconds",
+    "Время ожидания генерации в очереди допуска",
+    ["model"],
+    buckets=(
+        0.01,
+        0.05,
+        0.1,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+        60.0,
+        120.0,
+        float("inf"),
+    ),
+)
+
+GENERATION_TIME_TO_FIRST_TOKEN = Histogram(
+    "chatbot_generation_time_to_first_token_seconds",
+    "Время от запуска генерации после допуска до первого токена модели",
+    ["model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")),
+)
+
+GENERATION_INTER_TOKEN_LATENCY = Histogram(
+    "chatbot_generation_inter_token_latency_seconds",
+    "Интервал между соседними токенами стрима Ollama",
+    ["model"],
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, float("inf")),
+)
+
+GENERATION_EVAL_TOKENS_PER_SECOND = Histogram(
+    "chatbot_generation_eval_tokens_per_second",
+    "Скорость генерации по eval_count/eval_duration из ответа Ollama",
+    ["model"],
+    buckets=(1, 2.5, 5, 10, 20, 40, 60, 80, 120, 200, 500, float("inf")),
+)
+
+GENERATION_PREFILL = Histogram(
+    "chatbot_generation_prefill_seconds",
+    "Время обработки промпта моделью (prompt_eval_duration Ollama)",
+    ["model"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")),
+)
+
+GENERATION_TOKENS = Counter(
+    "chatbot_generation_tokens_total",
+    "Токены, обработанные моделью: prompt - промпт, eval - сгенерированные",
+    ["model", "kind"],
+)
+
+GENERATION_ACTIVE = Gauge(
+    "chatbot_generation_active",
+    "Генерации, допущенные планировщиком и еще не завершенные",
+    ["model"],
+)
+
+GENERATION_SATURATION = Gauge(
+    "chatbot_generation_saturation",
+    "Занятость слотов модели: активные генерации / адаптивный лимит",
+    ["model"],
+)
+
+AI_EXECUTOR_BUSY = Gauge(
+    "chatbot_ai_executor_busy_threads",
+    "Занятые потоки пула генераций вне event loop (_AI_EXECUTOR)",
+)
+
+AI_EXECUTOR_MAX_WORKERS = Gauge(
+    "chatbot_ai_executor_max_workers",
+    "Размер пула генераций вне event loop (AI_MAX_WORKERS)",
+)
+
+GENERATION_QUEUE_DEPTH = Gauge(
+    "chatbot_generation_queue_depth",
+    "Число генераций, ожидающих допуска",
+)
+
+OLLAMA_BACKEND_IN_FLIGHT = Gauge(
+    "chatbot_ollama_backend_in_flight",
+    "Число генераций, выполняющихся на сервере Ollama",
+    ["backend"],
+)
+
+OLLAMA_BACKEND_TOKENS_PER_SECOND = Gauge(
+    "chatbot_ollama_backend_tokens_per_second",
+    "Скользящая средняя скорость генерации сервера Ollama",
+    ["backend"],
+)
+
+OLLAMA_BACKEND_UP = Gauge(
+    "chatbot_ollama_backend_up",
+    "Исправен ли сервер Ollama (0 - отключен автоматом)",
+    ["backend"],
+)
+
+GENERATION_CONCURRENCY_LIMIT = Gauge(
+    "chatbot_generation_concurrency_limit",
+    "Адаптивный лимит одновременных генераций модели",
+    ["model"],
+)
+
+RESPONSE_CACHE_HITS = Counter(
+    "chatbot_response_cache_hits_total",
+    "Ответы, отданные из кеша, по уровню кеша",
+    ["tier"],
+)
+
+RESPONSE_CACHE_MISSES = Counter(
+    "chatbot_response_cache_misses_total",
+    "Запросы, для которых ответа в кеше не нашлось",
+)
+
+DB_CONNECTIONS_OPEN = Gauge(
+    "chatbot_db_connections_open",
+    "Открытые соединения с БД в процессе по пулам потоков",
+    ["pool"],
+)
+
+DB_POOL_JOBS_IN_PROGRESS = Gauge(
+    "chatbot_db_pool_jobs_in_progress",
+    "Запросы генерации, выполняющиеся в пуле соединений БД",
+)
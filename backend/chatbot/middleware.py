@@ -3,6 +3,8 @@
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 
+from chatbot.protocol import SUBPROTOCOLS
+
 
 class JWTAuthMiddleware(BaseMiddleware):
     """Middleware для JWT аутентификации в WebSocket."""
@@ -17,39 +19,70 @@ class JWTAuthMiddleware(BaseMiddleware):
             auth_header = headers[b"authorization"].decode("utf-8")
             token = auth_header
 
-        # Также проверяем подпротоколы (на случай если фронт использует их)
+        # Также проверяем подпротоколы (на случай если фронт использует их).
+        # Имена протоколов кадров (см. chatbot.protocol) токеном не считаются
         subprotocols = scope.get("subprotocols", [])
         for proto in subprotocols:
+            if proto in SUBPROTOCOLS:
+                continue
             token = proto
             break
 
         if token:
             scope["user"] = await self.get_user_from_token(token)
         else:
-            scope["user"] = await self.get_anonymous_user()
+            scope["user"] = self.get_anonymous_user()
 
         return await super().__call__(scope, receive, send)
 
-    @database_sync_to_async
-    def get_user_from_token(self, token_str):
-        """Аутентификация пользователя по JWT токену."""
-        try:
-            # Убираем 'Bearer ' если есть
-            # if token_str.startswith('Bearer '):
-            #     token_str = token_str[7:]
+    async def get_user_from_token(self, token_str):
+        """
+        Аутентификация пользователя по JWT токену.
 
-            # Импорты ВНУТРИ функции чтобы избежать AppRegistryNotReady
-            from django.contrib.auth import get_user_model
-            from rest_framework_simplejwt.tokens import AccessToken
+        Подпись и срок действия проверяются прямо в event loop, пользователь
+        берется из TokenUserCache. В БД (через поток) идем только при промахе.
+        """
+        # Импорты ВНУТРИ функции чтобы избежать AppRegistryNotReady
+        from rest_framework_simplejwt.exceptions import TokenError
+        from rest_framework_simplejwt.settings import api_settings
+        from rest_framework_simplejwt.tokens import AccessToken
 
+        from chatbot.auth_cache import TokenUserCache, load_user
+
+        try:
             access_token = AccessToken(token_str)
-            User = get_user_model()
-            user = User.objects.get(id=access_token["user_id"])
-            return user
-        except Exception as e:
+            user_id = access_token[api_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
             return self.get_anonymous_user()
 
+        use_cache = TokenUserCache.is_enabled()
+        if use_cache:
+            jti = access_token[api_settings.JTI_CLAIM]
+            fields, revoked = await TokenUserCache.get(token_str, jti)
+            if revoked:
+                return self.get_anonymous_user()
+            if fields is not None:
+                return load_user(fields)
+
+        user = await self.fetch_user(user_id)
+        if user is None or not user.is_active:
+            return self.get_anonymous_user()
+        if use_cache:
+            await TokenUserCache.set(token_str, user, access_token["exp"])
+        return user
+
     @database_sync_to_async
+    def fetch_user(self, user_id):
+        """Загружает пользователя из БД."""
+        from django.contrib.auth import get_user_model
+        from rest_framework_simplejwt.settings import api_settings
+
+        User = get_user_model()
+        try:
+            return User.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            return None
+
     def get_anonymous_user(self):
         """Получение анонимного пользователя."""
         from django.contrib.auth.models import AnonymousUser
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.27 on 2026-10-17 00:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chatbot", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="is_draft",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.27 on 2026-10-17 00:18
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def backfill_chat_activity(apps, schema_editor):
+    """Заполняет счетчики активности по уже существующим сообщениям."""
+    Chat = apps.get_model("chatbot", "Chat")
+    Message = apps.get_model("chatbot", "Message")
+
+    messages = Message.objects.filter(chat=OuterRef("pk"))
+    last_message = messages.order_by("-created_at")
+    Chat.objects.update(
+        message_count=Coalesce(
+            Subquery(
+                messages.values("chat").annotate(count=Count("id")).values("count")
+            ),
+            0,
+        ),
+        last_message_at=Coalesce(
+            Subquery(last_message.values("created_at")[:1]), F("created_at")
+        ),
+        # Превью ограничено длиной колонки
+        last_message_preview=Coalesce(
+            Substr(Subquery(last_message.values("content")[:1]), 1, 255), Value("")
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chatbot", "0002_message_is_draft"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="last_message_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="last_message_preview",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_chat_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="chat",
+            index=models.Index(
+                fields=["owner", "deleted", "is_pinned", "last_message_at"],
+                name="chat_sidebar_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-17 00:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chatbot", "0003_chat_activity"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["chat", "created_at", "id"], name="message_chat_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.27 on 2026-10-17 00:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chatbot", "0004_message_keyset_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="thinking",
+            field=models.TextField(blank=True, default=""),
+        ),
+    ]
@@ -4,6 +4,7 @@ import uuid
 
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
 
 
 class Chat(models.Model):
@@ -18,6 +19,10 @@ class Chat(models.Model):
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized activity, maintained by chatbot.writes on every message insert
+    last_message_at = models.DateTimeField(default=timezone.now)
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=255, blank=True, default="")
 
     class Meta:
         """Метаданные модели."""
@@ -29,6 +34,13 @@ class Chat(models.Model):
                 fields=["owner", "name"], name="unique_chat_per_user"
             )
         ]
+        indexes = [
+            # Sidebar: chats of the owner, pinned first, by recent activity
+            models.Index(
+                fields=["owner", "deleted", "is_pinned", "last_message_at"],
+                name="chat_sidebar_idx",
+            )
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.owner})"
@@ -54,6 +66,10 @@ class Message(models.Model):
     is_edited = models.BooleanField(default=False)
     # Soft delete for messages (e.g., "deleted for me")
     deleted_for_owner = models.BooleanField(default=False)
+    # AI response that is still being generated (checkpointed partial content)
+    is_draft = models.BooleanField(default=False)
+    # Model reasoning (<think> block), kept apart from the answer in content
+    thinking = models.TextField(blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -63,6 +79,13 @@ class Message(models.Model):
         verbose_name = "Сообщение"
         verbose_name_plural = "Сообщения"
         ordering = ("created_at",)
+        indexes = [
+            # Keyset pagination of chat history on (created_at, id)
+            models.Index(
+                fields=["chat", "created_at", "id"],
+                name="message_chat_created_idx",
+            )
+        ]
 
     def __str__(self):
         sender_name = self.sender.username if self.sender else "System"
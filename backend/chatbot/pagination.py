@@ -0,0 +1,123 @@
+"""Пагинация истории сообщений чата."""
+
+import uuid
+from base64 import b64decode, b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from typing import Optional, Tuple
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset-пагинация сообщений по (created_at, id) в обе стороны.
+
+    Без курсора возвращается последняя страница чата. ?before=<cursor>
+    листает к более старым сообщениям, ?after=<cursor> - к более новым.
+    Сообщения на странице всегда идут по возрастанию created_at. Ссылка
+    previous ведет к более старым сообщениям, next - к более новым.
+    Стоимость запроса не зависит от глубины: ни OFFSET, ни COUNT(*),
+    только диапазон по индексу Message(chat, created_at, id).
+    """
+
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = "page_size"
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor"
+
+    @staticmethod
+    def encode_cursor(message) -> str:
+        raw = f"{message.created_at.isoformat()}|{message.id}"
+        return b64encode(raw.encode("ascii")).decode("ascii")
+
+    def decode_cursor(self, cursor: str) -> Tuple[datetime, uuid.UUID]:
+        try:
+            created_at, _, message_id = b64decode(cursor).decode("ascii").partition("|")
+            return datetime.fromisoformat(created_at), uuid.UUID(message_id)
+        except (BinasciiError, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_page_size(self, request) -> int:
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+
+        if after:
+            created_at, message_id = self.decode_cursor(after)
+            # Лишнее условие по created_at дает планировщику диапазон по индексу
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at)
+                | Q(created_at=created_at, id__gt=message_id),
+                created_at__gte=created_at,
+            ).order_by("created_at", "id")
+            page = list(queryset[: page_size + 1])
+            self.has_newer = len(page) > page_size
+            self.has_older = True
+            page = page[:page_size]
+        else:
+            if before:
+                created_at, message_id = self.decode_cursor(before)
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at)
+                    | Q(created_at=created_at, id__lt=message_id),
+                    created_at__lte=created_at,
+                )
+            queryset = queryset.order_by("-created_at", "-id")
+            page = list(queryset[: page_size + 1])
+            self.has_older = len(page) > page_size
+            self.has_newer = bool(before)
+            page = page[:page_size][::-1]
+
+        self.page = page
+        return page
+
+    def _link(self, param: str, cursor_from) -> Optional[str]:
+        url = remove_query_param(self.base_url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, self.encode_cursor(cursor_from))
+
+    def get_previous_link(self) -> Optional[str]:
+        if not self.page or not self.has_older:
+            return None
+        return self._link(self.before_query_param, self.page[0])
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.page or not self.has_newer:
+            return None
+        return self._link(self.after_query_param, self.page[-1])
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+                "results": data,
+            }
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
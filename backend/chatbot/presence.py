@@ -0,0 +1,102 @@
+"""Присутствие подписчиков чатов поверх Redis."""
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from django.conf import settings
+
+from chatbot.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_KEY = "chatbot:presence:{chat_id}"
+
+
+def _presence_ttl() -> float:
+    return getattr(settings, "WS_PRESENCE_TTL", 30)
+
+
+class ChatPresence:
+    """
+    Подключения к чату на всех воркерах.
+
+    Sorted set на чат: член - имя канала соединения, score - момент, до
+    которого соединение считается живым. Консьюмер продлевает его
+    heartbeat-ом раз в треть WS_PRESENCE_TTL, поэтому соединения упавшего
+    воркера сами перестают учитываться.
+    """
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, "WS_PRESENCE_ENABLED", True)
+
+    @staticmethod
+    async def join(chat_id: str, channel_name: str):
+        """Отмечает соединение живым еще на WS_PRESENCE_TTL секунд."""
+        key = PRESENCE_KEY.format(chat_id=chat_id)
+        ttl = _presence_ttl()
+        now = time.time()
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {channel_name: now + ttl})
+            # Заодно вычищаем соединения, не приславшие heartbeat
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.expire(key, int(ttl) + 1)
+            await pipe.execute()
+
+    @staticmethod
+    async def leave(chat_id: str, channel_name: str):
+        await get_redis().zrem(PRESENCE_KEY.format(chat_id=chat_id), channel_name)
+
+    @staticmethod
+    async def count(chat_id: str) -> int:
+        """Число живых соединений чата."""
+        return await get_redis().zcount(
+            PRESENCE_KEY.format(chat_id=chat_id), f"({time.time()}", "+inf"
+        )
+
+    @classmethod
+    async def heartbeat(cls, chat_id: str, channel_name: str):
+        """Продлевает присутствие соединения, пока задачу не отменят."""
+        interval = _presence_ttl() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await cls.join(chat_id, channel_name)
+            except Exception as e:
+                logger.error(f"Failed to renew presence in chat {chat_id}: {e}")
+
+
+class PresenceWatcher:
+    """
+    Отвечает генератору, есть ли у чата подписчики.
+
+    Найденные подписчики запоминаются на AI_PRESENCE_CHECK_INTERVAL секунд,
+    чтобы проверка не стоила запроса на каждый чанк: лишняя рассылка ушедшему
+    клиенту безвредна. Отсутствие подписчиков не запоминается - иначе чанки
+    клиента, подключившегося внутри интервала, попадали бы только в стрим,
+    который он уже прочитал. При выключенном присутствии или ошибке Redis
+    подписчики считаются присутствующими.
+    """
+
+    def __init__(self, chat_id: str, interval: Optional[float] = None):
+        if interval is None:
+            interval = getattr(settings, "AI_PRESENCE_CHECK_INTERVAL", 1.0)
+        self.chat_id = chat_id
+        self.interval = interval
+        self._checked_at: Optional[float] = None
+
+    async def has_listeners(self) -> bool:
+        if not ChatPresence.is_enabled():
+            return True
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.interval:
+            return True
+        try:
+            present = await ChatPresence.count(self.chat_id) > 0
+        except Exception as e:
+            logger.error(f"Failed to check presence in chat {self.chat_id}: {e}")
+            present = True
+        self._checked_at = now if present else None
+        return present
@@ -0,0 +1,94 @@
+"""Протоколы кадров веб-сокета чата: JSON по умолчанию и бинарный msgpack."""
+
+import json
+from typing import Any, Dict, Iterable, Optional
+
+import msgpack
+
+# Подпротокол бинарного формата; клиент передает его вместе с токеном
+MSGPACK_SUBPROTOCOL = "chatbot.msgpack.v1"
+
+# Имена протоколов, которые middleware не должен принимать за JWT токен
+SUBPROTOCOLS = (MSGPACK_SUBPROTOCOL,)
+
+# Коды событий бинарного протокола. Коды не переиспользуются: новые события
+# получают следующий свободный номер
+EVENT_CODES = {
+    "connection_established": 1,
+    "user_message": 2,
+    "ai_chunk": 3,
+    "ai_complete": 4,
+    "queue_position": 5,
+    "error": 6,
+    "broadcast": 7,
+    "ai_thinking": 8,
+}
+EVENT_TYPES = {code: event_type for event_type, code in EVENT_CODES.items()}
+
+
+class ProtocolError(ValueError):
+    """Кадр клиента не разбирается в формате протокола."""
+
+
+class JsonProtocol:
+    """Текстовые JSON-кадры вида {"type": ..., ...}."""
+
+    name: Optional[str] = None
+
+    def encode(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        """Аргументы для AsyncWebsocketConsumer.send."""
+        return {"text_data": json.dumps(event)}
+
+    def decode(
+        self, text_data: Optional[str] = None, bytes_data: Optional[bytes] = None
+    ) -> Dict[str, Any]:
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except (TypeError, ValueError) as e:
+            raise ProtocolError(str(e))
+        if not isinstance(data, dict):
+            raise ProtocolError("Frame must be an object")
+        return data
+
+
+class MsgpackProtocol(JsonProtocol):
+    """
+    Бинарные кадры msgpack: [код события, поля события].
+
+    Тип события передается целым кодом из EVENT_CODES, поля со значением
+    None опускаются. Входящие бинарные кадры - msgpack-словари с теми же
+    полями, что и в JSON; текстовые кадры по-прежнему разбираются как JSON.
+    """
+
+    name = MSGPACK_SUBPROTOCOL
+
+    def encode(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        fields = {k: v for k, v in event.items() if k != "type" and v is not None}
+        frame = [EVENT_CODES[event["type"]], fields]
+        return {"bytes_data": msgpack.packb(frame)}
+
+    def decode(
+        self, text_data: Optional[str] = None, bytes_data: Optional[bytes] = None
+    ) -> Dict[str, Any]:
+        if bytes_data is None:
+            return super().decode(text_data)
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except (TypeError, ValueError, msgpack.UnpackException) as e:
+            raise ProtocolError(str(e))
+        if not isinstance(data, dict):
+            raise ProtocolError("Frame must be a map")
+        return data
+
+    @staticmethod
+    def unpack_event(frame: bytes) -> Dict[str, Any]:
+        """Разбирает исходящий кадр обратно в событие (для тестов и клиентов)."""
+        code, fields = msgpack.unpackb(frame)
+        return {"type": EVENT_TYPES[code], **fields}
+
+
+def negotiate(subprotocols: Iterable[str]) -> JsonProtocol:
+    """Выбирает протокол по списку подпротоколов клиента."""
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return MsgpackProtocol()
+    return JsonProtocol()
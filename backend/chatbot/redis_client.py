@@ -0,0 +1,43 @@
+"""Подключение чат-бота к Redis, общему для всех воркеров."""
+
+import asyncio
+from typing import Dict, Optional
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+# Клиенты Redis: по одному на каждый event loop процесса
+_REDIS_CLIENTS: Dict[asyncio.AbstractEventLoop, aioredis.Redis] = {}
+
+# Синхронный клиент для кода вне event loop (сигналы, views, management-команды)
+_SYNC_CLIENT: Optional[redis.Redis] = None
+
+
+def _redis_url() -> str:
+    return getattr(settings, "CHATBOT_REDIS_URL", "redis://redis:6379/0")
+
+
+def get_redis() -> aioredis.Redis:
+    """Возвращает асинхронный клиент Redis для текущего event loop."""
+    loop = asyncio.get_running_loop()
+    client = _REDIS_CLIENTS.get(loop)
+    if client is None:
+        client = aioredis.Redis.from_url(_redis_url(), decode_responses=True)
+        _REDIS_CLIENTS[loop] = client
+    return client
+
+
+async def close_redis():
+    """Закрывает клиент Redis, принадлежащий текущему event loop."""
+    client = _REDIS_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def get_sync_redis() -> redis.Redis:
+    """Возвращает синхронный клиент Redis с общим пулом соединений."""
+    global _SYNC_CLIENT
+    if _SYNC_CLIENT is None:
+        _SYNC_CLIENT = redis.Redis.from_url(_redis_url(), decode_responses=True)
+    return _SYNC_CLIENT
@@ -0,0 +1,314 @@
+"""Распределенный реестр AI генераций поверх Redis."""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Dict, Optional
+
+from django.conf import settings
+
+from chatbot.redis_client import get_redis
+from chatbot.streams import STREAM_KEY
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор процесса-воркера, который держит аренду
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+LEASE_KEY = "chatbot:generation:{chat_id}"
+CANCEL_CHANNEL = "chatbot:generation:cancel"
+# Отмена, запрошенная для аренды: ее видит задача Celery, которая ждала в
+# брокере и еще не слушала CANCEL_CHANNEL
+CANCEL_FLAG_KEY = "chatbot:generation:cancelled:{token}"
+
+# Взять аренду и вместе с ней очистить стрим воспроизведения прошлой
+# генерации: переподключившийся клиент не получит старый ответ, пока новая
+# генерация ждет в очереди допуска
+_ACQUIRE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    redis.call('del', KEYS[2])
+    return 1
+end
+return 0
+"""
+
+# Продлить аренду, только если ей все еще владеет этот воркер
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Снять аренду, только если ей все еще владеет этот воркер
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _lease_ttl_ms() -> int:
+    return int(getattr(settings, "AI_GENERATION_LEASE_TTL", 30) * 1000)
+
+
+class GenerationBusyError(Exception):
+    """Для чата уже идет генерация, аренду взять не удалось."""
+
+
+class CancelToken:
+    """
+    Токен кооперативной отмены генерации.
+
+    Отмена помечает токен временем запроса и прерывает привязанную задачу
+    стриминга, чтобы та закрыла HTTP-ответ Ollama и освободила слот модели.
+    """
+
+    def __init__(self):
+        self.cancelled_at: Optional[float] = None
+        self.reason: Optional[str] = None  # "shutdown" - прервана остановкой процесса
+        self._task: Optional[asyncio.Future] = None
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancelled_at is not None
+
+    def bind(self, task: asyncio.Future):
+        """Привязывает задачу, которую нужно прервать при отмене."""
+        self._task = task
+        if self.is_cancelled:
+            self._interrupt()
+
+    def cancel(self, reason: Optional[str] = None) -> bool:
+        """Запрашивает отмену. Возвращает False, если она уже запрошена."""
+        if self.is_cancelled:
+            return False
+        self.cancelled_at = time.monotonic()
+        self.reason = reason
+        self._interrupt()
+        return True
+
+    def _interrupt(self):
+        task = self._task
+        if task is not None and not task.done():
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+
+class GenerationLease:
+    """Аренда генерации для одного чата, продлеваемая heartbeat-ом"""
+
+    def __init__(self, chat_id: str, token: str):
+        self.chat_id = chat_id
+        self.token = token
+        self.key = LEASE_KEY.format(chat_id=chat_id)
+        self.cancel_token: Optional[CancelToken] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def start(self, cancel_token: CancelToken):
+        """Регистрирует токен отмены на этом воркере и запускает heartbeat."""
+        self.cancel_token = cancel_token
+        GenerationRegistry._register_local(self.chat_id, cancel_token)
+        self._heartbeat = asyncio.ensure_future(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        interval = _lease_ttl_ms() / 3000
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                renewed = await get_redis().eval(
+                    _RENEW_SCRIPT, 1, self.key, self.token, _lease_ttl_ms()
+                )
+                if not renewed:
+                    # Чат может занять другой воркер: останавливаемся, чтобы
+                    # не вести две генерации, частичный ответ сохранится
+                    logger.warning(f"Generation lease lost for chat {self.chat_id}")
+                    if self.cancel_token is not None:
+                        self.cancel_token.cancel("lease_lost")
+                    return
+            except Exception as e:
+                logger.error(f"Failed to renew generation lease: {e}")
+
+    async def cancel_requested(self) -> bool:
+        """Проверяет, запросили ли отмену, пока аренда ждала генерацию."""
+        try:
+            return bool(
+                await get_redis().exists(CANCEL_FLAG_KEY.format(token=self.token))
+            )
+        except Exception as e:
+            logger.error(f"Failed to check cancel flag for chat {self.chat_id}: {e}")
+            return False
+
+    async def hand_off(self, ttl: float) -> bool:
+        """
+        Продлевает аренду на ttl секунд перед передачей в другой процесс.
+
+        Так чат остается занятым, пока генерация ждет воркера Celery,
+        который подхватит аренду через GenerationRegistry.adopt.
+        """
+        return bool(
+            await get_redis().eval(
+                _RENEW_SCRIPT, 1, self.key, self.token, int(ttl * 1000)
+            )
+        )
+
+    async def release(self):
+        """Останавливает heartbeat и снимает аренду в Redis."""
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+        GenerationRegistry._unregister_local(self.chat_id, self.cancel_token)
+
+        try:
+            await get_redis().eval(_RELEASE_SCRIPT, 1, self.key, self.token)
+        except Exception as e:
+            logger.error(f"Failed to release generation lease: {e}")
+
+
+class GenerationRegistry:
+    """
+    Реестр активных генераций, общий для всех воркеров.
+
+    Каждая генерация держит в Redis аренду с TTL, которую продлевает
+    heartbeat. Если воркер падает, аренда истекает сама. Отмена рассылается
+    через pub/sub канал и доходит до воркера, который ведет генерацию.
+    """
+
+    _local_tokens: Dict[str, CancelToken] = {}  # chat_id -> токен отмены
+    _listeners: Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+
+    @classmethod
+    async def acquire(cls, chat_id: str) -> Optional[GenerationLease]:
+        """
+        Атомарно берет аренду на генерацию. None - генерация уже идет.
+
+        Тем же скриптом удаляется стрим воспроизведения чата: с момента
+        взятия аренды дочитывание отдает только события новой генерации.
+        """
+        token = f"{WORKER_ID}:{uuid.uuid4().hex}"
+        acquired = await get_redis().eval(
+            _ACQUIRE_SCRIPT,
+            2,
+            LEASE_KEY.format(chat_id=chat_id),
+            STREAM_KEY.format(chat_id=chat_id),
+            token,
+            _lease_ttl_ms(),
+        )
+        if not acquired:
+            return None
+
+        cls._ensure_listener()
+        return GenerationLease(chat_id, token)
+
+    @classmethod
+    async def adopt(cls, chat_id: str, token: str) -> Optional[GenerationLease]:
+        """
+        Подхватывает аренду, взятую другим процессом, по ее токену.
+
+        None - аренда уже истекла или принадлежит другой генерации.
+        """
+        renewed = await get_redis().eval(
+            _RENEW_SCRIPT, 1, LEASE_KEY.format(chat_id=chat_id), token, _lease_ttl_ms()
+        )
+        if not renewed:
+            return None
+
+        cls._ensure_listener()
+        return GenerationLease(chat_id, token)
+
+    @classmethod
+    async def is_generating(cls, chat_id: str) -> bool:
+        """Проверяет, идет ли генерация для чата на любом воркере."""
+        return bool(await get_redis().exists(LEASE_KEY.format(chat_id=chat_id)))
+
+    @classmethod
+    async def get_owner(cls, chat_id: str) -> Optional[str]:
+        """Возвращает идентификатор воркера, который ведет генерацию."""
+        token = await get_redis().get(LEASE_KEY.format(chat_id=chat_id))
+        if token is None:
+            return None
+        return token.rsplit(":", 1)[0]
+
+    @classmethod
+    async def cancel(cls, chat_id: str):
+        """Отменяет генерацию чата, где бы она ни выполнялась."""
+        cls._cancel_local(chat_id)
+        redis = get_redis()
+        token = await redis.get(LEASE_KEY.format(chat_id=chat_id))
+        if token is not None:
+            # Флаг живет не дольше аренды задачи, ждущей воркера Celery
+            await redis.set(
+                CANCEL_FLAG_KEY.format(token=token),
+                1,
+                ex=getattr(settings, "AI_GENERATION_QUEUE_LEASE_TTL", 300),
+            )
+        await redis.publish(CANCEL_CHANNEL, chat_id)
+
+    # --- Локальное состояние воркера ---
+
+    @classmethod
+    def _register_local(cls, chat_id: str, token: CancelToken):
+        cls._local_tokens[chat_id] = token
+
+    @classmethod
+    def _unregister_local(cls, chat_id: str, token: Optional[CancelToken]):
+        if token is not None and cls._local_tokens.get(chat_id) is token:
+            cls._local_tokens.pop(chat_id, None)
+
+    @classmethod
+    def _cancel_local(cls, chat_id: str) -> bool:
+        token = cls._local_tokens.get(chat_id)
+        if token is None or not token.cancel():
+            return False
+        logger.info(f"Cancel requested for chat {chat_id} on {WORKER_ID}")
+        return True
+
+    @classmethod
+    def interrupt_local(cls, reason: str) -> int:
+        """Прерывает все генерации этого воркера. Возвращает их число."""
+        interrupted = 0
+        for chat_id, token in list(cls._local_tokens.items()):
+            if token.cancel(reason):
+                logger.info(f"Generation for chat {chat_id} interrupted: {reason}")
+                interrupted += 1
+        return interrupted
+
+    @classmethod
+    def _ensure_listener(cls):
+        loop = asyncio.get_running_loop()
+        listener = cls._listeners.get(loop)
+        if listener is None or listener.done():
+            cls._listeners[loop] = loop.create_task(cls._listen())
+
+    @classmethod
+    async def _listen(cls):
+        """Слушает канал отмены и отменяет генерации этого воркера."""
+        while True:
+            pubsub = get_redis().pubsub()
+            try:
+                await pubsub.subscribe(CANCEL_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        cls._cancel_local(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Generation cancel listener failed: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    @classmethod
+    async def stop_listener(cls):
+        """Останавливает слушатель отмен текущего event loop."""
+        listener = cls._listeners.pop(asyncio.get_running_loop(), None)
+        if listener is not None:
+            listener.cancel()
+            try:
+                await listener
+            except asyncio.CancelledError:
+                pass
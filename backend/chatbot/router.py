@@ -0,0 +1,303 @@
+"""Маршрутизация генераций между несколькими серверами Ollama."""
+
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Collection, Dict, Optional, Set, Tuple
+
+import aiohttp
+from django.conf import settings
+
+from chatbot.metrics import (
+    OLLAMA_BACKEND_IN_FLIGHT,
+    OLLAMA_BACKEND_TOKENS_PER_SECOND,
+    OLLAMA_BACKEND_UP,
+)
+
+logger = logging.getLogger(__name__)
+
+# Вес последнего замера в скользящей средней скорости генерации
+THROUGHPUT_EWMA_ALPHA = 0.3
+
+
+class NoBackendAvailable(Exception):
+    """Нет исправного сервера Ollama с нужной моделью."""
+
+
+def get_backend_urls() -> Tuple[str, ...]:
+    """
+    Базовые URL серверов Ollama из настроек.
+
+    Если OLLAMA_BACKENDS не задан, пул состоит из единственного сервера,
+    вычисленного из OLLAMA_API_URL.
+    """
+    urls = getattr(settings, "OLLAMA_BACKENDS", None)
+    if not urls:
+        api_url = getattr(
+            settings, "OLLAMA_API_URL", "http://ollama:11434/api/generate"
+        )
+        urls = [api_url.rsplit("/api/", 1)[0]]
+    return tuple(url.rstrip("/") for url in urls)
+
+
+def normalize_model_name(name: str) -> str:
+    """
+    Имя модели в виде, в котором его отдает /api/tags.
+
+    Ollama дописывает тег latest к имени без тега: модель "llama3" в
+    списке сервера называется "llama3:latest".
+    """
+    if ":" not in name.rsplit("/", 1)[-1]:
+        return f"{name}:latest"
+    return name
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Ошибки, которые говорят о неисправности сервера, а не о запросе."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class OllamaBackend:
+    """Сервер Ollama в пуле: нагрузка, скорость и состояние автомата отключения"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.tokens_per_sec: Optional[float] = None
+        self.models: Optional[Set[str]] = None
+        self.models_checked_at: Optional[float] = None
+        self.failures = 0
+        self.opened_at: Optional[float] = None  # Время размыкания автомата
+        self._probe: Optional[asyncio.Future] = None
+
+    @property
+    def generate_url(self) -> str:
+        return f"{self.url}/api/generate"
+
+    @property
+    def tags_url(self) -> str:
+        return f"{self.url}/api/tags"
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def record_success(self, final: Optional[Dict[str, Any]] = None):
+        """Замыкает автомат и обновляет скорость по итогам генерации."""
+        self.failures = 0
+        if self.opened_at is not None:
+            logger.info(f"Ollama backend {self.url} is back online")
+            self.opened_at = None
+        OLLAMA_BACKEND_UP.labels(backend=self.url).set(1)
+
+        # eval_duration приходит в наносекундах
+        eval_count = (final or {}).get("eval_count")
+        eval_duration = (final or {}).get("eval_duration")
+        if eval_count and eval_duration:
+            rate = eval_count / (eval_duration / 1e9)
+            if self.tokens_per_sec is None:
+                self.tokens_per_sec = rate
+            else:
+                self.tokens_per_sec += THROUGHPUT_EWMA_ALPHA * (
+                    rate - self.tokens_per_sec
+                )
+            OLLAMA_BACKEND_TOKENS_PER_SECOND.labels(backend=self.url).set(
+                self.tokens_per_sec
+            )
+
+    def record_failure(self, threshold: int):
+        """Считает ошибку и размыкает автомат, если их набралось threshold подряд."""
+        self.failures += 1
+        if self.failures >= threshold or self.is_open:
+            if not self.is_open:
+                logger.warning(
+                    f"Ollama backend {self.url} disabled after "
+                    f"{self.failures} consecutive failures"
+                )
+            self.opened_at = time.monotonic()
+            OLLAMA_BACKEND_UP.labels(backend=self.url).set(0)
+
+
+class OllamaRouter:
+    """
+    Распределяет генерации по пулу серверов Ollama.
+
+    Каждая генерация уходит на наименее загруженный исправный сервер, где
+    есть нужная модель: in-flight запросы делятся на наблюдаемую скорость
+    сервера в токенах в секунду. Сервер, подряд отвечающий ошибками,
+    отключается автоматом (circuit breaker) и через OLLAMA_CIRCUIT_RESET_TIMEOUT
+    секунд проверяется запросом к /api/tags. Тот же запрос раз в
+    OLLAMA_MODELS_REFRESH_INTERVAL секунд обновляет список моделей сервера;
+    обе проверки идут в фоне и не задерживают генерацию.
+
+    Роутер один на процесс (shared): генерации в пуле потоков и на воркерах
+    Celery идут в своих event loop, но видят одни и те же автоматы
+    отключения и замеры скорости серверов.
+    """
+
+    _shared: Optional["OllamaRouter"] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        urls: Collection[str],
+        failure_threshold: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+        models_refresh_interval: Optional[float] = None,
+    ):
+        if failure_threshold is None:
+            failure_threshold = getattr(settings, "OLLAMA_CIRCUIT_FAILURE_THRESHOLD", 3)
+        if reset_timeout is None:
+            reset_timeout = getattr(settings, "OLLAMA_CIRCUIT_RESET_TIMEOUT", 30)
+        if models_refresh_interval is None:
+            models_refresh_interval = getattr(
+                settings, "OLLAMA_MODELS_REFRESH_INTERVAL", 30
+            )
+
+        self.urls = tuple(urls)
+        self.backends = [OllamaBackend(url) for url in self.urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.models_refresh_interval = models_refresh_interval
+
+    @classmethod
+    def shared(cls) -> "OllamaRouter":
+        """Возвращает роутер процесса для пула из настроек."""
+        urls = get_backend_urls()
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared.urls != urls:
+                cls._shared = cls(urls)
+            return cls._shared
+
+    def _needs_probe(self, backend: OllamaBackend, now: float) -> bool:
+        if backend.is_open:
+            return now - backend.opened_at >= self.reset_timeout
+        return (
+            backend.models_checked_at is None
+            or now - backend.models_checked_at >= self.models_refresh_interval
+        )
+
+    def _start_probe(self, backend: OllamaBackend) -> asyncio.Future:
+        """Запускает проверку сервера, если она еще не идет в этом event loop."""
+        # Параллельные генерации ждут одну и ту же проверку. Проверку,
+        # начатую в другом event loop, из этого не дождаться
+        probe = backend._probe
+        if (
+            probe is None
+            or probe.done()
+            or probe.get_loop() is not asyncio.get_running_loop()
+        ):
+            probe = backend._probe = asyncio.ensure_future(self._fetch_models(backend))
+        return probe
+
+    async def probe(self, backend: OllamaBackend):
+        """Проверяет сервер и обновляет его список моделей."""
+        await asyncio.shield(self._start_probe(backend))
+
+    async def _fetch_models(self, backend: OllamaBackend):
+        from chatbot.generation import get_ollama_session
+
+        timeout = aiohttp.ClientTimeout(
+            total=getattr(settings, "OLLAMA_HEALTH_CHECK_TIMEOUT", 5)
+        )
+        try:
+            async with get_ollama_session().get(
+                backend.tags_url, timeout=timeout
+            ) as resp:
+                resp.raise_for_status()
+                data = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"Health check failed for Ollama backend {backend.url}: {e}")
+            backend.record_failure(self.failure_threshold)
+            return
+
+        backend.models = {
+            normalize_model_name(m["name"])
+            for m in data.get("models", [])
+            if m.get("name")
+        }
+        backend.models_checked_at = time.monotonic()
+        backend.record_success()
+
+    @staticmethod
+    def _candidates(backends, name: str):
+        return [
+            b
+            for b in backends
+            if not b.is_open and b.models is not None and name in b.models
+        ]
+
+    def _score(self, backend: OllamaBackend, default_rate: float) -> float:
+        """Оценка времени, за которое сервер разберет свою очередь."""
+        return (backend.in_flight + 1) / (backend.tokens_per_sec or default_rate)
+
+    async def select(
+        self, model: str, exclude: Collection[OllamaBackend] = ()
+    ) -> OllamaBackend:
+        """
+        Выбирает наименее загруженный исправный сервер с моделью.
+
+        Генерация ждет /api/tags только для сервера, чей список моделей еще
+        ни разу не загружался. Устаревшие списки и проверки отключенных
+        серверов обновляются в фоне, а выбор идет по тому, что уже известно;
+        их дожидаемся, только если подходящих серверов не нашлось.
+        """
+        now = time.monotonic()
+        backends = [b for b in self.backends if b not in exclude]
+        name = normalize_model_name(model)
+
+        first_checks = []
+        for backend in backends:
+            if not self._needs_probe(backend, now):
+                continue
+            if backend.models is None and not backend.is_open:
+                first_checks.append(self.probe(backend))
+            else:
+                self._start_probe(backend)
+        if first_checks:
+            await asyncio.gather(*first_checks)
+
+        candidates = self._candidates(backends, name)
+        if not candidates:
+            loop = asyncio.get_running_loop()
+            running = [
+                b._probe
+                for b in backends
+                if b._probe is not None
+                and not b._probe.done()
+                and b._probe.get_loop() is loop
+            ]
+            if running:
+                await asyncio.gather(*(asyncio.shield(p) for p in running))
+                candidates = self._candidates(backends, name)
+        if not candidates:
+            raise NoBackendAvailable(f"No healthy Ollama backend serves model {model}")
+
+        # Для серверов без замеров скорости берем среднюю по пулу
+        rates = [b.tokens_per_sec for b in candidates if b.tokens_per_sec]
+        default_rate = sum(rates) / len(rates) if rates else 1.0
+        return min(
+            candidates, key=lambda b: (self._score(b, default_rate), b.in_flight)
+        )
+
+    @asynccontextmanager
+    async def dispatch(
+        self, model: str, exclude: Collection[OllamaBackend] = ()
+    ) -> AsyncIterator[OllamaBackend]:
+        """Занимает сервер на время генерации и учитывает ее ошибки."""
+        backend = await self.select(model, exclude)
+        backend.in_flight += 1
+        OLLAMA_BACKEND_IN_FLIGHT.labels(backend=backend.url).inc()
+        try:
+            yield backend
+        except BaseException as e:
+            if is_backend_failure(e):
+                backend.record_failure(self.failure_threshold)
+            raise
+        finally:
+            backend.in_flight -= 1
+            OLLAMA_BACKEND_IN_FLIGHT.labels(backend=backend.url).dec()
@@ -0,0 +1,364 @@
+"""Справедливая очередь допуска AI генераций."""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterator, Optional, Set
+
+from django.conf import settings
+
+from chatbot.metrics import (
+    GENERATION_ACTIVE,
+    GENERATION_CONCURRENCY_LIMIT,
+    GENERATION_QUEUE_DEPTH,
+    GENERATION_QUEUE_WAIT,
+    GENERATION_SATURATION,
+)
+
+logger = logging.getLogger(__name__)
+
+# Лимиты моделей процесса: переживают event loop отдельной генерации
+_MODEL_LIMITS: Dict[str, "AdaptiveConcurrencyLimit"] = {}
+_limits_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Очередь генераций переполнена, запрос нужно повторить позже."""
+
+
+class AdmissionTicket:
+    """Место генерации в очереди допуска"""
+
+    def __init__(self, user_id: str, model: str, chat_id: Optional[str] = None):
+        self.user_id = user_id
+        self.model = model
+        self.chat_id = chat_id
+        self.enqueued_at = time.monotonic()
+        self.admitted = asyncio.get_running_loop().create_future()
+        self.admitted_at: Optional[float] = None
+        self.concurrency = 0  # Сколько генераций модели шло при допуске
+        self.position: Optional[int] = None
+        self.released = False
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Лимит одновременных генераций одной модели, подстраиваемый по AIMD.
+
+    После каждой генерации лимит сравнивает суммарную скорость модели
+    (eval_count / eval_duration одного стрима, умноженные на число
+    параллельных стримов) с лучшей замеченной. Пока рост параллелизма дает
+    прирост, лимит растет на единицу за окно генераций. Когда суммарная
+    скорость падает (пройдена точка насыщения) или стрим становится медленнее
+    AI_MIN_STREAM_TOKENS_PER_SEC, лимит умножается на AI_CONCURRENCY_BACKOFF.
+
+    Лимит общий для процесса (for_model), а число идущих генераций считает
+    планировщик своего event loop: генерации в пуле потоков и на воркерах
+    Celery идут в отдельных loop, но учатся на одной и той же модели.
+    """
+
+    # Допустимая просадка суммарной скорости относительно лучшей
+    TOLERANCE = 0.1
+    # Забывание лучшей скорости, чтобы лимит подстраивался под смену нагрузки
+    BEST_DECAY = 0.01
+
+    def __init__(
+        self,
+        model: str,
+        initial: Optional[float] = None,
+        min_limit: Optional[int] = None,
+        max_limit: Optional[int] = None,
+        backoff: Optional[float] = None,
+        min_stream_rate: Optional[float] = None,
+    ):
+        if initial is None:
+            initial = getattr(settings, "AI_MODEL_CONCURRENCY_INITIAL", 2)
+        if min_limit is None:
+            min_limit = getattr(settings, "AI_MODEL_CONCURRENCY_MIN", 1)
+        if max_limit is None:
+            max_limit = getattr(settings, "AI_MODEL_CONCURRENCY_MAX", 16)
+        if backoff is None:
+            backoff = getattr(settings, "AI_CONCURRENCY_BACKOFF", 0.7)
+        if min_stream_rate is None:
+            min_stream_rate = getattr(settings, "AI_MIN_STREAM_TOKENS_PER_SEC", 5)
+
+        self.model = model
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.min_stream_rate = min_stream_rate
+        self.best_throughput: Optional[float] = None
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+        GENERATION_CONCURRENCY_LIMIT.labels(model=model).set(self.limit)
+
+    @classmethod
+    def for_model(cls, model: str) -> "AdaptiveConcurrencyLimit":
+        """Возвращает лимит модели, общий для всех event loop процесса."""
+        with _limits_lock:
+            limit = _MODEL_LIMITS.get(model)
+            if limit is None:
+                limit = _MODEL_LIMITS[model] = cls(model)
+            return limit
+
+    def on_complete(self, ticket: AdmissionTicket, result: Optional[Dict[str, Any]]):
+        """Учитывает итог генерации, допущенной по этому лимиту."""
+        with self._lock:
+            self._on_complete(ticket, result or {})
+
+    def _on_complete(self, ticket: AdmissionTicket, result: Dict[str, Any]):
+        # Генерации, стартовавшие до прошлого снижения, уже учтены в нем
+        if result.get("cancelled") or (
+            ticket.admitted_at is not None and ticket.admitted_at < self._decreased_at
+        ):
+            return
+        if not result.get("success"):
+            if result.get("message_id") in ("timeout_error", "connection_error"):
+                self._decrease()
+            return
+
+        eval_count = result.get("eval_count")
+        eval_duration = result.get("eval_duration")
+        if not eval_count or not eval_duration:
+            return
+
+        # eval_duration приходит в наносекундах
+        stream_rate = eval_count / (eval_duration / 1e9)
+        throughput = stream_rate * max(ticket.concurrency, 1)
+
+        if self.best_throughput is None:
+            self.best_throughput = throughput
+        if stream_rate < self.min_stream_rate or throughput < self.best_throughput * (
+            1 - self.TOLERANCE
+        ):
+            self._decrease()
+        else:
+            self.best_throughput = max(
+                throughput, self.best_throughput * (1 - self.BEST_DECAY)
+            )
+            self._increase()
+
+    def _increase(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        GENERATION_CONCURRENCY_LIMIT.labels(model=self.model).set(self.limit)
+
+    def _decrease(self):
+        self._decreased_at = time.monotonic()
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        # Лучшая скорость могла быть замерена при другой нагрузке на сервер
+        self.best_throughput = None
+        GENERATION_CONCURRENCY_LIMIT.labels(model=self.model).set(self.limit)
+        logger.info(f"Concurrency limit for {self.model} lowered to {self.limit:.2f}")
+
+
+class GenerationScheduler:
+    """
+    Ограничивает число одновременных генераций и делит очередь между
+    пользователями по кругу (round-robin).
+
+    Помимо общего потолка у каждой модели свой адаптивный лимит
+    (AdaptiveConcurrencyLimit): легкие модели сами разгоняются до большего
+    параллелизма, тяжелые не перегружают сервер.
+
+    Один пользователь не может занять всю очередь: у каждого есть лимит
+    ожидающих генераций, а общая глубина очереди ограничена - сверх нее
+    новые запросы отклоняются. Ожидающим чатам отправляются события
+    queue_position с их текущим местом в очереди.
+    """
+
+    _instances: Dict[asyncio.AbstractEventLoop, "GenerationScheduler"] = {}
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        max_queue_depth: Optional[int] = None,
+        max_queued_per_user: Optional[int] = None,
+        channel_layer=None,
+    ):
+        if max_concurrency is None:
+            max_concurrency = getattr(settings, "AI_MAX_CONCURRENT_GENERATIONS", 3)
+        if max_queue_depth is None:
+            max_queue_depth = getattr(settings, "AI_MAX_QUEUE_DEPTH", 50)
+        if max_queued_per_user is None:
+            max_queued_per_user = getattr(settings, "AI_MAX_QUEUED_PER_USER", 3)
+
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_queued_per_user = max_queued_per_user
+        self.active = 0
+        self._channel_layer = channel_layer
+        # Порядок ключей - порядок обхода пользователей по кругу
+        self._queues: "OrderedDict[str, Deque[AdmissionTicket]]" = OrderedDict()
+        self._queued = 0
+        # Идущие генерации этого планировщика по моделям
+        self._active_by_model: Dict[str, int] = {}
+        self._notifications: Set[asyncio.Future] = set()
+
+    @classmethod
+    def for_loop(cls) -> "GenerationScheduler":
+        """Возвращает планировщик текущего event loop."""
+        loop = asyncio.get_running_loop()
+        scheduler = cls._instances.get(loop)
+        if scheduler is None:
+            scheduler = cls._instances[loop] = cls()
+        return scheduler
+
+    @classmethod
+    def discard_loop(cls):
+        """Забывает планировщик текущего event loop перед его закрытием."""
+        cls._instances.pop(asyncio.get_running_loop(), None)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def limit_for(self, model: str) -> AdaptiveConcurrencyLimit:
+        """Возвращает адаптивный лимит модели."""
+        return AdaptiveConcurrencyLimit.for_model(model)
+
+    def _has_capacity(self, model: str) -> bool:
+        return self._active_by_model.get(model, 0) < int(self.limit_for(model).limit)
+
+    def _report_saturation(self, model: str):
+        GENERATION_SATURATION.labels(model=model).set(
+            self._active_by_model.get(model, 0) / self.limit_for(model).limit
+        )
+
+    def reserve(
+        self,
+        user_id: str,
+        chat_id: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> AdmissionTicket:
+        """Ставит генерацию в очередь или отклоняет ее при переполнении."""
+        user_id = str(user_id)
+        if model is None:
+            model = getattr(settings, "DEFAULT_AI_MODEL", "deepseek-r1:1.5b")
+        user_queue = self._queues.get(user_id)
+        if user_queue is not None and len(user_queue) >= self.max_queued_per_user:
+            raise QueueFullError(f"User {user_id} has too many queued generations")
+        if self._queued >= self.max_queue_depth:
+            raise QueueFullError("Generation queue is full")
+
+        ticket = AdmissionTicket(user_id, model, chat_id)
+        if user_queue is None:
+            user_queue = self._queues[user_id] = deque()
+        user_queue.append(ticket)
+        self._queued += 1
+        GENERATION_QUEUE_DEPTH.set(self._queued)
+
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket: AdmissionTicket):
+        """Дожидается допуска. При отмене ожидания место в очереди освобождается."""
+        try:
+            await asyncio.shield(ticket.admitted)
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+
+    def release(self, ticket: AdmissionTicket, result: Optional[Dict[str, Any]] = None):
+        """Освобождает слот после завершения генерации и учитывает ее итог."""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted.done() and not ticket.admitted.cancelled():
+            self.active -= 1
+            self._active_by_model[ticket.model] -= 1
+            GENERATION_ACTIVE.labels(model=ticket.model).dec()
+            self.limit_for(ticket.model).on_complete(ticket, result)
+            self._report_saturation(ticket.model)
+        else:
+            self._remove(ticket)
+        self._dispatch()
+
+    def cancel(self, ticket: AdmissionTicket):
+        """Убирает генерацию из очереди или освобождает ее слот."""
+        self.release(ticket)
+        if not ticket.admitted.done():
+            ticket.admitted.cancel()
+
+    def _remove(self, ticket: AdmissionTicket):
+        user_queue = self._queues.get(ticket.user_id)
+        if user_queue is None or ticket not in user_queue:
+            return
+        user_queue.remove(ticket)
+        self._queued -= 1
+        GENERATION_QUEUE_DEPTH.set(self._queued)
+        if not user_queue:
+            del self._queues[ticket.user_id]
+
+    def _dispatch(self):
+        """Допускает генерации по кругу, пока есть свободные слоты."""
+        while self.active < self.max_concurrency and self._admit_next():
+            pass
+
+        GENERATION_QUEUE_DEPTH.set(self._queued)
+        self._notify_positions()
+
+    def _admit_next(self) -> bool:
+        """Допускает первую генерацию по кругу, чья модель не упирается в лимит."""
+        for user_id, user_queue in self._queues.items():
+            ticket = next((t for t in user_queue if self._has_capacity(t.model)), None)
+            if ticket is None:
+                continue
+
+            user_queue.remove(ticket)
+            # Пользователь уходит в конец круга
+            del self._queues[user_id]
+            if user_queue:
+                self._queues[user_id] = user_queue
+            self._queued -= 1
+
+            active = self._active_by_model.get(ticket.model, 0) + 1
+            self._active_by_model[ticket.model] = active
+            self.active += 1
+            ticket.concurrency = active
+            ticket.admitted_at = time.monotonic()
+            ticket.admitted.set_result(True)
+            GENERATION_QUEUE_WAIT.labels(model=ticket.model).observe(
+                ticket.admitted_at - ticket.enqueued_at
+            )
+            GENERATION_ACTIVE.labels(model=ticket.model).inc()
+            self._report_saturation(ticket.model)
+            return True
+        return False
+
+    def _iter_waiting(self) -> Iterator[AdmissionTicket]:
+        """Ожидающие генерации в порядке будущего допуска."""
+        queues = list(self._queues.values())
+        depth = max((len(q) for q in queues), default=0)
+        for round_index in range(depth):
+            for user_queue in queues:
+                if round_index < len(user_queue):
+                    yield user_queue[round_index]
+
+    def _notify_positions(self):
+        for position, ticket in enumerate(self._iter_waiting(), start=1):
+            if ticket.position == position or ticket.chat_id is None:
+                continue
+            ticket.position = position
+            notification = asyncio.ensure_future(
+                self._send_position(ticket.chat_id, position)
+            )
+            self._notifications.add(notification)
+            notification.add_done_callback(self._notifications.discard)
+
+    async def _send_position(self, chat_id: str, position: int):
+        channel_layer = self._channel_layer
+        if channel_layer is None:
+            from channels.layers import get_channel_layer
+
+            channel_layer = get_channel_layer()
+
+        try:
+            await channel_layer.group_send(
+                f"chat_{chat_id}",
+                {"type": "queue_position", "chat_id": chat_id, "position": position},
+            )
+        except Exception as e:
+            logger.error(f"Failed to send queue position: {e}")
@@ -1,9 +1,40 @@
 """Сериализаторы для приложения чатбота."""
 
+from django.db.models import F, Prefetch, Window
+from django.db.models.functions import RowNumber
 from rest_framework import serializers
 
 from chatbot.models import Chat, Message
 
+# Сколько последних сообщений чата отдается в списке чатов
+LATEST_MESSAGES_LIMIT = 5
+
+
+def prefetch_latest_messages(queryset, limit: int = LATEST_MESSAGES_LIMIT):
+    """
+    Подгружает последние limit сообщений для всей страницы чатов одним запросом.
+
+    ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY created_at DESC)
+    нумерует сообщения внутри каждого чата, и фильтр по номеру оставляет
+    только последние. Результат кладется в атрибут prefetched_latest_messages.
+    Рассуждения модели (thinking) в список чатов не попадают и не читаются.
+    """
+    messages = (
+        Message.objects.defer("thinking")
+        .annotate(
+            row_number=Window(
+                expression=RowNumber(),
+                partition_by=[F("chat_id")],
+                order_by=[F("created_at").desc(), F("id").desc()],
+            )
+        )
+        .filter(row_number__lte=limit)
+        .order_by("-created_at", "-id")
+    )
+    return queryset.prefetch_related(
+        Prefetch("messages", queryset=messages, to_attr="prefetched_latest_messages")
+    )
+
 
 class StartChatSerializer(serializers.Serializer):
     """Сериализатор для создания нового чата"""
@@ -30,25 +61,64 @@ class MessageSerializer(serializers.ModelSerializer):
         """Метаданные сериализатора."""
 
         model = Message
-        fields = ["id", "content", "sender", "message_type", "is_edited", "created_at"]
+        fields = [
+            "id",
+            "content",
+            "thinking",
+            "sender",
+            "message_type",
+            "is_edited",
+            "is_draft",
+            "created_at",
+        ]
+
+
+class LatestMessageSerializer(MessageSerializer):
+    """Сообщение в списке чатов: без рассуждений модели."""
+
+    class Meta(MessageSerializer.Meta):
+        """Метаданные сериализатора."""
+
+        fields = [f for f in MessageSerializer.Meta.fields if f != "thinking"]
 
 
 class ChatSerializer(serializers.ModelSerializer):
     """Сериализатор для чата."""
 
     # Вложенная информация о последних сообщениях
-    latest_messages = MessageSerializer(
-        source="get_latest_messages", many=True, read_only=True
-    )
+    latest_messages = serializers.SerializerMethodField()
 
     class Meta:
         """Метаданные сериализатора."""
 
         model = Chat
-        fields = ["id", "name", "is_pinned", "created_at", "latest_messages"]
-        read_only_fields = ["id", "name", "owner", "created_at", "latest_messages"]
+        fields = [
+            "id",
+            "name",
+            "is_pinned",
+            "created_at",
+            "last_message_at",
+            "message_count",
+            "last_message_preview",
+            "latest_messages",
+        ]
+        read_only_fields = [
+            "id",
+            "name",
+            "owner",
+            "created_at",
+            "last_message_at",
+            "message_count",
+            "last_message_preview",
+            "latest_messages",
+        ]
 
     def get_latest_messages(self, obj):
-        """Возвращает сообщения."""
-        messages = obj.messages.all().order_by("-created_at")[:5]
-        return messages
+        """Возвращает последние сообщения чата."""
+        messages = getattr(obj, "prefetched_latest_messages", None)
+        if messages is None:
+            # Чат загружен без prefetch_latest_messages
+            messages = obj.messages.defer("thinking").order_by("-created_at", "-id")[
+                :LATEST_MESSAGES_LIMIT
+            ]
+        return LatestMessageSerializer(messages, many=True).data
@@ -0,0 +1,55 @@
+"""Обработчики сигналов моделей чат-бота."""
+
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from chatbot.auth_cache import TokenUserCache
+from chatbot.context import ConversationContextCache, HistoryAssembler
+from chatbot.models import Message
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_conversation_context(sender, instance, created=False, **kwargs):
+    """Сбрасывает контекст Ollama и окно истории, если сообщение изменилось."""
+    if created:
+        return
+    if not (ConversationContextCache.is_enabled() or HistoryAssembler.is_enabled()):
+        return
+
+    try:
+        ConversationContextCache.invalidate_sync(str(instance.chat_id))
+    except Exception as e:
+        logger.error(f"Failed to invalidate context for chat {instance.chat_id}: {e}")
+
+
+def _invalidate_user_auth(user_id):
+    if not TokenUserCache.is_enabled():
+        return
+    try:
+        TokenUserCache.invalidate_user(user_id)
+    except Exception as e:
+        logger.error(f"Failed to invalidate auth cache for user {user_id}: {e}")
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_user_auth(sender, instance, created=False, update_fields=None, **kwargs):
+    """Сбрасывает кеш JWT-аутентификации веб-сокетов при изменении пользователя."""
+    # Вход обновляет только last_login - кешированные поля не меняются
+    if created or update_fields == frozenset({"last_login"}):
+        return
+    _invalidate_user_auth(instance.pk)
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def invalidate_blacklisted_user_auth(sender, instance, created=False, **kwargs):
+    """Сбрасывает кеш JWT-аутентификации веб-сокетов при отзыве refresh-токена."""
+    if created and instance.token.user_id is not None:
+        _invalidate_user_auth(instance.token.user_id)
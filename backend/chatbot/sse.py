@@ -0,0 +1,292 @@
+"""Server-Sent Events: чтение генерации чата одним HTTP-ответом."""
+
+import asyncio
+import json
+import logging
+import secrets
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+
+from chatbot.consumers import drain_waiter, is_draining
+from chatbot.middleware import JWTAuthMiddleware
+from chatbot.presence import ChatPresence
+from chatbot.redis_client import get_redis, get_sync_redis
+from chatbot.registry import GenerationRegistry
+from chatbot.streams import STREAM_START, GenerationStream, is_valid_offset
+
+logger = logging.getLogger(__name__)
+
+TICKET_KEY = "chatbot:sse:ticket:{chat_id}:{ticket}"
+
+# Комментарий SSE, не дающий прокси закрыть простаивающее соединение
+KEEPALIVE = b": keepalive\n\n"
+
+# Последний кадр при остановке процесса: EventSource переподключится через
+# retry мс с Last-Event-ID, уже к другому воркеру
+DRAINING = b'retry: 1000\nevent: draining\ndata: {"type": "draining"}\n\n'
+
+
+class _Draining(Exception):
+    """Процесс начал останавливаться - ответ нужно закрыть."""
+
+
+async def _unless_draining(draining: asyncio.Future, coro):
+    """Выполняет coro, прерывая его при остановке процесса (_Draining)."""
+    task = asyncio.ensure_future(coro)
+    try:
+        done, _ = await asyncio.wait(
+            {task, draining}, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        if not task.done():
+            task.cancel()
+    if task not in done:
+        raise _Draining()
+    return task.result()
+
+
+def format_event(event: Dict[str, Any]) -> bytes:
+    """Кадр SSE: offset события уходит в id, чтобы браузер вернул его в Last-Event-ID."""
+    lines = []
+    if event.get("offset"):
+        lines.append(f"id: {event['offset']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event)}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def issue_ticket(user_id, chat_id) -> str:
+    """
+    Выдает одноразовый билет на чтение событий чата.
+
+    EventSource в браузере не умеет передавать заголовки, а JWT в query
+    string оседает в логах прокси. Билет живет AI_SSE_TICKET_TTL секунд и
+    погашается первым же подключением.
+    """
+    ticket = secrets.token_urlsafe(32)
+    get_sync_redis().set(
+        TICKET_KEY.format(chat_id=chat_id, ticket=ticket),
+        str(user_id),
+        ex=getattr(settings, "AI_SSE_TICKET_TTL", 30),
+    )
+    return ticket
+
+
+async def _redeem_ticket(chat_id, ticket: str) -> Optional[str]:
+    """Гасит билет и возвращает ID пользователя, которому он выдан."""
+    try:
+        return await get_redis().getdel(
+            TICKET_KEY.format(chat_id=chat_id, ticket=ticket)
+        )
+    except Exception as e:
+        logger.error(f"Failed to redeem SSE ticket for chat {chat_id}: {e}")
+        return None
+
+
+async def _authenticate(request, chat_id):
+    """Пользователь по заголовку Authorization или одноразовому билету."""
+    middleware = JWTAuthMiddleware(None)
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme == "Bearer" and token:
+        return await middleware.get_user_from_token(token)
+
+    ticket = request.GET.get("ticket")
+    user_id = await _redeem_ticket(chat_id, ticket) if ticket else None
+    if user_id is None:
+        return None
+    user = await middleware.fetch_user(user_id)
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
+def _get_offset(request) -> Optional[str]:
+    offset = request.headers.get("Last-Event-ID") or request.GET.get("offset")
+    return offset if is_valid_offset(offset) else None
+
+
+async def _is_generating(chat_id: str) -> bool:
+    try:
+        return await GenerationRegistry.is_generating(chat_id)
+    except Exception as e:
+        logger.error(f"Failed to check generation state: {e}")
+        return False
+
+
+async def _start_offset(chat_id: str) -> str:
+    """
+    Offset, с которого читать стрим клиенту без Last-Event-ID.
+
+    Идущая генерация отдается с начала. Без нее в стриме лежит уже
+    законченный ответ, и чтение начинается после его последнего события.
+    Последний offset берется до проверки генерации: генерация, начатая между
+    ними, очищает стрим, и ее события все равно окажутся после него.
+    """
+    try:
+        last = await GenerationStream.last_offset(chat_id)
+    except Exception as e:
+        logger.error(f"Failed to read stream for chat {chat_id}: {e}")
+        return STREAM_START
+    if await _is_generating(chat_id):
+        return STREAM_START
+    return last
+
+
+@asynccontextmanager
+async def _presence(chat_id: str):
+    """
+    Учитывает SSE-соединение в присутствии чата на время ответа.
+
+    Иначе генератор сочтет чат безлюдным: не будет рассылать чанки в
+    группу, а после ухода веб-сокетов отменит генерацию (cancel_if_abandoned).
+    """
+    if not ChatPresence.is_enabled():
+        yield
+        return
+
+    presence_name = f"sse.{uuid.uuid4().hex}"
+    await ChatPresence.join(chat_id, presence_name)
+    heartbeat = asyncio.ensure_future(ChatPresence.heartbeat(chat_id, presence_name))
+    try:
+        yield
+    finally:
+        heartbeat.cancel()
+        try:
+            await ChatPresence.leave(chat_id, presence_name)
+        except Exception as e:
+            logger.error(f"Failed to remove presence in chat {chat_id}: {e}")
+
+
+async def _tail_stream(chat_id: str, offset: str) -> AsyncIterator[bytes]:
+    """
+    Читает стрим воспроизведения генерации с offset до ai_complete.
+
+    Подписки на группу канального слоя нет: события берутся из того же
+    Redis Stream, по которому дочитывают веб-сокеты (XREAD BLOCK).
+    """
+    keepalive = getattr(settings, "AI_SSE_KEEPALIVE_INTERVAL", 15)
+    idle_timeout = getattr(settings, "AI_SSE_IDLE_TIMEOUT", 30)
+    idle_since = time.monotonic()
+
+    async with _presence(chat_id):
+        with drain_waiter() as draining:
+            while True:
+                try:
+                    events = await _unless_draining(
+                        draining,
+                        GenerationStream.wait_after(chat_id, offset, keepalive),
+                    )
+                except _Draining:
+                    yield DRAINING
+                    return
+                except Exception as e:
+                    logger.error(f"Failed to read stream for chat {chat_id}: {e}")
+                    return
+
+                for event in events:
+                    offset = event["offset"]
+                    yield format_event(event)
+                    if event["type"] == "ai_complete":
+                        return
+
+                if events or await _is_generating(chat_id):
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since >= idle_timeout:
+                    return
+                if not events:
+                    yield KEEPALIVE
+
+
+async def _follow_group(chat_id: str) -> AsyncIterator[bytes]:
+    """
+    Читает события генерации из группы чата, когда стрим воспроизведения выключен.
+    """
+    from channels.layers import get_channel_layer
+
+    keepalive = getattr(settings, "AI_SSE_KEEPALIVE_INTERVAL", 15)
+    idle_timeout = getattr(settings, "AI_SSE_IDLE_TIMEOUT", 30)
+    group_name = f"chat_{chat_id}"
+    channel_layer = get_channel_layer()
+    channel_name = await channel_layer.new_channel()
+
+    await channel_layer.group_add(group_name, channel_name)
+    try:
+        async with _presence(chat_id):
+            with drain_waiter() as draining:
+                idle_since = time.monotonic()
+                while True:
+                    try:
+                        event = await _unless_draining(
+                            draining,
+                            asyncio.wait_for(
+                                channel_layer.receive(channel_name), keepalive
+                            ),
+                        )
+                    except _Draining:
+                        yield DRAINING
+                        return
+                    except asyncio.TimeoutError:
+                        if await _is_generating(chat_id):
+                            idle_since = time.monotonic()
+                        elif time.monotonic() - idle_since >= idle_timeout:
+                            return
+                        yield KEEPALIVE
+                        continue
+
+                    if event["type"] not in ("ai_chunk", "ai_thinking", "ai_complete"):
+                        continue
+                    idle_since = time.monotonic()
+                    yield format_event(event)
+                    if event["type"] == "ai_complete":
+                        return
+    finally:
+        await channel_layer.group_discard(group_name, channel_name)
+
+
+async def chat_events(request, chat_id):
+    """
+    GET /api/v1/chatbot/chats/{id}/events/ - генерация чата потоком SSE.
+
+    Отдает события ai_chunk/ai_thinking/ai_complete текущей генерации и
+    закрывает ответ после ai_complete. Семантика дочитывания та же, что у веб-сокета:
+    offset из Last-Event-ID (или ?offset=) продолжает с места обрыва, без
+    него идущая генерация отдается с начала, а законченная не повторяется.
+    Если генерации нет, соединение закрывается после AI_SSE_IDLE_TIMEOUT
+    секунд ожидания. При остановке процесса ответ закрывается кадром с
+    retry, чтобы клиент переподключился к другому воркеру. Клиент
+    предъявляет JWT в заголовке Authorization или одноразовый билет
+    (?ticket=, см. issue_ticket).
+    """
+    from chatbot.models import Chat
+
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    if is_draining():
+        response = JsonResponse({"error": "Server is shutting down"}, status=503)
+        response["Retry-After"] = "1"
+        return response
+
+    user = await _authenticate(request, chat_id)
+    if user is None or user.is_anonymous:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+
+    if not await Chat.objects.filter(id=chat_id, owner=user, deleted=False).aexists():
+        return JsonResponse({"error": "Chat not found"}, status=404)
+
+    if GenerationStream.is_enabled():
+        offset = _get_offset(request) or await _start_offset(str(chat_id))
+        stream = _tail_stream(str(chat_id), offset)
+    else:
+        stream = _follow_group(str(chat_id))
+
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # nginx не должен буферизовать поток
+    response["X-Accel-Buffering"] = "no"
+    return response
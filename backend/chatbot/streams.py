@@ -0,0 +1,108 @@
+"""Буфер воспроизведения генераций поверх Redis Streams."""
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from chatbot.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = "chatbot:stream:{chat_id}"
+
+# Смещение "с начала стрима"
+STREAM_START = "0-0"
+
+
+def parse_offset(offset: str) -> Tuple[int, int]:
+    """Разбирает ID записи Redis Stream ("<ms>-<seq>") для сравнения."""
+    ms, _, seq = offset.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def is_valid_offset(offset: Optional[str]) -> bool:
+    if not offset:
+        return False
+    try:
+        parse_offset(offset)
+    except ValueError:
+        return False
+    return True
+
+
+class GenerationStream:
+    """
+    Redis Stream событий текущей генерации чата.
+
+    Каждое событие ai_chunk/ai_thinking/ai_complete перед рассылкой в группу
+    дописывается в стрим, а его ID уходит клиенту как offset. Клиент,
+    подключившийся поздно или после обрыва, дочитывает пропущенное из стрима
+    по последнему полученному offset, не перезапуская генерацию. Стрим
+    не обрезается по длине: дочитывание с начала должно отдать ответ
+    целиком. Его ограничивают сброс при взятии аренды новой генерацией и
+    AI_STREAM_TTL секунд жизни после последней записи.
+    """
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, "AI_STREAM_RESUME_ENABLED", True)
+
+    @staticmethod
+    async def reset(chat_id: str):
+        """Начинает стрим новой генерации с чистого листа."""
+        await get_redis().delete(STREAM_KEY.format(chat_id=chat_id))
+
+    @staticmethod
+    async def append(chat_id: str, event: Dict[str, Any]) -> str:
+        """Дописывает событие в стрим и возвращает его offset."""
+        key = STREAM_KEY.format(chat_id=chat_id)
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"event": json.dumps(event, ensure_ascii=False)})
+            pipe.expire(key, getattr(settings, "AI_STREAM_TTL", 300))
+            offset, _ = await pipe.execute()
+        return offset
+
+    @staticmethod
+    async def read_after(
+        chat_id: str, offset: str = STREAM_START
+    ) -> List[Dict[str, Any]]:
+        """Возвращает события стрима после offset, каждое со своим offset."""
+        entries = await get_redis().xrange(
+            STREAM_KEY.format(chat_id=chat_id), min=f"({offset}", max="+"
+        )
+        return _parse_entries(entries)
+
+    @staticmethod
+    async def last_offset(chat_id: str) -> str:
+        """Offset последнего события стрима или STREAM_START, если стрим пуст."""
+        entries = await get_redis().xrevrange(
+            STREAM_KEY.format(chat_id=chat_id), max="+", min="-", count=1
+        )
+        return entries[0][0] if entries else STREAM_START
+
+    @staticmethod
+    async def wait_after(
+        chat_id: str, offset: str, timeout: float
+    ) -> List[Dict[str, Any]]:
+        """
+        Ждет до timeout секунд событий после offset (XREAD BLOCK).
+
+        Возвращает пустой список, если за это время ничего не появилось.
+        """
+        key = STREAM_KEY.format(chat_id=chat_id)
+        response = await get_redis().xread({key: offset}, block=int(timeout * 1000))
+        if not response:
+            return []
+        _, entries = response[0]
+        return _parse_entries(entries)
+
+
+def _parse_entries(entries) -> List[Dict[str, Any]]:
+    events = []
+    for entry_id, fields in entries:
+        event = json.loads(fields["event"])
+        event["offset"] = entry_id
+        events.append(event)
+    return events
@@ -1,81 +1,37 @@
 # chatbot/tasks.py
 import logging
+from typing import Optional
 
-logger = logging.getLogger(__name__)
-
-# @shared_task(bind=True)
-# def generate_ai_response(self, chat_id: str, prompt: str):
-#     try:
-#         from chatbot.models import Message, Chat
-
-#         logger.info(f"[Celery] Start AI for chat {chat_id}, prompt: {prompt[:50]}...")
-
-#         try:
-#             chat_uuid = UUID(chat_id)
-#         except ValueError:
-#             logger.error(f"Invalid chat_id format: {chat_id}")
-#             return
-
-#         channel_layer = get_channel_layer()
-#         group_name = f"chat_{chat_id}"
-#         full_response = ""
-
-#         req = urllib.request.Request(
-#             "http://ollama:11434/api/generate",
-#             data=json.dumps({
-#                 "model": "qwen2.5:7b-instruct",
-#                 "prompt": f"Ты AI-психолог HisMind. Общайся ТОЛЬКО на русском. ... {prompt}",
-#                 "stream": True
-#             }).encode(),
-#             headers={"Content-Type": "application/json"},
-#             method="POST",
-#         )
+from celery import shared_task
 
-#         with urllib.request.urlopen(req) as resp:
-#             for line in resp:
-#                 line = line.strip()
-#                 if not line:
-#                     continue
-#                 data = json.loads(line.decode())
-#                 token = data.get("response", "")
-#                 if not token:
-#                     continue
-
-#                 full_response += token
-#                 async_to_sync(channel_layer.group_send)(
-#                     group_name,
-#                     {"type": "ai_chunk", "chunk": token},
-#                 )
-#                 if data.get("done"):
-#                     break
-
-#         ai_msg = Message.objects.create(
-#             chat_id=chat_id,  # ← ЯВНО
-#             content=full_response,
-#             message_type="text",
-#             sender=None,
-#         )
-
-#         async_to_sync(channel_layer.group_send)(
-#             group_name,
-#             {"type": "ai_complete", "message_id": str(ai_msg.id)},
-#         )
-
-#         # # СОХРАНЯЕМ В БД
-#         # ai_msg = Message.objects.create(
-#         #     chat_id=chat_id,
-#         #     content=full_response,
-#         #     message_type="text",
-#         #     sender=None,
-#         # )
-#         # logger.info(f"[Celery] AI message saved: {ai_msg.id}")
+logger = logging.getLogger(__name__)
 
-#         # # ОТПРАВЛЯЕМ ai_complete
-#         # async_to_sync(channel_layer.group_send)(
-#         #     group_name,
-#         #     {"type": "ai_complete", "message_id": str(ai_msg.id)},
-#         # )
-#         # logger.info(f"[Celery] ai_complete sent for {ai_msg.id}")
 
-#     except Exception as e:
-#         logger.error(f"[Celery] ERROR in generate_ai_response: {e}", exc_info=True)
+@shared_task(name="chatbot.tasks.generate_ai_response", ignore_result=True)
+def generate_ai_response(
+    chat_id: str,
+    prompt: str,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    lease_token: Optional[str] = None,
+    user_id: Optional[str] = None,
+):
+    """
+    Генерация ответа на воркере Celery (AI_GENERATION_MODE = "celery").
+
+    Задачу ставит enqueue_generation в очередь AI_GENERATION_QUEUE. Чанки и
+    ai_complete уходят в группу чата канального слоя и в стрим
+    воспроизведения, так что клиент получает те же события, что и при
+    генерации в процессе веб-сервера.
+    """
+    from chatbot.consumers import OllamaClient
+
+    logger.info(f"[Celery] Start AI for chat {chat_id}")
+    OllamaClient.generate_response(
+        chat_id=chat_id,
+        prompt=prompt,
+        model=model,
+        system_prompt=system_prompt,
+        lease_token=lease_token,
+        user_id=user_id,
+    )
@@ -1,5 +1,2447 @@
 """Модульное тестирование чат-бота."""
 
-# flake8: noqa
+import asyncio
+import json
+import signal
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import aiohttp
+import msgpack
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from chatbot import consumers, context, registry
+from chatbot.auth_cache import TokenUserCache
+from chatbot.cache import ResponseCache
+from chatbot.consumers import (
+    ServiceChatConsumer,
+    _track,
+    cancel_if_abandoned,
+    drain_generations,
+    submit_generation,
+)
+from chatbot.context import (
+    ConversationContextCache,
+    HistoryAssembler,
+    render_history,
+    trim_to_budget,
+)
+from chatbot.db import (
+    _connections,
+    _track_connection,
+    generation_db,
+    open_connections,
+    release_connections,
+    shutdown_db_executor,
+)
+from chatbot.drafts import DraftCheckpointer, finalize_orphaned_drafts
+from chatbot.generation import (
+    AsyncOllamaClient,
+    ThinkSplitter,
+    TokenCoalescer,
+    _publish,
+    close_ollama_session,
+    get_ollama_session,
+    run_generation,
+    send_not_started,
+)
+from chatbot.lifespan import LifespanApp
+from chatbot.middleware import JWTAuthMiddleware
+from chatbot.models import Chat, Message
+from chatbot.presence import ChatPresence, PresenceWatcher
+from chatbot.protocol import (
+    MSGPACK_SUBPROTOCOL,
+    JsonProtocol,
+    MsgpackProtocol,
+    ProtocolError,
+    negotiate,
+)
+from chatbot.registry import CancelToken, GenerationLease, GenerationRegistry
+from chatbot.router import NoBackendAvailable, OllamaRouter
+from chatbot.scheduler import (
+    AdaptiveConcurrencyLimit,
+    GenerationScheduler,
+    QueueFullError,
+)
+from chatbot.sse import DRAINING, chat_events
+from chatbot.streams import GenerationStream, parse_offset
+from chatbot.tasks import generate_ai_response
+from chatbot.writes import (
+    PREVIEW_LENGTH,
+    ChatAccessDenied,
+    create_message,
+    save_user_message,
+)
+
+TEST_MODELS = ("deepseek-r1:1.5b", "test-model")
+
+
+def serve_models(app, models=TEST_MODELS):
+    """Добавляет фейковому Ollama список моделей /api/tags."""
+
+    async def tags(request):
+        return web.json_response({"models": [{"name": name} for name in models]})
+
+    app.router.add_get("/api/tags", tags)
+    return app
+
+
+def make_ollama_app(tokens, done_payload=None, models=TEST_MODELS):
+    """Создает фейковый стриминговый сервер Ollama /api/generate."""
+    requests = []
+
+    async def generate(request):
+        requests.append(await request.json())
+        response = web.StreamResponse()
+        response.content_type = "application/x-ndjson"
+        await response.prepare(request)
+        for token in tokens:
+            line = {"response": token, "done": False}
+            await response.write(json.dumps(line).encode() + b"\n")
+        final = {"response": "", "done": True}
+        final.update(done_payload or {})
+        await response.write(json.dumps(final).encode() + b"\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/api/generate", generate)
+    app["requests"] = requests
+    return serve_models(app, models)
+
+
+def make_slow_ollama_app(delay=0.05, count=200):
+    """Создает фейковый Ollama, который стримит медленно и ловит обрыв клиента."""
+    state = {"disconnected": asyncio.Event()}
+
+    async def generate(request):
+        response = web.StreamResponse()
+        response.content_type = "application/x-ndjson"
+        await response.prepare(request)
+        try:
+            for i in range(count):
+                line = {"response": f"t{i} ", "done": False}
+                await response.write(json.dumps(line).encode() + b"\n")
+                await asyncio.sleep(delay)
+        except (ConnectionResetError, asyncio.CancelledError):
+            state["disconnected"].set()
+            raise
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/api/generate", generate)
+    app["state"] = state
+    return serve_models(app)
+
+
+def make_failing_ollama_app():
+    """Создает фейковый Ollama, у которого генерация падает с 500."""
+    app = web.Application()
+    app["calls"] = 0
+
+    async def generate(request):
+        app["calls"] += 1
+        return web.Response(status=500, text="model crashed")
+
+    app.router.add_post("/api/generate", generate)
+    return serve_models(app)
+
+
+@asynccontextmanager
+async def running_servers(*apps):
+    """Поднимает фейковые серверы Ollama и отдает их базовые URL."""
+    servers = [TestServer(app) for app in apps]
+    try:
+        for server in servers:
+            await server.start_server()
+        yield [str(server.make_url("")).rstrip("/") for server in servers]
+    finally:
+        await close_ollama_session()
+        for server in servers:
+            await server.close()
+
+
+async def connect_consumer(user, chat_id, query_string="", subprotocols=()):
+    """Подключает ServiceChatConsumer в обход middleware аутентификации."""
+    communicator = ApplicationCommunicator(
+        ServiceChatConsumer.as_asgi(),
+        {
+            "type": "websocket",
+            "path": f"/ws/chat/{chat_id}/",
+            "query_string": query_string.encode(),
+            "headers": [],
+            "subprotocols": list(subprotocols),
+            "user": user,
+            "url_route": {"kwargs": {"chat_id": chat_id}},
+        },
+    )
+    await communicator.send_input({"type": "websocket.connect"})
+    accepted = await communicator.receive_output(1)
+    assert accepted["type"] == "websocket.accept", accepted
+    communicator.subprotocol = accepted.get("subprotocol")
+    return communicator
+
+
+async def receive_json(communicator):
+    """Читает следующее JSON-сообщение, отправленное консьюмером клиенту."""
+    output = await communicator.receive_output(1)
+    return json.loads(output["text"])
+
+
+async def drain_group(channel_layer, channel_name):
+    """Вычитывает сообщения канала до события ai_complete включительно."""
+    events = []
+    while True:
+        event = await channel_layer.receive(channel_name)
+        events.append(event)
+        if event["type"] == "ai_complete":
+            return events
+
+
+class AsyncOllamaClientTests(TestCase):
+    """Тесты асинхронного клиента Ollama"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="chatuser", password="pass123")
+        self.chat = Chat.objects.create(owner=self.user, name="Тестовый чат")
+        self.chat_id = str(self.chat.id)
+
+    async def run_generation(self, app, **kwargs):
+        """Запускает генерацию против фейкового сервера и собирает события."""
+        server = TestServer(app)
+        await server.start_server()
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(f"chat_{self.chat_id}", channel_name)
+        try:
+            with override_settings(
+                OLLAMA_API_URL=str(server.make_url("/api/generate"))
+            ):
+                result = await AsyncOllamaClient.generate_response(
+                    chat_id=self.chat_id,
+                    prompt="Привет",
+                    channel_layer=channel_layer,
+                    **kwargs,
+                )
+            events = await drain_group(channel_layer, channel_name)
+        finally:
+            await close_ollama_session()
+            await server.close()
+        return result, events
+
+    async def test_streams_tokens_and_saves_message(self):
+        """Тест стриминга токенов в группу и сохранения ответа"""
+        app = make_ollama_app(["При", "вет", "!"])
+        result, events = await self.run_generation(app)
+
+        self.assertTrue(result["success"])
+        chunks = "".join(e["chunk"] for e in events if e["type"] == "ai_chunk")
+        self.assertEqual(chunks, "Привет!")
+        self.assertEqual(events[-1]["message_id"], result["message_id"])
+
+        message = await Message.objects.aget(id=result["message_id"])
+        self.assertEqual(message.content, "Привет!")
+        self.assertIsNone(message.sender_id)
+
+    async def test_thinking_separated_from_answer(self):
+        """Тест отделения рассуждений от ответа на границах токенов"""
+        app = make_ollama_app(["<thi", "nk>\nДумаю", "...</th", "ink>\n\n", "Ответ"])
+        result, events = await self.run_generation(app)
+
+        thinking = "".join(e["chunk"] for e in events if e["type"] == "ai_thinking")
+        chunks = "".join(e["chunk"] for e in events if e["type"] == "ai_chunk")
+        self.assertEqual(thinking, "\nДумаю...")
+        self.assertEqual(chunks, "Ответ")
+        # Рассуждения приходят раньше ответа
+        types = [e["type"] for e in events]
+        self.assertLess(types.index("ai_thinking"), types.index("ai_chunk"))
+
+        message = await Message.objects.aget(id=result["message_id"])
+        self.assertEqual(message.content, "Ответ")
+        self.assertEqual(message.thinking, "\nДумаю...")
+
+    @override_settings(AI_THINKING_STREAM=False)
+    async def test_thinking_not_streamed_when_disabled(self):
+        """Тест отключенной рассылки рассуждений: в БД они сохраняются"""
+        app = make_ollama_app(["<think>Думаю</think>", "Ответ"])
+        result, events = await self.run_generation(app)
+
+        self.assertNotIn("ai_thinking", [e["type"] for e in events])
+        message = await Message.objects.aget(id=result["message_id"])
+        self.assertEqual(message.content, "Ответ")
+        self.assertEqual(message.thinking, "Думаю")
+
+    async def test_generation_metrics_by_model(self):
+        """Тест метрик генерации из статистики Ollama по модели"""
+
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, {"model": "test-model", **labels})
+
+        before_eval = sample("chatbot_generation_tokens_total", kind="eval") or 0
+        before_ttft = (
+            sample("chatbot_generation_time_to_first_token_seconds_count") or 0
+        )
+        before_itl = sample("chatbot_generation_inter_token_latency_seconds_count") or 0
+        app = make_ollama_app(
+            ["a", "b", "c"],
+            done_payload={
+                "eval_count": 30,
+                "eval_duration": 1_500_000_000,
+                "prompt_eval_count": 12,
+                "prompt_eval_duration": 250_000_000,
+            },
+        )
+
+        await self.run_generation(app, model="test-model")
+
+        self.assertEqual(
+            sample("chatbot_generation_tokens_total", kind="eval"), before_eval + 30
+        )
+        self.assertEqual(
+            sample("chatbot_generation_time_to_first_token_seconds_count"),
+            before_ttft + 1,
+        )
+        self.assertEqual(
+            sample("chatbot_generation_inter_token_latency_seconds_count"),
+            before_itl + 2,
+        )
+        # 30 токенов за 1.5 с попадают в корзину 20 ток/с
+        self.assertGreaterEqual(
+            sample("chatbot_generation_eval_tokens_per_second_bucket", le="20.0"), 1
+        )
+        self.assertGreaterEqual(
+            sample("chatbot_generation_prefill_seconds_bucket", le="0.25"), 1
+        )
+
+    async def test_empty_response(self):
+        """Тест пустого ответа модели"""
+        result, events = await self.run_generation(make_ollama_app([]))
+
+        self.assertFalse(result["success"])
+        self.assertEqual(result["message_id"], "empty_response")
+        self.assertEqual(events[-1]["error"], "Пустой ответ от модели")
+
+    async def test_request_payload(self):
+        """Тест передачи модели и системного промпта в Ollama"""
+        app = make_ollama_app(["ok"])
+        await self.run_generation(app, model="test-model", system_prompt="Будь краток")
+
+        payload = app["requests"][0]
+        self.assertEqual(payload["model"], "test-model")
+        self.assertEqual(payload["system"], "Будь краток")
+        self.assertTrue(payload["stream"])
+
+    @override_settings(AI_CONTEXT_REUSE=True)
+    async def test_context_reused_between_turns(self):
+        """Тест передачи сохраненного контекста и запоминания нового"""
+        app = make_ollama_app(["ok"], done_payload={"context": [1, 2, 3]})
+        with (
+            mock.patch.object(
+                ConversationContextCache,
+                "get",
+                mock.AsyncMock(return_value=([7, 8], "4")),
+            ),
+            mock.patch.object(ConversationContextCache, "store") as store,
+        ):
+            await self.run_generation(app, model="test-model")
+
+        self.assertEqual(app["requests"][0]["context"], [7, 8])
+        store.assert_awaited_once_with(self.chat_id, "test-model", [1, 2, 3], "4")
+
+    @override_settings(AI_DRAFT_CHECKPOINT_TOKENS=2)
+    async def test_long_answer_checkpointed_into_one_message(self):
+        """Тест сохранения длинного ответа через черновик в одно сообщение"""
+        tokens = [f"t{i} " for i in range(10)]
+        result, _ = await self.run_generation(make_ollama_app(tokens))
+
+        messages = [m async for m in Message.objects.filter(chat=self.chat)]
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(str(messages[0].id), result["message_id"])
+        self.assertEqual(messages[0].content, "".join(tokens))
+        self.assertFalse(messages[0].is_draft)
+
+    @override_settings(AI_RESPONSE_CACHE_ENABLED=True)
+    async def test_repeated_prompt_served_from_cache(self):
+        """Тест ответа на повтор промпта из кеша тем же потоком событий"""
+        ResponseCache.clear_local()
+        self.addCleanup(ResponseCache.clear_local)
+        app = make_ollama_app(["При", "вет"], done_payload={"eval_count": 2})
+
+        with mock.patch("chatbot.cache.get_redis", return_value=FakeRedis().aio):
+            first, _ = await self.run_generation(app)
+            second, events = await self.run_generation(app)
+
+        self.assertEqual(len(app["requests"]), 1)
+        self.assertTrue(second["success"])
+        self.assertNotEqual(first["message_id"], second["message_id"])
+        self.assertEqual([e["type"] for e in events], ["ai_chunk", "ai_complete"])
+        self.assertEqual(events[0]["chunk"], "Привет")
+        message = await Message.objects.aget(id=second["message_id"])
+        self.assertEqual(message.content, "Привет")
+
+    @override_settings(WS_PRESENCE_ENABLED=True)
+    async def test_unattended_chat_skips_chunk_fan_out(self):
+        """Тест генерации без подписчиков: только итог, без рассылки чанков"""
+        presence = FakeRedis().aio
+        with mock.patch("chatbot.presence.get_redis", return_value=presence):
+            result, events = await self.run_generation(make_ollama_app(["a", "b"]))
+
+        self.assertTrue(result["success"])
+        self.assertEqual([e["type"] for e in events], ["ai_complete"])
+        message = await Message.objects.aget(id=result["message_id"])
+        self.assertEqual(message.content, "ab")
+
+    async def test_failover_to_healthy_backend(self):
+        """Тест повтора генерации на другом сервере до первого токена"""
+        failing = make_failing_ollama_app()
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(f"chat_{self.chat_id}", channel_name)
+
+        async with running_servers(failing, make_ollama_app(["ok"])) as urls:
+            with override_settings(OLLAMA_BACKENDS=urls):
+                result = await AsyncOllamaClient.generate_response(
+                    chat_id=self.chat_id,
+                    prompt="Привет",
+                    channel_layer=channel_layer,
+                )
+        await drain_group(channel_layer, channel_name)
+
+        self.assertTrue(result["success"])
+        self.assertEqual(failing["calls"], 1)
+        message = await Message.objects.aget(id=result["message_id"])
+        self.assertEqual(message.content, "ok")
+
+    async def test_cancel_closes_stream_and_saves_partial(self):
+        """Тест отмены: стрим к Ollama рвется, частичный ответ сохраняется"""
+        app = make_slow_ollama_app()
+        server = TestServer(app)
+        await server.start_server()
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(f"chat_{self.chat_id}", channel_name)
+
+        redis = mock.MagicMock()
+        redis.eval = mock.AsyncMock(return_value=1)
+        lease = GenerationLease(self.chat_id, "test-token")
+        try:
+            url = str(server.make_url("/api/generate"))
+            with (
+                mock.patch("chatbot.registry.get_redis", return_value=redis),
+                override_settings(OLLAMA_API_URL=url),
+            ):
+                generation = asyncio.ensure_future(
+                    AsyncOllamaClient.generate_response(
+                        chat_id=self.chat_id,
+                        prompt="Привет",
+                        channel_layer=channel_layer,
+                        lease=lease,
+                    )
+                )
+                first = await channel_layer.receive(channel_name)
+                self.assertEqual(first["type"], "ai_chunk")
+
+                self.assertTrue(GenerationRegistry._cancel_local(self.chat_id))
+                result = await asyncio.wait_for(generation, timeout=5)
+                await asyncio.wait_for(app["state"]["disconnected"].wait(), timeout=5)
+            events = await drain_group(channel_layer, channel_name)
+        finally:
+            await close_ollama_session()
+            await server.close()
+
+        self.assertTrue(result["cancelled"])
+        self.assertTrue(result["success"])
+        self.assertTrue(events[-1]["cancelled"])
+        self.assertNotIn(self.chat_id, GenerationRegistry._local_tokens)
+
+        message = await Message.objects.aget(id=result["message_id"])
+        self.assertTrue(message.content.startswith("t0 "))
+        self.assertLess(len(message.content.split()), 200)
+
+
+def eval_stats(tokens_per_sec, success=True):
+    """Итог генерации с заданной скоростью одного стрима."""
+    return {
+        "success": success,
+        "eval_count": tokens_per_sec,
+        "eval_duration": 1_000_000_000,
+    }
+
+
+class AdaptiveConcurrencyLimitTests(SimpleTestCase):
+    """Тесты адаптивного лимита параллелизма модели"""
+
+    def make_ticket(self, concurrency):
+        return mock.Mock(admitted_at=time.monotonic(), concurrency=concurrency)
+
+    def test_additive_increase_while_throughput_grows(self):
+        """Тест роста лимита, пока параллелизм дает прирост скорости"""
+        limit = AdaptiveConcurrencyLimit("m", initial=2, max_limit=3)
+
+        limit.on_complete(self.make_ticket(1), eval_stats(50))
+        self.assertEqual(limit.limit, 2.5)
+        limit.on_complete(self.make_ticket(2), eval_stats(45))
+        limit.on_complete(self.make_ticket(2), eval_stats(45))
+        self.assertEqual(limit.limit, 3)
+
+    def test_decrease_past_saturation(self):
+        """Тест снижения лимита, когда суммарная скорость падает"""
+        limit = AdaptiveConcurrencyLimit("m", initial=4, backoff=0.5)
+        limit.on_complete(self.make_ticket(2), eval_stats(50))
+
+        # Четыре стрима по 20 ток/с медленнее двух по 50
+        limit.on_complete(self.make_ticket(4), eval_stats(20))
+        self.assertEqual(limit.limit, 4.25 * 0.5)
+
+        # Генерация, начатая до снижения, на лимит уже не влияет
+        stale = self.make_ticket(4)
+        stale.admitted_at = 0
+        limit.on_complete(stale, eval_stats(10))
+        self.assertEqual(limit.limit, 4.25 * 0.5)
+
+    def test_decrease_on_slow_stream_and_errors(self):
+        """Тест снижения лимита при медленном стриме и ошибках сервера"""
+        limit = AdaptiveConcurrencyLimit(
+            "m", initial=4, backoff=0.5, min_stream_rate=5, min_limit=1
+        )
+        limit.on_complete(self.make_ticket(4), eval_stats(3))
+        self.assertEqual(limit.limit, 2)
+
+        error = {"success": False, "message_id": "timeout_error"}
+        limit.on_complete(self.make_ticket(2), error)
+        self.assertEqual(limit.limit, 1)
+
+        # Отмена ничего не говорит о нагрузке
+        limit.on_complete(self.make_ticket(1), {"cancelled": True})
+        self.assertEqual(limit.limit, 1)
+
+
+class OllamaRouterTests(SimpleTestCase):
+    """Тесты маршрутизации генераций по пулу серверов Ollama"""
+
+    async def test_routes_to_backend_with_model(self):
+        """Тест выбора сервера, на котором есть модель"""
+        apps = make_ollama_app([], models=("other-model",)), make_ollama_app([])
+        async with running_servers(*apps) as urls:
+            router = OllamaRouter(urls)
+
+            backend = await router.select("test-model")
+
+            self.assertEqual(backend.url, urls[1])
+            with self.assertRaises(NoBackendAvailable):
+                await router.select("missing-model")
+
+    async def test_least_loaded_backend(self):
+        """Тест выбора сервера с наименьшей нагрузкой с учетом скорости"""
+        async with running_servers(make_ollama_app([]), make_ollama_app([])) as urls:
+            router = OllamaRouter(urls)
+            fast, slow = router.backends
+
+            fast.in_flight = 2
+            self.assertIs(await router.select("test-model"), slow)
+
+            # Быстрый сервер разберет две генерации раньше, чем медленный одну
+            fast.record_success({"eval_count": 100, "eval_duration": 1_000_000_000})
+            slow.record_success({"eval_count": 10, "eval_duration": 1_000_000_000})
+            self.assertEqual(fast.tokens_per_sec, 100)
+            self.assertIs(await router.select("test-model"), fast)
+
+    async def test_circuit_breaker(self):
+        """Тест отключения падающего сервера и его возврата после проверки"""
+        failing = make_failing_ollama_app()
+        async with running_servers(failing, make_ollama_app(["ok"])) as urls:
+            router = OllamaRouter(urls, failure_threshold=2, reset_timeout=60)
+            broken, healthy = router.backends
+            healthy.in_flight = 10  # Пока автомат замкнут, выбирается broken
+
+            for _ in range(2):
+                with self.assertRaises(aiohttp.ClientResponseError):
+                    async with router.dispatch("test-model") as backend:
+                        self.assertIs(backend, broken)
+                        session = get_ollama_session()
+                        async with session.post(backend.generate_url) as resp:
+                            resp.raise_for_status()
+
+            self.assertTrue(broken.is_open)
+            self.assertEqual(broken.in_flight, 0)
+            self.assertIs(await router.select("test-model"), healthy)
+            self.assertEqual(failing["calls"], 2)
+
+            # После таймаута сервер проверяется через /api/tags в фоне и возвращается
+            broken.opened_at -= 60
+            self.assertIs(await router.select("test-model"), healthy)
+            await broken._probe
+            self.assertFalse(broken.is_open)
+            self.assertIs(await router.select("test-model"), broken)
+
+    async def test_model_names_normalized(self):
+        """Тест сравнения имени модели без тега с именами из /api/tags"""
+        app = make_ollama_app([], models=("llama3:latest", "qwen:7b"))
+        async with running_servers(app) as urls:
+            router = OllamaRouter(urls)
+
+            self.assertEqual((await router.select("llama3")).url, urls[0])
+            self.assertEqual((await router.select("qwen:7b")).url, urls[0])
+            with self.assertRaises(NoBackendAvailable):
+                await router.select("qwen")
+
+    async def test_stale_models_refreshed_in_background(self):
+        """Тест выбора по устаревшему списку моделей без ожидания /api/tags"""
+        app = make_ollama_app([])
+        async with running_servers(app) as urls:
+            router = OllamaRouter(urls, models_refresh_interval=60)
+            backend = await router.select("test-model")
+            backend.models_checked_at -= 60
+            backend.models = {"test-model:latest"}
+
+            with mock.patch.object(router, "_fetch_models", mock.AsyncMock()) as fetch:
+                self.assertIs(await router.select("test-model"), backend)
+                # Проверка запущена, но выбор ее не ждал
+                self.assertFalse(backend._probe.done())
+                await backend._probe
+            fetch.assert_awaited_once_with(backend)
+
+    async def test_unreachable_backend_opens_circuit(self):
+        """Тест отключения недоступного сервера по проверке здоровья"""
+        async with running_servers(make_ollama_app([])) as (url,):
+            router = OllamaRouter(["http://127.0.0.1:9", url], failure_threshold=1)
+
+            backend = await router.select("test-model")
+
+            self.assertEqual(backend.url, url)
+            self.assertTrue(router.backends[0].is_open)
+
+
+class ThinkSplitterTests(SimpleTestCase):
+    """Тесты потокового разбора тегов рассуждений"""
+
+    def split(self, tokens):
+        splitter = ThinkSplitter()
+        segments = []
+        for token in tokens:
+            segments.extend(splitter.feed(token))
+        segments.extend(splitter.close())
+        thinking = "".join(text for is_thinking, text in segments if is_thinking)
+        answer = "".join(text for is_thinking, text in segments if not is_thinking)
+        return thinking, answer
+
+    def test_tags_split_at_every_character(self):
+        """Тест тегов, разрезанных на отдельные символы"""
+        text = "<think>abc</think>\n\nОтвет <b>"
+        self.assertEqual(self.split(list(text)), ("abc", "Ответ <b>"))
+
+    def test_answer_without_thinking(self):
+        """Тест ответа без рассуждений и угловой скобки в конце"""
+        self.assertEqual(self.split(["a < b", " и c <"]), ("", "a < b и c <"))
+
+    def test_unclosed_thinking(self):
+        """Тест генерации, оборвавшейся внутри рассуждения"""
+        self.assertEqual(
+            self.split(["<think>долго", " думаю</th"]), ("долго думаю</th", "")
+        )
+
+
+class TokenCoalescerTests(SimpleTestCase):
+    """Тесты склейки токенов в чанки"""
+
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, chunk):
+        self.sent.append(chunk)
+
+    async def test_first_token_sent_immediately(self):
+        """Тест немедленной отправки первого токена"""
+        coalescer = TokenCoalescer(self.send, interval_ms=1000, max_bytes=1024)
+        await coalescer.add("Привет")
+        self.assertEqual(self.sent, ["Привет"])
+        await coalescer.add(",")
+        await coalescer.add(" мир")
+        self.assertEqual(len(self.sent), 1)
+        await coalescer.close()
+        self.assertEqual(self.sent, ["Привет", ", мир"])
+
+    async def test_flush_by_size(self):
+        """Тест отправки чанка при переполнении буфера"""
+        coalescer = TokenCoalescer(self.send, interval_ms=1000, max_bytes=4)
+        for token in ["a", "b", "c", "d", "e", "f"]:
+            await coalescer.add(token)
+        self.assertEqual(self.sent, ["a", "bcde"])
+        await coalescer.close()
+        self.assertEqual("".join(self.sent), "abcdef")
+
+    async def test_flush_by_time(self):
+        """Тест отправки чанка по истечении окна времени"""
+        coalescer = TokenCoalescer(self.send, interval_ms=10, max_bytes=1024)
+        await coalescer.add("a")
+        await coalescer.add("b")
+        await coalescer.add("c")
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, ["a", "bc"])
+        await coalescer.close()
+        self.assertEqual(coalescer.messages_sent, 2)
+
+    async def test_message_count_drops(self):
+        """Тест сокращения числа сообщений на длинном ответе"""
+        coalescer = TokenCoalescer(self.send, interval_ms=1000, max_bytes=64)
+        for _ in range(1000):
+            await coalescer.add("tok ")
+        await coalescer.close()
+        self.assertEqual("".join(self.sent), "tok " * 1000)
+        self.assertLessEqual(coalescer.messages_sent, 100)
+
+
+class GenerationRegistryTests(SimpleTestCase):
+    """Тесты локальной части реестра генераций"""
+
+    async def test_cancel_local_task(self):
+        """Тест отмены генерации, которую ведет этот воркер"""
+        task = asyncio.ensure_future(asyncio.sleep(10))
+        token = CancelToken()
+        token.bind(task)
+        GenerationRegistry._register_local("chat-1", token)
+        try:
+            self.assertTrue(GenerationRegistry._cancel_local("chat-1"))
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertTrue(token.is_cancelled)
+            self.assertFalse(GenerationRegistry._cancel_local("chat-1"))
+        finally:
+            GenerationRegistry._unregister_local("chat-1", token)
+        self.assertNotIn("chat-1", GenerationRegistry._local_tokens)
+
+    def test_cancel_unknown_chat(self):
+        """Тест отмены генерации, которой нет на этом воркере"""
+        self.assertFalse(GenerationRegistry._cancel_local("missing"))
+
+    @override_settings(AI_GENERATION_LEASE_TTL=0.03)
+    async def test_lost_lease_cancels_generation(self):
+        """Тест остановки генерации, чью аренду не удалось продлить"""
+        redis = FakeRedis()
+        token = CancelToken()
+        lease = GenerationLease("chat-lost", "worker:1:abc")
+        with mock.patch("chatbot.registry.get_redis", return_value=redis.aio):
+            lease.start(token)
+            try:
+                await asyncio.sleep(0.05)
+            finally:
+                await lease.release()
+
+        self.assertTrue(token.is_cancelled)
+        self.assertEqual(token.reason, "lease_lost")
+
+    async def test_failed_acquire_reports_not_started(self):
+        """Тест: генерация без аренды сообщает клиенту, что не стартовала"""
+        redis = FakeRedis()
+        redis.set("chatbot:generation:chat-busy", "other:1:abc")
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        scheduler = GenerationScheduler.for_loop()
+        ticket = scheduler.reserve("u1", "chat-busy")
+
+        with mock.patch("chatbot.registry.get_redis", return_value=redis.aio):
+            result = await run_generation(
+                ticket=ticket,
+                chat_id="chat-busy",
+                prompt="Привет",
+                channel_layer=channel_layer,
+            )
+
+        self.assertIsNone(result)
+        event = channel_layer.group_send.await_args.args[1]
+        self.assertEqual(event["type"], "ai_complete")
+        self.assertEqual(event["reason"], "busy")
+        self.assertTrue(ticket.released)
+
+    async def test_scheduler_error_releases_lease(self):
+        """Тест: сбой планировщика снимает аренду и сообщает клиенту"""
+        redis = FakeRedis()
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+
+        with (
+            mock.patch("chatbot.registry.get_redis", return_value=redis.aio),
+            mock.patch.object(
+                GenerationScheduler, "reserve", side_effect=RuntimeError("boom")
+            ),
+        ):
+            result = await run_generation(
+                chat_id="chat-err", prompt="Привет", channel_layer=channel_layer
+            )
+
+        self.assertIsNone(result)
+        self.assertIsNone(redis.get("chatbot:generation:chat-err"))
+        self.assertNotIn("chat-err", GenerationRegistry._local_tokens)
+        event = channel_layer.group_send.await_args.args[1]
+        self.assertEqual(event["reason"], "failed")
+
+
+@override_settings(AI_GENERATION_MODE="celery")
+class CeleryGenerationModeTests(SimpleTestCase):
+    """Тесты генерации на воркерах Celery"""
+
+    def make_lease(self):
+        return mock.Mock(
+            token="web:1:abc",
+            hand_off=mock.AsyncMock(return_value=True),
+            release=mock.AsyncMock(),
+        )
+
+    async def test_consumer_enqueues_generation(self):
+        """Тест постановки генерации в очередь с передачей аренды"""
+        lease = self.make_lease()
+        scheduler = GenerationScheduler.for_loop()
+        ticket = scheduler.reserve("u1", "chat-1")
+
+        with mock.patch.object(generate_ai_response, "apply_async") as apply_async:
+            future = submit_generation(
+                chat_id="chat-1",
+                prompt="Привет",
+                lease=lease,
+                ticket=ticket,
+                user_id="u1",
+            )
+            await future
+
+        lease.hand_off.assert_awaited_once_with(300)
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.kwargs["queue"], "generation")
+        task_kwargs = apply_async.call_args.kwargs["kwargs"]
+        self.assertEqual(task_kwargs["lease_token"], "web:1:abc")
+        self.assertEqual(task_kwargs["prompt"], "Привет")
+        # Место в локальной очереди возвращено: генерацию ведет воркер
+        self.assertEqual(scheduler.active, 0)
+        lease.release.assert_not_awaited()
+
+    async def test_enqueue_failure_releases_lease(self):
+        """Тест снятия аренды и ответа клиенту, если брокер недоступен"""
+        lease = self.make_lease()
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_chat-2", channel_name)
+
+        with mock.patch.object(
+            generate_ai_response, "apply_async", side_effect=ConnectionError("down")
+        ):
+            await submit_generation(chat_id="chat-2", prompt="Привет", lease=lease)
+
+        lease.release.assert_awaited_once()
+        event = await asyncio.wait_for(channel_layer.receive(channel_name), 1)
+        self.assertEqual(event["type"], "ai_complete")
+        self.assertEqual(event["message_id"], "failed")
+        await channel_layer.group_discard("chat_chat-2", channel_name)
+
+    async def test_cancel_before_worker_picks_task(self):
+        """Тест отмены, пока задача ждет воркера в брокере"""
+        redis = FakeRedis()
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+
+        with mock.patch("chatbot.registry.get_redis", return_value=redis.aio):
+            lease = await GenerationRegistry.acquire("chat-5")
+            await lease.hand_off(300)
+            # Задача еще в брокере: слушателя отмен на воркере нет
+            await GenerationRegistry.cancel("chat-5")
+
+            adopted = await GenerationRegistry.adopt("chat-5", lease.token)
+            result = await run_generation(
+                lease=adopted,
+                chat_id="chat-5",
+                prompt="Привет",
+                channel_layer=channel_layer,
+            )
+            await GenerationRegistry.stop_listener()
+
+        self.assertIsNone(result)
+        event = channel_layer.group_send.await_args.args[1]
+        self.assertEqual(event["reason"], "cancelled")
+        self.assertIsNone(redis.get("chatbot:generation:chat-5"))
+
+    def test_worker_adopts_lease(self):
+        """Тест воркера: аренда подхватывается по токену из задачи"""
+        lease = self.make_lease()
+        with (
+            mock.patch.object(
+                GenerationRegistry, "adopt", mock.AsyncMock(return_value=lease)
+            ) as adopt,
+            mock.patch(
+                "chatbot.consumers.run_generation", mock.AsyncMock(return_value=None)
+            ) as run,
+        ):
+            generate_ai_response(
+                chat_id="chat-3", prompt="Привет", lease_token="web:1:abc", user_id="u1"
+            )
+
+        adopt.assert_awaited_once_with("chat-3", "web:1:abc")
+        self.assertIs(run.call_args.kwargs["lease"], lease)
+        self.assertEqual(run.call_args.kwargs["user_id"], "u1")
+        self.assertIsNone(run.call_args.kwargs["channel_layer"])
+
+    def test_worker_tasks_share_process_state(self):
+        """Тест задач воркера: планировщики loop не копятся, роутер и лимиты общие"""
+        seen = []
+
+        async def fake_run(**kwargs):
+            GenerationScheduler.for_loop()
+            seen.append(
+                (OllamaRouter.shared(), AdaptiveConcurrencyLimit.for_model("m"))
+            )
+
+        before = len(GenerationScheduler._instances)
+        with mock.patch("chatbot.consumers.run_generation", fake_run):
+            for _ in range(3):
+                generate_ai_response(chat_id="chat-4", prompt="Привет")
+
+        self.assertEqual(len(GenerationScheduler._instances), before)
+        self.assertEqual(len(set(seen)), 1)
+
+
+class GenerationDbPoolTests(SimpleTestCase):
+    """Тесты пула соединений БД генераций"""
+
+    def setUp(self):
+        shutdown_db_executor()
+        self.addCleanup(shutdown_db_executor)
+
+    def make_connection(self, **attrs):
+        conn = mock.Mock(
+            alias="default",
+            connection=object(),
+            in_atomic_block=False,
+            errors_occurred=False,
+        )
+        conn.configure_mock(**attrs)
+        return conn
+
+    @override_settings(AI_DB_POOL_SIZE=2)
+    async def test_pool_caps_concurrency(self):
+        """Тест ограничения одновременных запросов размером пула"""
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0, "threads": set()}
+
+        @generation_db
+        def query():
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+                state["threads"].add(threading.current_thread().name)
+            time.sleep(0.02)
+            with lock:
+                state["running"] -= 1
+
+        await asyncio.gather(*(query() for _ in range(6)))
+
+        self.assertEqual(state["peak"], 2)
+        self.assertTrue(all(name.startswith("ai_db") for name in state["threads"]))
+
+    @override_settings(AI_DB_CONN_MAX_AGE=300)
+    def test_release_keeps_healthy_and_closes_broken(self):
+        """Тест переиспользования живых и закрытия сломанных соединений"""
+        healthy = self.make_connection()
+        broken = self.make_connection(errors_occurred=True)
+        broken.is_usable.return_value = False
+        in_transaction = self.make_connection(in_atomic_block=True)
+        expired = self.make_connection()
+        for conn in (healthy, broken, in_transaction, expired):
+            _track_connection(None, conn)
+        _connections[expired].opened_at -= 600
+
+        with mock.patch("chatbot.db.connections") as conns:
+            conns.all.return_value = [healthy, broken, in_transaction, expired]
+            release_connections()
+
+        healthy.close.assert_not_called()
+        broken.close.assert_called_once()
+        in_transaction.close.assert_called_once()
+        expired.close.assert_called_once()
+
+    def test_open_connections_metric(self):
+        """Тест подсчета открытых соединений по пулам"""
+        before = open_connections("other")
+        conn = self.make_connection()
+        _track_connection(None, conn)
+        self.assertEqual(open_connections("other"), before + 1)
+
+        conn.connection = None
+        self.assertEqual(open_connections("other"), before)
+
+
+class GenerationSchedulerTests(SimpleTestCase):
+    """Тесты очереди допуска генераций"""
+
+    async def test_concurrency_limit(self):
+        """Тест ограничения числа одновременных генераций"""
+        scheduler = GenerationScheduler(max_concurrency=1)
+        first = scheduler.reserve("u1")
+        second = scheduler.reserve("u2")
+
+        self.assertTrue(first.admitted.done())
+        self.assertFalse(second.admitted.done())
+        self.assertEqual(scheduler.queued, 1)
+
+        scheduler.release(first)
+        await asyncio.wait_for(scheduler.wait(second), 1)
+        self.assertEqual(scheduler.active, 1)
+        self.assertEqual(scheduler.queued, 0)
+
+    async def test_active_and_saturation_metrics(self):
+        """Тест метрик активных генераций и занятости слотов модели"""
+        scheduler = GenerationScheduler(max_concurrency=4)
+        labels = {"model": "gauge-model"}
+        before = REGISTRY.get_sample_value("chatbot_generation_active", labels) or 0
+
+        ticket = scheduler.reserve("u1", model="gauge-model")
+        self.assertEqual(
+            REGISTRY.get_sample_value("chatbot_generation_active", labels), before + 1
+        )
+        self.assertEqual(
+            REGISTRY.get_sample_value("chatbot_generation_saturation", labels), 0.5
+        )
+
+        scheduler.release(ticket)
+        self.assertEqual(
+            REGISTRY.get_sample_value("chatbot_generation_active", labels), before
+        )
+        self.assertEqual(
+            REGISTRY.get_sample_value("chatbot_generation_saturation", labels), 0
+        )
+
+    async def test_round_robin_between_users(self):
+        """Тест справедливого чередования пользователей"""
+        scheduler = GenerationScheduler(max_concurrency=1)
+        running = scheduler.reserve("busy")
+        busy = [scheduler.reserve("heavy") for _ in range(3)]
+        light = scheduler.reserve("light")
+
+        order = []
+        for _ in range(4):
+            scheduler.release(running)
+            running = next(
+                t for t in busy + [light] if t.admitted.done() and t not in order
+            )
+            order.append(running)
+
+        self.assertEqual(order, [busy[0], light, busy[1], busy[2]])
+
+    def test_queue_limits(self):
+        """Тест отказа при переполнении очереди"""
+
+        async def scenario():
+            scheduler = GenerationScheduler(
+                max_concurrency=0, max_queue_depth=3, max_queued_per_user=2
+            )
+            scheduler.reserve("u1")
+            scheduler.reserve("u1")
+            with self.assertRaises(QueueFullError):
+                scheduler.reserve("u1")
+            scheduler.reserve("u2")
+            with self.assertRaises(QueueFullError):
+                scheduler.reserve("u3")
+            return scheduler.queued
+
+        self.assertEqual(async_to_sync(scenario)(), 3)
+
+    async def test_cancel_waiting_ticket(self):
+        """Тест отмены ожидающей генерации"""
+        scheduler = GenerationScheduler(max_concurrency=0)
+        ticket = scheduler.reserve("u1")
+        waiter = asyncio.ensure_future(scheduler.wait(ticket))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(scheduler.queued, 0)
+        self.assertEqual(scheduler.active, 0)
+
+    async def test_per_model_limit(self):
+        """Тест лимита модели: тяжелая модель не занимает слоты легкой"""
+        scheduler = GenerationScheduler(max_concurrency=10)
+        scheduler.limit_for("big").limit = 1
+
+        running = scheduler.reserve("u1", model="big")
+        waiting = scheduler.reserve("u1", model="big")
+        small = scheduler.reserve("u1", model="small")
+
+        self.assertTrue(running.admitted.done())
+        self.assertFalse(waiting.admitted.done())
+        self.assertTrue(small.admitted.done())
+
+        scheduler.release(running)
+        self.assertTrue(waiting.admitted.done())
+
+    async def test_queue_position_events(self):
+        """Тест рассылки позиций в очереди"""
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_c2", channel_name)
+
+        scheduler = GenerationScheduler(max_concurrency=1, channel_layer=channel_layer)
+        first = scheduler.reserve("u1", "c1")
+        scheduler.reserve("u1", "c1")
+        scheduler.reserve("u2", "c2")
+
+        event = await asyncio.wait_for(channel_layer.receive(channel_name), 1)
+        self.assertEqual(
+            event, {"type": "queue_position", "chat_id": "c2", "position": 2}
+        )
+
+        # Первый пользователь освободил слот - второй продвигается к началу
+        scheduler.release(first)
+        event = await asyncio.wait_for(channel_layer.receive(channel_name), 1)
+        self.assertEqual(event["position"], 1)
+
+
+class ContextInvalidationTests(TestCase):
+    """Тесты сброса контекста Ollama при изменении сообщений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="ctxuser", password="pass123")
+        self.chat = Chat.objects.create(owner=self.user, name="Контекст")
+
+    @override_settings(AI_CONTEXT_REUSE=True)
+    def test_invalidate_on_edit_and_delete(self):
+        """Тест сброса контекста при редактировании и удалении"""
+        with mock.patch.object(ConversationContextCache, "invalidate_sync") as inv:
+            message = Message.objects.create(chat=self.chat, content="Привет")
+            inv.assert_not_called()
+
+            message.content = "Привет!"
+            message.is_edited = True
+            message.save()
+            inv.assert_called_once_with(str(self.chat.id))
+
+            message.delete()
+            self.assertEqual(inv.call_count, 2)
+
+
+class FakeResults(list):
+    """Результат execute, который можно и вернуть, и дождаться через await."""
+
+    def __await__(self):
+        yield from ()
+        return self
+
+
+class FakeRedis:
+    """
+    Redis в памяти с командами, которые использует чат-бот.
+
+    Методы синхронные, как у redis.Redis; асинхронный клиент - атрибут aio.
+    Lua-скрипты модулей чат-бота эмулируются обработчиками из SCRIPTS.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.zsets = {}
+        self.streams = {}
+        self.counter = 0
+        self.aio = FakeAsyncRedis(self)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, *keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value)
+        return True
+
+    def getdel(self, key):
+        return self.values.pop(key, None)
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, 0)) + 1)
+        return int(self.values[key])
+
+    def ttl(self, key):
+        return 60 if key in self.values else -2
+
+    def exists(self, key):
+        return int(self.type(key) is not None)
+
+    def type(self, key):
+        for kind in ("values", "sets", "zsets", "streams"):
+            if key in getattr(self, kind):
+                return kind
+        return None
+
+    def expire(self, key, ttl):
+        return self.exists(key)
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            for kind in ("values", "sets", "zsets", "streams"):
+                deleted += getattr(self, kind).pop(key, None) is not None
+        return deleted
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return set(self.sets.get(key, ()))
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        return int(self.zsets.get(key, {}).pop(member, None) is not None)
+
+    def zcount(self, key, low, high):
+        low = float(str(low).lstrip("("))
+        return sum(1 for score in self.zsets.get(key, {}).values() if score > low)
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.zsets.get(key, {})
+        for member, score in list(members.items()):
+            if score <= high:
+                del members[member]
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        self.counter += 1
+        entry_id = f"{self.counter}-0"
+        entries = self.streams.setdefault(key, [])
+        entries.append((entry_id, fields))
+        if maxlen is not None:
+            del entries[:-maxlen]
+        return entry_id
+
+    def xrange(self, key, min="-", max="+"):
+        after = parse_offset(min[1:]) if min.startswith("(") else (0, -1)
+        return [
+            (entry_id, fields)
+            for entry_id, fields in self.streams.get(key, [])
+            if parse_offset(entry_id) > after
+        ]
+
+    def xrevrange(self, key, max="+", min="-", count=None):
+        return list(reversed(self.streams.get(key, [])))[:count]
+
+    def xread(self, streams, block=None):
+        [(key, offset)] = streams.items()
+        if offset == "$":
+            return []
+        entries = self.xrange(key, min=f"({offset}")
+        return [(key, entries)] if entries else []
+
+    def publish(self, channel, message):
+        return 0
+
+    def eval(self, script, numkeys, *args):
+        return self.SCRIPTS[script](self, args[:numkeys], args[numkeys:])
+
+    def _store(self, keys, argv):
+        if (self.values.get(keys[1]) or "0") != str(argv[0]):
+            return 0
+        self.values[keys[0]] = argv[1]
+        return 1
+
+    def _invalidate(self, keys, argv):
+        self.delete(keys[0], keys[2])
+        self.incr(keys[1])
+        return 1
+
+    def _acquire(self, keys, argv):
+        if not self.set(keys[0], argv[0], px=argv[1], nx=True):
+            return 0
+        self.delete(keys[1])
+        return 1
+
+    def _renew(self, keys, argv):
+        return int(self.values.get(keys[0]) == argv[0])
+
+    def _release(self, keys, argv):
+        if self.values.get(keys[0]) != argv[0]:
+            return 0
+        return self.delete(keys[0])
+
+    SCRIPTS = {
+        context._STORE_SCRIPT: _store,
+        context._INVALIDATE_SCRIPT: _invalidate,
+        registry._ACQUIRE_SCRIPT: _acquire,
+        registry._RENEW_SCRIPT: _renew,
+        registry._RELEASE_SCRIPT: _release,
+    }
+
+
+class FakeAsyncRedis:
+    """Асинхронный интерфейс FakeRedis, как у redis.asyncio.Redis."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def pipeline(self, transaction=True):
+        return self.redis.pipeline(transaction)
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+
+        return call
+
+
+class FakePipeline:
+    """Pipeline FakeRedis: команды выполняются сразу, execute отдает результаты."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.results = FakeResults()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.results.append(command(*args, **kwargs))
+
+    def execute(self):
+        return self.results
+
+
+class DraftCheckpointTests(TestCase):
+    """Тесты черновиков частичных ответов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="draftuser", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="Черновик")
+        self.chat_id = str(self.chat.id)
+
+    async def test_checkpoints_every_n_tokens(self):
+        """Тест записи черновика каждые N токенов и финального UPDATE"""
+        checkpointer = DraftCheckpointer(self.chat_id, every_tokens=2, interval=60)
+        response = ""
+        for token in ("a", "b", "c", "d"):
+            response += token
+            checkpointer.on_token(response)
+            await checkpointer._wait_pending()
+
+        self.assertEqual(checkpointer.checkpoints, 2)
+        draft = await Message.objects.aget(id=checkpointer.message_id)
+        self.assertTrue(draft.is_draft)
+        self.assertEqual(draft.content, "abcd")
+
+        message_id = await checkpointer.finalize("abcde")
+        self.assertEqual(message_id, checkpointer.message_id)
+        message = await Message.objects.aget(id=message_id)
+        self.assertFalse(message.is_draft)
+        self.assertEqual(message.content, "abcde")
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 1)
+
+    async def test_short_answer_single_insert(self):
+        """Тест ответа короче первой контрольной точки"""
+        checkpointer = DraftCheckpointer(self.chat_id, every_tokens=100, interval=60)
+        checkpointer.on_token("ok")
+
+        message_id = await checkpointer.finalize("ok")
+
+        self.assertEqual(checkpointer.checkpoints, 0)
+        message = await Message.objects.aget(id=message_id)
+        self.assertFalse(message.is_draft)
+
+    async def test_close_after_error_keeps_partial(self):
+        """Тест закрытия черновика при обрыве генерации"""
+        checkpointer = DraftCheckpointer(self.chat_id, every_tokens=1, interval=60)
+        checkpointer.on_token("час")
+        await checkpointer.close("частичный")
+
+        message = await Message.objects.aget(id=checkpointer.message_id)
+        self.assertFalse(message.is_draft)
+        self.assertEqual(message.content, "частичный")
+
+    async def test_finalize_updates_chat_preview(self):
+        """Тест превью чата: черновик заменяется окончательным ответом"""
+        checkpointer = DraftCheckpointer(self.chat_id, every_tokens=1, interval=60)
+        checkpointer.on_token("на")
+        await checkpointer._wait_pending()
+        await checkpointer.finalize("начало и конец")
+
+        chat = await Chat.objects.aget(id=self.chat_id)
+        self.assertEqual(chat.message_count, 1)
+        self.assertEqual(chat.last_message_preview, "начало и конец")
+
+    def test_finalize_orphaned_drafts(self):
+        """Тест закрытия брошенных черновиков без живой аренды"""
+        live_chat = Chat.objects.create(owner=self.user, name="Идет генерация")
+        orphan = Message.objects.create(chat=self.chat, content="x", is_draft=True)
+        live = Message.objects.create(chat=live_chat, content="y", is_draft=True)
+        fresh = Message.objects.create(chat=self.chat, content="z", is_draft=True)
+        old = timezone.now() - timedelta(minutes=5)
+        Message.objects.filter(id__in=[orphan.id, live.id]).update(updated_at=old)
+
+        redis = mock.Mock()
+        redis.exists.side_effect = lambda key: str(live_chat.id) in key
+        with mock.patch("chatbot.redis_client.get_sync_redis", return_value=redis):
+            self.assertEqual(finalize_orphaned_drafts(stale_after=60), 1)
+
+        orphan.refresh_from_db()
+        live.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertFalse(orphan.is_draft)
+        self.assertTrue(live.is_draft)
+        self.assertTrue(fresh.is_draft)
+
+    def test_finalized_orphan_refreshes_chat_preview(self):
+        """Тест: закрытый брошенный черновик попадает в превью чата"""
+        draft = create_message(chat=self.chat, content="нача", is_draft=True)
+        # Последний чекпоинт дописал ответ одним UPDATE, превью осталось старым
+        Message.objects.filter(id=draft.id).update(
+            content="начало ответа", updated_at=timezone.now() - timedelta(minutes=5)
+        )
+
+        redis = mock.Mock(exists=mock.Mock(return_value=False))
+        with mock.patch("chatbot.redis_client.get_sync_redis", return_value=redis):
+            self.assertEqual(finalize_orphaned_drafts(stale_after=60), 1)
+
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_preview, "начало ответа")
+        self.assertEqual(self.chat.last_message_at, draft.created_at)
+
+
+class SaveUserMessageTests(TestCase):
+    """Тесты записи сообщения пользователя"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="writer", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="Запись")
+
+    def test_insert_marks_chat_activity(self):
+        """Тест вставки сообщения с отметкой активности чата"""
+        before = self.chat.updated_at
+
+        message = save_user_message(str(self.chat.id), self.user, "Привет")
+
+        saved = Message.objects.get(id=message.id)
+        self.assertEqual(saved.content, "Привет")
+        self.assertEqual(saved.sender, self.user)
+        self.chat.refresh_from_db()
+        self.assertGreater(self.chat.updated_at, before)
+        self.assertEqual(self.chat.last_message_at, saved.created_at)
+        self.assertEqual(self.chat.message_count, 1)
+        self.assertEqual(self.chat.last_message_preview, "Привет")
+
+    def test_create_message_updates_chat_activity(self):
+        """Тест счетчика и превью чата при создании сообщения"""
+        save_user_message(str(self.chat.id), self.user, "Первое")
+        message = create_message(chat=self.chat, content="Второе\n  сообщение")
+
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.message_count, 2)
+        self.assertEqual(self.chat.last_message_at, message.created_at)
+        self.assertEqual(self.chat.last_message_preview, "Второе сообщение")
+
+    def test_preview_truncated(self):
+        """Тест обрезки длинного превью"""
+        save_user_message(str(self.chat.id), self.user, "x" * 1000)
+
+        self.chat.refresh_from_db()
+        self.assertEqual(len(self.chat.last_message_preview), PREVIEW_LENGTH)
+
+    def test_foreign_chat_rejected(self):
+        """Тест отказа в записи в чужой чат"""
+        stranger = User.objects.create_user(username="stranger", password="pass")
+
+        with self.assertRaises(ChatAccessDenied):
+            save_user_message(str(self.chat.id), stranger, "Привет")
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+
+    async def test_consumer_saves_message_and_starts_generation(self):
+        """Тест приема сообщения консьюмером без блокировки чата"""
+        lease = mock.Mock(release=mock.AsyncMock())
+        with (
+            mock.patch.object(
+                GenerationRegistry, "acquire", mock.AsyncMock(return_value=lease)
+            ),
+            mock.patch.object(
+                GenerationRegistry, "is_generating", mock.AsyncMock(return_value=False)
+            ),
+            mock.patch.object(GenerationRegistry, "cancel", mock.AsyncMock()),
+            mock.patch("chatbot.consumers.submit_generation") as submit,
+        ):
+            communicator = await connect_consumer(self.user, str(self.chat.id))
+            try:
+                await receive_json(communicator)
+                await communicator.send_input(
+                    {"type": "websocket.receive", "text": json.dumps({"message": "Hi"})}
+                )
+                echo = await receive_json(communicator)
+            finally:
+                await communicator.send_input(
+                    {"type": "websocket.disconnect", "code": 1000}
+                )
+                await communicator.wait(1)
+
+        self.assertEqual(echo["type"], "user_message")
+        message = await Message.objects.aget(id=echo["message_id"])
+        self.assertEqual(message.content, "Hi")
+        submit.assert_called_once()
+        self.assertIs(submit.call_args.kwargs["lease"], lease)
+
+
+class GracefulDrainTests(TestCase):
+    """Тесты плавной остановки процесса с идущими генерациями"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="drain", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="Остановка")
+        self.addCleanup(consumers._DRAINING.clear)
+        patcher = mock.patch("chatbot.consumers.shutdown_ai_executor")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_drain_waits_for_generations(self):
+        """Тест ожидания генераций, успевающих к дедлайну"""
+        task = _track(asyncio.ensure_future(asyncio.sleep(0.05, result="done")))
+
+        await drain_generations(timeout=1)
+
+        self.assertTrue(consumers.is_draining())
+        self.assertEqual(task.result(), "done")
+
+    async def test_drain_interrupts_after_deadline(self):
+        """Тест прерывания генерации с причиной shutdown после дедлайна"""
+        token = CancelToken()
+        GenerationRegistry._register_local(str(self.chat.id), token)
+        self.addCleanup(GenerationRegistry._unregister_local, str(self.chat.id), token)
+
+        async def generation():
+            stream = asyncio.ensure_future(asyncio.sleep(10))
+            token.bind(stream)
+            try:
+                await stream
+            except asyncio.CancelledError:
+                return token.reason
+
+        task = _track(asyncio.ensure_future(generation()))
+
+        await drain_generations(timeout=0.05)
+
+        self.assertEqual(task.result(), "shutdown")
+
+    async def test_drain_sees_task_not_yet_started(self):
+        """Тест: задача учитывается сразу при создании, до первого шага"""
+        task = _track(asyncio.ensure_future(asyncio.sleep(0.05, result="done")))
+
+        await drain_generations(timeout=1)
+
+        self.assertEqual(task.result(), "done")
+
+    def test_sigterm_starts_draining(self):
+        """Тест: SIGTERM переводит процесс в остановку до lifespan.shutdown"""
+        server_handler = mock.Mock()
+        previous = signal.signal(signal.SIGTERM, server_handler)
+        self.addCleanup(signal.signal, signal.SIGTERM, previous)
+
+        consumers.install_drain_signal()
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+
+        self.assertTrue(consumers.is_draining())
+        server_handler.assert_called_once_with(signal.SIGTERM, None)
+
+    async def test_consumer_refuses_while_draining(self):
+        """Тест отказа в новых генерациях и подключениях при остановке"""
+        with mock.patch.object(
+            GenerationRegistry, "is_generating", mock.AsyncMock(return_value=False)
+        ):
+            communicator = await connect_consumer(self.user, str(self.chat.id))
+            await receive_json(communicator)
+            consumers._DRAINING.set()
+            await communicator.send_input(
+                {"type": "websocket.receive", "text": json.dumps({"message": "Hi"})}
+            )
+            error = await receive_json(communicator)
+            closed = await communicator.receive_output(1)
+            await communicator.wait(1)
+
+            rejected = ApplicationCommunicator(
+                ServiceChatConsumer.as_asgi(),
+                {
+                    "type": "websocket",
+                    "path": f"/ws/chat/{self.chat.id}/",
+                    "user": self.user,
+                    "url_route": {"kwargs": {"chat_id": str(self.chat.id)}},
+                },
+            )
+            await rejected.send_input({"type": "websocket.connect"})
+            refused = await rejected.receive_output(1)
+
+        self.assertEqual(error["code"], "draining")
+        self.assertEqual(closed, {"type": "websocket.close", "code": 1012})
+        self.assertEqual(refused["type"], "websocket.close")
+        self.assertFalse(await Message.objects.filter(chat=self.chat).aexists())
+
+    async def test_lifespan_shutdown_drains(self):
+        """Тест lifespan.shutdown: процесс дожидается генераций"""
+        communicator = ApplicationCommunicator(LifespanApp(), {"type": "lifespan"})
+        with (
+            mock.patch("chatbot.consumers.drain_generations") as drain,
+            mock.patch("chatbot.db.shutdown_db_executor") as shutdown_db,
+        ):
+            await communicator.send_input({"type": "lifespan.startup"})
+            started = await communicator.receive_output(1)
+            await communicator.send_input({"type": "lifespan.shutdown"})
+            stopped = await communicator.receive_output(1)
+
+        self.assertEqual(started["type"], "lifespan.startup.complete")
+        self.assertEqual(stopped["type"], "lifespan.shutdown.complete")
+        drain.assert_awaited_once()
+        shutdown_db.assert_called_once()
+
+    async def test_view_thread_submits_to_server_loop(self):
+        """Тест: генерация из потока DRF идет в loop, запомненный на startup"""
+        communicator = ApplicationCommunicator(LifespanApp(), {"type": "lifespan"})
+        self.addCleanup(consumers.set_server_loop, None)
+        await communicator.send_input({"type": "lifespan.startup"})
+        await communicator.receive_output(1)
+        loops = []
+
+        async def fake_run(**kwargs):
+            loops.append(asyncio.get_running_loop())
+
+        with mock.patch("chatbot.consumers.run_generation", fake_run):
+            future = await sync_to_async(submit_generation, thread_sensitive=False)(
+                chat_id="chat-1", prompt="Привет"
+            )
+            await asyncio.wrap_future(future)
+
+        self.assertEqual(loops, [asyncio.get_running_loop()])
+
+
+class ChatListTests(TestCase):
+    """Тесты списка чатов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="lister", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_chats(self, count, messages=7):
+        start = Chat.objects.filter(owner=self.user).count()
+        for i in range(start, start + count):
+            chat = Chat.objects.create(owner=self.user, name=f"Чат {i}")
+            for j in range(messages):
+                create_message(chat=chat, content=f"{i}-{j}")
+
+    def list_chats(self):
+        response = self.client.get("/api/v1/chatbot/chats/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def test_latest_messages_limited_and_ordered(self):
+        """Тест последних сообщений каждого чата в списке"""
+        self.make_chats(2)
+
+        chats = self.list_chats()
+
+        self.assertEqual(len(chats), 2)
+        # Сверху чат с самой свежей активностью
+        self.assertEqual(chats[0]["name"], "Чат 1")
+        contents = [m["content"] for m in chats[0]["latest_messages"]]
+        self.assertEqual(contents, ["1-6", "1-5", "1-4", "1-3", "1-2"])
+
+    def test_query_count_independent_of_page_size(self):
+        """Тест постоянного числа запросов при росте страницы"""
+        self.make_chats(2)
+        with CaptureQueriesContext(connection) as small:
+            self.list_chats()
+
+        self.make_chats(10)
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(len(self.list_chats()), 12)
+
+        self.assertEqual(len(large), len(small))
+
+    def test_latest_messages_without_thinking(self):
+        """Тест: рассуждения модели не попадают в список чатов и не читаются"""
+        chat = Chat.objects.create(owner=self.user, name="Рассуждения")
+        create_message(chat=chat, content="ответ", thinking="очень длинно" * 100)
+
+        with CaptureQueriesContext(connection) as queries:
+            chats = self.list_chats()
+
+        self.assertEqual(chats[0]["latest_messages"][0]["content"], "ответ")
+        self.assertNotIn("thinking", chats[0]["latest_messages"][0])
+        message_sql = [q["sql"] for q in queries if "ROW_NUMBER" in q["sql"].upper()]
+        self.assertNotIn("thinking", message_sql[0])
+
+    def test_rename_and_pin_keep_activity(self):
+        """Тест: переименование и закрепление не затирают счетчики активности"""
+        chat = Chat.objects.create(owner=self.user, name="Старое")
+        url = f"/api/v1/chatbot/chats/{chat.id}"
+        with mock.patch("chatbot.views.ChatViewSet.get_object", return_value=chat):
+            # Сообщение пришло, пока запрос держал устаревший объект чата
+            create_message(chat=chat, content="новое")
+            self.client.patch(f"{url}/rename/", {"name": "Новое"}, format="json")
+            self.client.patch(f"{url}/toggle_pin/")
+
+        chat.refresh_from_db()
+        self.assertEqual((chat.name, chat.is_pinned), ("Новое", True))
+        self.assertEqual(chat.message_count, 1)
+
+
+class MessageHistoryTests(TestCase):
+    """Тесты курсорной пагинации истории сообщений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="История")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f"/api/v1/chatbot/chats/{self.chat.id}/messages/"
+        for i in range(7):
+            create_message(chat=self.chat, content=str(i))
+        # Одинаковое время у части сообщений: порядок держится на id
+        Message.objects.filter(content__in=["2", "3", "4"]).update(
+            created_at=Message.objects.get(content="3").created_at
+        )
+        self.expected = [
+            m.content for m in Message.objects.order_by("created_at", "id")
+        ]
+
+    def get(self, url):
+        # Ссылки пагинации уже несут page_size в строке запроса
+        response = self.client.get(url if "?" in url else f"{url}?page_size=3")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def contents(self, page):
+        return [m["content"] for m in page["results"]]
+
+    def test_walks_history_in_both_directions(self):
+        """Тест перехода к старым и обратно к новым сообщениям"""
+        latest = self.get(self.url)
+        self.assertEqual(self.contents(latest), self.expected[4:])
+        self.assertIsNone(latest["next"])
+
+        middle = self.get(latest["previous"])
+        self.assertEqual(self.contents(middle), self.expected[1:4])
+        oldest = self.get(middle["previous"])
+        self.assertEqual(self.contents(oldest), self.expected[:1])
+        self.assertIsNone(oldest["previous"])
+
+        newer = self.get(oldest["next"])
+        self.assertEqual(self.contents(newer), self.expected[1:4])
+        newest = self.get(newer["next"])
+        self.assertEqual(self.contents(newest), self.expected[4:])
+        self.assertIsNone(newest["next"])
+
+    def test_deep_page_without_offset_or_count(self):
+        """Тест страницы из глубины истории без OFFSET и COUNT"""
+        latest = self.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.get(latest["previous"])
+
+        sql = " ".join(q["sql"].upper() for q in queries)
+        self.assertNotIn("OFFSET", sql)
+        self.assertNotIn("COUNT(", sql)
+
+    def test_invalid_cursor(self):
+        """Тест отказа на поврежденный курсор"""
+        response = self.client.get(self.url, {"before": "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(WS_AUTH_CACHE_ENABLED=True)
+class TokenUserCacheTests(TestCase):
+    """Тесты кеша JWT-аутентификации веб-сокетов"""
+
+    def setUp(self):
+        TokenUserCache.clear_local()
+        self.addCleanup(TokenUserCache.clear_local)
+        self.redis = FakeRedis()
+        for target, client in (
+            ("chatbot.auth_cache.get_redis", self.redis.aio),
+            ("chatbot.auth_cache.get_sync_redis", self.redis),
+        ):
+            patcher = mock.patch(target, return_value=client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user(username="socket", password="pass")
+        self.token = AccessToken.for_user(self.user)
+        self.middleware = JWTAuthMiddleware(mock.AsyncMock())
+
+    async def resolve(self, token=None):
+        return await self.middleware.get_user_from_token(str(token or self.token))
+
+    async def test_handshakes_served_from_cache(self):
+        """Тест повторных рукопожатий без обращения к БД"""
+        user = await self.resolve()
+        self.assertEqual(user.id, self.user.id)
+
+        no_db = mock.AsyncMock(side_effect=AssertionError("DB hit"))
+        with mock.patch.object(JWTAuthMiddleware, "fetch_user", no_db):
+            self.assertEqual((await self.resolve()).id, self.user.id)
+            # Другой процесс: локального уровня нет, берем из Redis
+            TokenUserCache.clear_local()
+            cached = await self.resolve()
+
+        self.assertEqual(cached.username, "socket")
+        self.assertTrue(cached.is_authenticated)
+
+    async def test_invalid_token_is_anonymous(self):
+        """Тест рукопожатия с поврежденным токеном"""
+        user = await self.resolve("not-a-token")
+        self.assertTrue(user.is_anonymous)
+
+    async def test_logout_revokes_token(self):
+        """Тест отзыва токена при выходе из системы"""
+        await self.resolve()
+
+        TokenUserCache.revoke_token(
+            str(self.token), self.token["jti"], self.token["exp"]
+        )
+
+        self.assertTrue((await self.resolve()).is_anonymous)
+        other = AccessToken.for_user(self.user)
+        self.assertEqual((await self.resolve(other)).id, self.user.id)
+
+    def test_deactivation_invalidates(self):
+        """Тест сброса кеша при деактивации пользователя"""
+        async_to_sync(self.resolve)()
+
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertTrue(async_to_sync(self.resolve)().is_anonymous)
+
+    def test_blacklist_invalidates(self):
+        """Тест сброса кеша при отзыве refresh-токена"""
+        async_to_sync(self.resolve)()
+        self.assertTrue(self.redis.values)
+
+        RefreshToken.for_user(self.user).blacklist()
+
+        self.assertFalse(self.redis.values)
+        self.assertFalse(TokenUserCache._local)
+
+
+@override_settings(WS_PRESENCE_ENABLED=True)
+class ChatPresenceTests(TestCase):
+    """Тесты присутствия подписчиков чата"""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch("chatbot.presence.get_redis", return_value=self.redis.aio)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username="present", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="Присутствие")
+
+    async def test_join_leave_and_expiry(self):
+        """Тест учета соединений и забывания соединений без heartbeat"""
+        await ChatPresence.join("c1", "ch.a")
+        await ChatPresence.join("c1", "ch.b")
+        self.assertEqual(await ChatPresence.count("c1"), 2)
+
+        await ChatPresence.leave("c1", "ch.a")
+        self.assertEqual(await ChatPresence.count("c1"), 1)
+
+        with override_settings(WS_PRESENCE_TTL=-1):
+            await ChatPresence.join("c1", "ch.b")
+        self.assertEqual(
+            await ServiceChatConsumer.get_active_connections_count("c1"), 0
+        )
+
+    async def test_watcher_reuses_answer(self):
+        """Тест: найденные подписчики запоминаются на интервал, отсутствие - нет"""
+        watcher = PresenceWatcher("c1", interval=60)
+        self.assertFalse(await watcher.has_listeners())
+
+        # Подключившийся сразу после проверки виден следующей проверке
+        await ChatPresence.join("c1", "ch.a")
+        self.assertTrue(await watcher.has_listeners())
+
+        await ChatPresence.leave("c1", "ch.a")
+        self.assertTrue(await watcher.has_listeners())
+        watcher.interval = 0
+        self.assertFalse(await watcher.has_listeners())
+
+    @override_settings(AI_STREAM_RESUME_ENABLED=True)
+    async def test_late_subscriber_gets_fan_out(self):
+        """Тест клиента, подключившегося между чанками чата без подписчиков"""
+        watcher = PresenceWatcher("c1", interval=60)
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+
+        with mock.patch("chatbot.streams.get_redis", return_value=self.redis.aio):
+            first = {"type": "ai_chunk", "chunk": "a", "chat_id": "c1"}
+            await _publish(channel_layer, "chat_c1", "c1", first, presence=watcher)
+
+            # Консьюмер входит в группу и присутствие, затем читает стрим
+            await channel_layer.group_add("chat_c1", channel_name)
+            await ChatPresence.join("c1", channel_name)
+            replayed = await GenerationStream.read_after("c1")
+
+            second = {"type": "ai_chunk", "chunk": "b", "chat_id": "c1"}
+            await _publish(channel_layer, "chat_c1", "c1", second, presence=watcher)
+
+        live = await asyncio.wait_for(channel_layer.receive(channel_name), 1)
+        self.assertEqual([e["chunk"] for e in replayed], ["a"])
+        self.assertEqual(live["chunk"], "b")
+        await channel_layer.group_discard("chat_c1", channel_name)
+
+    async def test_consumer_registers_presence(self):
+        """Тест регистрации соединения консьюмером на время подключения"""
+        chat_id = str(self.chat.id)
+
+        with (
+            mock.patch.object(GenerationRegistry, "cancel", mock.AsyncMock()),
+            mock.patch.object(
+                GenerationRegistry, "is_generating", mock.AsyncMock(return_value=False)
+            ),
+        ):
+            communicator = await connect_consumer(self.user, chat_id)
+            await receive_json(communicator)
+            self.assertEqual(await ChatPresence.count(chat_id), 1)
+
+            await communicator.send_input(
+                {"type": "websocket.disconnect", "code": 1000}
+            )
+            await communicator.wait(1)
+
+        self.assertEqual(await ChatPresence.count(chat_id), 0)
+
+    @override_settings(AI_STREAM_RESUME_ENABLED=True, AI_RESUME_GRACE=0.05)
+    async def test_abandoned_generation_cancelled(self):
+        """Тест: генерация отменяется, если за AI_RESUME_GRACE к чату не вернулись"""
+        chat_id = str(self.chat.id)
+        cancel = mock.AsyncMock()
+        is_generating = mock.AsyncMock(return_value=False)
+
+        with (
+            mock.patch.object(GenerationRegistry, "cancel", cancel),
+            mock.patch.object(GenerationRegistry, "is_generating", is_generating),
+        ):
+            communicator = await connect_consumer(self.user, chat_id)
+            await receive_json(communicator)
+            is_generating.return_value = True
+            await communicator.send_input(
+                {"type": "websocket.disconnect", "code": 1000}
+            )
+            await communicator.wait(1)
+            # Пока идет окно ожидания, переподключение еще может дочитать ответ
+            cancel.assert_not_awaited()
+            await asyncio.sleep(0.1)
+            cancel.assert_awaited_once_with(chat_id)
+
+            # Вернувшийся клиент генерацию сохраняет
+            await ChatPresence.join(chat_id, "ch.back")
+            self.assertFalse(await cancel_if_abandoned(chat_id, grace=0))
+
+
+class WebSocketProtocolTests(TestCase):
+    """Тесты согласования формата кадров веб-сокета"""
+
+    def test_msgpack_frames_are_compact(self):
+        """Тест кодов событий и пропуска пустых полей в бинарных кадрах"""
+        event = {
+            "type": "ai_complete",
+            "message_id": "m1",
+            "chat_id": "c1",
+            "error": None,
+            "cancelled": False,
+            "offset": None,
+        }
+        frame = MsgpackProtocol().encode(event)["bytes_data"]
+        text = JsonProtocol().encode(event)["text_data"]
+
+        self.assertEqual(
+            MsgpackProtocol.unpack_event(frame),
+            {
+                "type": "ai_complete",
+                "message_id": "m1",
+                "chat_id": "c1",
+                "cancelled": False,
+            },
+        )
+        self.assertLess(len(frame), len(text.encode()))
+
+    def test_negotiation(self):
+        """Тест выбора протокола по подпротоколам клиента"""
+        self.assertIsInstance(negotiate(["jwt-token"]), JsonProtocol)
+        self.assertNotIsInstance(negotiate(["jwt-token"]), MsgpackProtocol)
+        self.assertIsInstance(
+            negotiate(["jwt-token", MSGPACK_SUBPROTOCOL]), MsgpackProtocol
+        )
+        with self.assertRaises(ProtocolError):
+            MsgpackProtocol().decode(bytes_data=b"\xc1")
+
+    def test_malformed_msgpack_frames(self):
+        """Тест: кадр не-словарь или с непригодными ключами - ProtocolError"""
+        frames = [
+            msgpack.packb([1, 2]),  # не map
+            msgpack.packb("hello"),
+            b"\x81\x91\x01\x01",  # ключ map - массив
+            b"\x81",  # обрезанный кадр
+        ]
+        for frame in frames:
+            with self.subTest(frame=frame), self.assertRaises(ProtocolError):
+                MsgpackProtocol().decode(bytes_data=frame)
+
+    async def test_middleware_skips_protocol_name(self):
+        """Тест выбора токена среди подпротоколов"""
+        middleware = JWTAuthMiddleware(mock.AsyncMock())
+        scope = {"headers": [], "subprotocols": [MSGPACK_SUBPROTOCOL, "jwt-token"]}
+        with mock.patch.object(
+            JWTAuthMiddleware, "get_user_from_token", mock.AsyncMock()
+        ) as resolve:
+            await middleware(scope, None, None)
+        resolve.assert_awaited_once_with("jwt-token")
+
+    async def test_consumer_speaks_msgpack(self):
+        """Тест бинарного обмена с консьюмером"""
+        user = await database_sync_to_async(User.objects.create_user)(
+            username="binary", password="pass"
+        )
+        chat = await Chat.objects.acreate(owner=user, name="msgpack")
+        lease = mock.Mock(release=mock.AsyncMock())
+        with (
+            mock.patch.object(
+                GenerationRegistry, "acquire", mock.AsyncMock(return_value=lease)
+            ),
+            mock.patch.object(
+                GenerationRegistry, "is_generating", mock.AsyncMock(return_value=False)
+            ),
+            mock.patch.object(GenerationRegistry, "cancel", mock.AsyncMock()),
+            mock.patch("chatbot.consumers.submit_generation"),
+        ):
+            communicator = await connect_consumer(
+                user, str(chat.id), subprotocols=["jwt-token", MSGPACK_SUBPROTOCOL]
+            )
+            try:
+                hello = await communicator.receive_output(1)
+                await communicator.send_input(
+                    {
+                        "type": "websocket.receive",
+                        "bytes": msgpack.packb({"message": "Hi"}),
+                    }
+                )
+                echo = await communicator.receive_output(1)
+            finally:
+                await communicator.send_input(
+                    {"type": "websocket.disconnect", "code": 1000}
+                )
+                await communicator.wait(1)
+
+        self.assertEqual(communicator.subprotocol, MSGPACK_SUBPROTOCOL)
+        hello = MsgpackProtocol.unpack_event(hello["bytes"])
+        self.assertEqual(hello["type"], "connection_established")
+        echo = MsgpackProtocol.unpack_event(echo["bytes"])
+        self.assertEqual(echo["type"], "user_message")
+        self.assertEqual(echo["content"], "Hi")
+
+
+class ChatEventsSSETests(TestCase):
+    """Тесты SSE-эндпоинта генерации чата"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader_sse", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="SSE")
+        self.chat_id = str(self.chat.id)
+        self.token = str(AccessToken.for_user(self.user))
+        self.factory = AsyncRequestFactory()
+        patcher = mock.patch.object(
+            GenerationRegistry, "is_generating", mock.AsyncMock(return_value=False)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, **headers):
+        return self.factory.get(
+            f"/api/v1/chatbot/chats/{self.chat_id}/events/",
+            headers={"Authorization": f"Bearer {self.token}", **headers},
+        )
+
+    @staticmethod
+    async def read_events(response):
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        frames = [
+            f
+            for f in body.decode().split("\n\n")
+            if f.startswith("id:") or f.startswith("event:")
+        ]
+        return [json.loads(f.rsplit("data: ", 1)[1]) for f in frames]
+
+    async def test_requires_token_and_ownership(self):
+        """Тест отказа без токена и для чужого чата"""
+        anonymous = self.factory.get(f"/api/v1/chatbot/chats/{self.chat_id}/events/")
+        self.assertEqual((await chat_events(anonymous, self.chat.id)).status_code, 401)
+
+        stranger = await database_sync_to_async(User.objects.create_user)(
+            username="stranger_sse", password="pass"
+        )
+        self.token = str(AccessToken.for_user(stranger))
+        self.assertEqual(
+            (await chat_events(self.request(), self.chat.id)).status_code, 404
+        )
+
+    @override_settings(AI_STREAM_RESUME_ENABLED=True)
+    async def test_replays_stream_from_last_event_id(self):
+        """Тест дочитывания генерации из стрима по Last-Event-ID"""
+        with mock.patch("chatbot.streams.get_redis", return_value=FakeRedis().aio):
+            first = await GenerationStream.append(
+                self.chat_id,
+                {"type": "ai_chunk", "chunk": "При", "chat_id": self.chat_id},
+            )
+            await GenerationStream.append(
+                self.chat_id,
+                {"type": "ai_chunk", "chunk": "вет", "chat_id": self.chat_id},
+            )
+            await GenerationStream.append(
+                self.chat_id,
+                {"type": "ai_complete", "message_id": "m1", "chat_id": self.chat_id},
+            )
+
+            response = await chat_events(
+                self.request(**{"Last-Event-ID": first}), self.chat.id
+            )
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            events = await self.read_events(response)
+
+        self.assertEqual([e["type"] for e in events], ["ai_chunk", "ai_complete"])
+        self.assertEqual(events[0]["chunk"], "вет")
+        self.assertEqual(events[-1]["message_id"], "m1")
+
+    @override_settings(
+        AI_STREAM_RESUME_ENABLED=True,
+        AI_SSE_IDLE_TIMEOUT=0,
+        AI_SSE_KEEPALIVE_INTERVAL=0,
+    )
+    async def test_finished_generation_not_replayed(self):
+        """Тест подключения без offset после конца генерации: старый ответ не отдается"""
+        with mock.patch("chatbot.streams.get_redis", return_value=FakeRedis().aio):
+            for event_type in ("ai_chunk", "ai_complete"):
+                await GenerationStream.append(
+                    self.chat_id,
+                    {"type": event_type, "chunk": "старый", "message_id": "m1"},
+                )
+
+            response = await chat_events(self.request(), self.chat.id)
+            events = await asyncio.wait_for(self.read_events(response), 1)
+
+        self.assertEqual(events, [])
+
+    async def test_single_use_ticket(self):
+        """Тест подключения по одноразовому билету вместо токена в URL"""
+        redis = FakeRedis()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with (
+            mock.patch("chatbot.sse.get_sync_redis", return_value=redis),
+            mock.patch("chatbot.sse.get_redis", return_value=redis.aio),
+            mock.patch("chatbot.sse._follow_group", return_value=iter(())),
+        ):
+            response = await database_sync_to_async(client.post)(
+                f"/api/v1/chatbot/chats/{self.chat_id}/events/ticket/"
+            )
+            self.assertEqual(response.status_code, 201)
+            ticket = response.json()["ticket"]
+
+            url = f"/api/v1/chatbot/chats/{self.chat_id}/events/"
+            first = await chat_events(
+                self.factory.get(url, {"ticket": ticket}), self.chat.id
+            )
+            again = await chat_events(
+                self.factory.get(url, {"ticket": ticket}), self.chat.id
+            )
+            with_token = await chat_events(
+                self.factory.get(url, {"token": self.token}), self.chat.id
+            )
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(again.status_code, 401)
+        self.assertEqual(with_token.status_code, 401)
+
+    @override_settings(AI_STREAM_RESUME_ENABLED=True)
+    async def test_not_started_outcome_reaches_stream(self):
+        """Тест: отказ в запуске генерации попадает в стрим для читателей SSE"""
+        with mock.patch("chatbot.streams.get_redis", return_value=FakeRedis().aio):
+            await send_not_started(self.chat_id, {}, QueueFullError("full"))
+            events = await GenerationStream.read_after(self.chat_id)
+
+        self.assertEqual([e["type"] for e in events], ["ai_complete"])
+        self.assertEqual(events[0]["message_id"], "queue_full")
+
+    @override_settings(AI_STREAM_RESUME_ENABLED=True)
+    async def test_draining_ends_stream_with_retry(self):
+        """Тест остановки процесса: SSE закрывается кадром retry, новые - 503"""
+        self.addCleanup(consumers._DRAINING.clear)
+
+        async def wait_after(*args):
+            await asyncio.sleep(10)
+
+        async def read_body(response):
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        with (
+            mock.patch("chatbot.streams.get_redis", return_value=FakeRedis().aio),
+            mock.patch.object(GenerationStream, "wait_after", wait_after),
+        ):
+            response = await chat_events(self.request(), self.chat.id)
+            body = asyncio.ensure_future(read_body(response))
+            await asyncio.sleep(0.05)
+            consumers.begin_draining()
+            body = await asyncio.wait_for(body, 1)
+            refused = await chat_events(self.request(), self.chat.id)
+
+        self.assertTrue(body.endswith(DRAINING))
+        self.assertEqual(refused.status_code, 503)
+        self.assertEqual(refused["Retry-After"], "1")
+
+    async def test_follows_group_without_stream(self):
+        """Тест чтения генерации из группы, когда стрим выключен"""
+        response = await chat_events(self.request(), self.chat.id)
+        reader = asyncio.ensure_future(self.read_events(response))
+        channel_layer = get_channel_layer()
+
+        async def subscribed():
+            while not channel_layer.groups.get(f"chat_{self.chat_id}"):
+                await asyncio.sleep(0.01)
+
+        # Даем ответу подписаться на группу
+        await asyncio.wait_for(subscribed(), 1)
+        await channel_layer.group_send(
+            f"chat_{self.chat_id}",
+            {"type": "ai_chunk", "chunk": "ok", "chat_id": self.chat_id},
+        )
+        await channel_layer.group_send(
+            f"chat_{self.chat_id}",
+            {"type": "ai_complete", "message_id": "m1", "chat_id": self.chat_id},
+        )
+        events = await asyncio.wait_for(reader, 1)
+
+        self.assertEqual([e["chunk"] for e in events[:1]], ["ok"])
+        self.assertEqual(events[-1]["type"], "ai_complete")
+        self.assertFalse(channel_layer.groups.get(f"chat_{self.chat_id}"))
+
+
+class ResponseCacheTests(SimpleTestCase):
+    """Тесты кеша ответов"""
+
+    def setUp(self):
+        ResponseCache.clear_local()
+        self.redis = FakeRedis()
+        patcher = mock.patch("chatbot.cache.get_redis", return_value=self.redis.aio)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(ResponseCache.clear_local)
+
+    def test_key_normalization(self):
+        """Тест нормализации промпта и учета модели и системного промпта"""
+        key = ResponseCache.make_key("Привет,  мир ", "m", "sys")
+        self.assertEqual(key, ResponseCache.make_key("привет, мир", "m", "sys"))
+        self.assertNotEqual(key, ResponseCache.make_key("привет, мир", "m2", "sys"))
+        self.assertNotEqual(key, ResponseCache.make_key("привет, мир", "m", None))
+
+    @override_settings(AI_RESPONSE_CACHE_ENABLED=True)
+    def test_stateful_requests_bypass_cache(self):
+        """Тест обхода кеша для запросов с состоянием диалога"""
+        self.assertTrue(ResponseCache.is_cacheable("hi", "hi", None))
+        self.assertFalse(ResponseCache.is_cacheable("hi", "hi", [1, 2]))
+        self.assertFalse(ResponseCache.is_cacheable("hi", "User: a\n\nUser: hi", None))
+        with override_settings(AI_RESPONSE_CACHE_ENABLED=False):
+            self.assertFalse(ResponseCache.is_cacheable("hi", "hi", None))
+
+    @override_settings(AI_RESPONSE_CACHE_SIZE=2)
+    async def test_lru_in_front_of_redis(self):
+        """Тест вытеснения из LRU и чтения из Redis"""
+        for key in ("a", "b", "c"):
+            await ResponseCache.set(key, key.upper())
+        self.assertEqual(list(ResponseCache._local), ["b", "c"])
+
+        # Вытесненный ответ достается из Redis и снова попадает в память
+        self.assertEqual(await ResponseCache.get("a"), "A")
+        self.assertEqual(list(ResponseCache._local), ["c", "a"])
+        self.assertIsNone(await ResponseCache.get("missing"))
+
+
+@override_settings(AI_STREAM_RESUME_ENABLED=True)
+class GenerationStreamTests(TestCase):
+    """Тесты дочитывания генерации из стрима"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="streamuser", password="pass")
+        self.chat = Chat.objects.create(owner=self.user, name="Стрим")
+        self.chat_id = str(self.chat.id)
+        self.redis = FakeRedis()
+        patcher = mock.patch("chatbot.streams.get_redis", return_value=self.redis.aio)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_read_after_offset(self):
+        """Тест чтения событий строго после offset"""
+        await GenerationStream.reset(self.chat_id)
+        first = await GenerationStream.append(self.chat_id, {"type": "ai_chunk"})
+        second = await GenerationStream.append(self.chat_id, {"type": "ai_chunk"})
+
+        events = await GenerationStream.read_after(self.chat_id, first)
+        self.assertEqual([e["offset"] for e in events], [second])
+        events = await GenerationStream.read_after(self.chat_id)
+        self.assertEqual([e["offset"] for e in events], [first, second])
+
+    async def test_long_generation_replayed_whole(self):
+        """Тест: длинный ответ дочитывается с начала, без обрезанного стрима"""
+        for i in range(1200):
+            await GenerationStream.append(self.chat_id, {"type": "ai_chunk", "i": i})
+
+        events = await GenerationStream.read_after(self.chat_id)
+        self.assertEqual(len(events), 1200)
+        self.assertEqual(events[0]["i"], 0)
+
+    async def test_consumer_resumes_from_offset(self):
+        """Тест переподключения консьюмера с offset без дублей живых событий"""
+        offsets = []
+        for chunk in ("a", "b", "c"):
+            event = {"type": "ai_chunk", "chunk": chunk, "chat_id": self.chat_id}
+            offsets.append(await GenerationStream.append(self.chat_id, event))
+
+        communicator = await connect_consumer(
+            self.user, self.chat_id, f"offset={offsets[0]}"
+        )
+        try:
+            welcome = await receive_json(communicator)
+            self.assertEqual(welcome["type"], "connection_established")
+            replayed = [await receive_json(communicator) for _ in range(2)]
+            self.assertEqual([e["chunk"] for e in replayed], ["b", "c"])
+            self.assertEqual(replayed[-1]["offset"], offsets[2])
+
+            # Живое событие, уже отданное из стрима, клиенту не дублируется
+            channel_layer = get_channel_layer()
+            group = f"chat_{self.chat_id}"
+            duplicate = {"type": "ai_chunk", "chunk": "c", "offset": offsets[2]}
+            await channel_layer.group_send(group, duplicate)
+            await channel_layer.group_send(
+                group, {"type": "ai_chunk", "chunk": "d", "offset": "99-0"}
+            )
+            live = await receive_json(communicator)
+            self.assertEqual(live["chunk"], "d")
+        finally:
+            await communicator.send_input(
+                {"type": "websocket.disconnect", "code": 1000}
+            )
+            await communicator.wait(1)
+
+    async def test_reconnect_while_generation_queued(self):
+        """Тест переподключения, пока новая генерация ждет в очереди допуска"""
+        for event_type in ("ai_chunk", "ai_complete"):
+            event = {"type": event_type, "chunk": "старый", "message_id": "m1"}
+            await GenerationStream.append(self.chat_id, event)
+
+        with (
+            mock.patch("chatbot.registry.get_redis", return_value=self.redis.aio),
+            mock.patch.object(GenerationRegistry, "_ensure_listener"),
+            mock.patch("chatbot.consumers.submit_generation") as submit,
+        ):
+            sender = await connect_consumer(self.user, self.chat_id)
+            await receive_json(sender)
+            await sender.send_input(
+                {"type": "websocket.receive", "text": json.dumps({"message": "Hi"})}
+            )
+            self.assertEqual((await receive_json(sender))["type"], "user_message")
+            submit.assert_called_once()
+
+            # Аренда взята, генерация еще не стартовала: старый ответ не досылается
+            reader = await connect_consumer(self.user, self.chat_id)
+            try:
+                welcome = await receive_json(reader)
+                self.assertEqual(welcome["type"], "connection_established")
+                self.assertTrue(await reader.receive_nothing(0.1))
+            finally:
+                for communicator in (sender, reader):
+                    await communicator.send_input(
+                        {"type": "websocket.disconnect", "code": 1000}
+                    )
+                    await communicator.wait(1)
+
+
+class HistoryAssemblerTests(TestCase):
+    """Тесты сборки истории чата в пределах бюджета токенов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="histuser", password="pass123")
+        self.chat = Chat.objects.create(owner=self.user, name="История")
+        self.chat_id = str(self.chat.id)
+        self.redis = FakeRedis()
+
+    def add_messages(self, *contents):
+        for i, content in enumerate(contents):
+            Message.objects.create(
+                chat=self.chat,
+                sender=self.user if i % 2 == 0 else None,
+                content=content,
+            )
+
+    def assemble(self):
+        with mock.patch("chatbot.context.get_redis", return_value=self.redis.aio):
+            return async_to_sync(HistoryAssembler.assemble)(self.chat_id, "test-model")
+
+    @override_settings(AI_HISTORY_TOKEN_BUDGET=1000, AI_CHARS_PER_TOKEN=1)
+    def test_window_extended_incrementally(self):
+        """Тест дочитывания только новых сообщений на следующем ходу"""
+        self.add_messages("Вопрос 1", "Ответ 1")
+        entries = self.assemble()
+        self.assertEqual([e["content"] for e in entries], ["Вопрос 1", "Ответ 1"])
+
+        self.add_messages("Вопрос 2")
+        with self.assertNumQueries(1):
+            entries = self.assemble()
+        self.assertEqual(
+            [e["content"] for e in entries], ["Вопрос 1", "Ответ 1", "Вопрос 2"]
+        )
+        self.assertEqual([e["role"] for e in entries], ["user", "assistant", "user"])
+
+    @override_settings(AI_HISTORY_TOKEN_BUDGET=10, AI_CHARS_PER_TOKEN=1)
+    def test_budget_limits_initial_load(self):
+        """Тест загрузки истории с конца в пределах бюджета"""
+        self.add_messages("aaaaaa", "bbbbbb", "cccc")
+        entries = self.assemble()
+        self.assertEqual([e["content"] for e in entries], ["bbbbbb", "cccc"])
+
+    def test_trim_keeps_last_message(self):
+        """Тест обрезки окна: последнее сообщение остается всегда"""
+        entries = [
+            {"role": "user", "content": "a", "tokens": 5},
+            {"role": "assistant", "content": "b", "tokens": 5},
+            {"role": "user", "content": "c", "tokens": 20},
+        ]
+        self.assertEqual(trim_to_budget(entries, 12), entries[2:])
+        self.assertEqual(trim_to_budget(entries, 30), entries)
+
+    def test_render_history(self):
+        """Тест сборки промпта из окна истории"""
+        entries = [
+            {"role": "user", "content": "Привет"},
+            {"role": "assistant", "content": "Здравствуйте"},
+            {"role": "user", "content": "Как дела?"},
+        ]
+        self.assertEqual(
+            render_history(entries),
+            "User: Привет\n\nAssistant: Здравствуйте\n\nUser: Как дела?\n\nAssistant:",
+        )
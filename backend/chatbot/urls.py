@@ -3,11 +3,12 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from . import views
+from . import sse, views
 
 router = DefaultRouter()
 router.register(r"chats", views.ChatViewSet, basename="chat")
 
 urlpatterns = [
+    path("chats/<uuid:chat_id>/events/", sse.chat_events, name="chat-events"),
     path("", include(router.urls)),
 ]
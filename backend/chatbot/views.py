@@ -11,8 +11,16 @@ from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from chatbot.models import Chat, Message
-from chatbot.serializers import ChatSerializer, MessageSerializer, StartChatSerializer
+from chatbot.models import Chat
+from chatbot.pagination import MessageCursorPagination
+from chatbot.serializers import (
+    ChatSerializer,
+    MessageSerializer,
+    StartChatSerializer,
+    prefetch_latest_messages,
+)
+from chatbot.sse import issue_ticket
+from chatbot.writes import create_message
 
 # from .tasks import generate_ai_response
 
@@ -28,9 +36,12 @@ class ChatViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Пользователь видит только свои, не удаленные чаты."""
-        return Chat.objects.filter(owner=self.request.user, deleted=False).order_by(
-            "-created_at"
+        queryset = Chat.objects.filter(owner=self.request.user, deleted=False).order_by(
+            "-is_pinned", "-last_message_at"
         )
+        if self.action == "list":
+            queryset = prefetch_latest_messages(queryset)
+        return queryset
 
     def perform_create(self, serializer):
         """При создании чата автоматически устанавливается владелец."""
@@ -94,12 +105,38 @@ class ChatViewSet(viewsets.ModelViewSet):
 
         message = serializer.validated_data["message"]
 
+        from .consumers import (
+            cancel_reservation,
+            is_draining,
+            reserve_generation,
+            submit_generation,
+        )
+        from .scheduler import QueueFullError
+
+        # Процесс останавливается - балансировщик повторит запрос на другом
+        if is_draining():
+            return Response(
+                {"error": "Сервер перезапускается, повторите запрос"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": "1"},
+            )
+
+        # Занимаем место в очереди генераций до создания чата
+        try:
+            ticket = reserve_generation(str(request.user.id))
+        except QueueFullError as e:
+            logger.warning(f"Chat start rejected for user {request.user.id}: {e}")
+            return Response(
+                {"error": "Сервер перегружен, повторите запрос позже"},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+
         try:
             # Создаем чат и сообщение
             with transaction.atomic():
                 chat = Chat.objects.create(owner=request.user, name=message[:50])
 
-                Message.objects.create(
+                create_message(
                     chat=chat,
                     sender=request.user,
                     content=message,
@@ -109,20 +146,13 @@ class ChatViewSet(viewsets.ModelViewSet):
                 # chat.touch()
 
             # Запускаем AI генерацию в фоне
-            from .consumers import _AI_EXECUTOR, OllamaClient
-
-            future = _AI_EXECUTOR.submit(
-                OllamaClient.generate_response,
+            submit_generation(
                 chat_id=str(chat.id),
                 prompt=message,
-                channel_layer=None,
-                group_name=None,
+                ticket=ticket,
+                user_id=str(request.user.id),
             )
-
-            # Начинаем отслеживание генерации
-            from .consumers import AIResponseTracker
-
-            AIResponseTracker.start_generation(str(chat.id), future)
+            ticket = None
 
             logger.info(f"Started chat {chat.id} for user {request.user.id}")
 
@@ -145,18 +175,39 @@ class ChatViewSet(viewsets.ModelViewSet):
                 },
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
+        finally:
+            # Генерация не запущена - возвращаем место в очереди
+            cancel_reservation(ticket)
 
-    @action(detail=True, methods=["get"])
+    @action(detail=True, methods=["get"], pagination_class=MessageCursorPagination)
     def messages(self, request, pk=None):
-        """GET /api/chats/{id}/messages/ - Получить все сообщения чата."""
+        """
+        GET /api/chats/{id}/messages/ - Сообщения чата с курсорной пагинацией.
+
+        Без параметров - последние сообщения, ?before=<cursor> - более
+        старые, ?after=<cursor> - более новые (см. MessageCursorPagination).
+        """
         chat = self.get_object()
-        messages = chat.messages.all().order_by("created_at")
-        page = self.paginate_queryset(messages)
-        if page is not None:
-            serializer = MessageSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        page = self.paginate_queryset(chat.messages.all())
+        serializer = MessageSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=["post"], url_path="events/ticket")
+    def events_ticket(self, request, pk=None):
+        """
+        POST /api/chats/{id}/events/ticket/ - одноразовый билет для SSE.
+
+        EventSource не передает заголовок Authorization, поэтому клиент
+        открывает /events/?ticket=<билет> вместо токена в query string.
+        """
+        chat = self.get_object()
+        return Response(
+            {
+                "ticket": issue_ticket(request.user.id, chat.id),
+                "expires_in": getattr(settings, "AI_SSE_TICKET_TTL", 30),
+            },
+            status=status.HTTP_201_CREATED,
+        )
 
     @action(detail=True, methods=["patch"])
     def rename(self, request, pk=None):
@@ -169,7 +220,7 @@ class ChatViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
         chat.name = new_name
-        chat.save()
+        chat.save(update_fields=["name", "updated_at"])
         return Response(ChatSerializer(chat).data)
 
     @action(detail=True, methods=["patch"])
@@ -177,7 +228,7 @@ class ChatViewSet(viewsets.ModelViewSet):
         """Эндпоинт для закрепления/открепления чата: PATCH /api/chats/{id}/toggle_pin/."""
         chat = self.get_object()
         chat.is_pinned = not chat.is_pinned
-        chat.save()
+        chat.save(update_fields=["is_pinned", "updated_at"])
         return Response(ChatSerializer(chat).data)
 
     def perform_destroy(self, instance):
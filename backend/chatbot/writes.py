@@ -0,0 +1,129 @@
+"""Горячий путь записи сообщений чата."""
+
+import uuid
+from typing import Any, Dict
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+# Длина превью последнего сообщения в списке чатов (колонка Chat.last_message_preview)
+PREVIEW_LENGTH = 255
+
+
+class ChatAccessDenied(Exception):
+    """Чата нет или он принадлежит другому пользователю."""
+
+
+def make_preview(content: str) -> str:
+    """Превью сообщения для списка чатов: одна строка ограниченной длины."""
+    return " ".join(content.split())[:PREVIEW_LENGTH]
+
+
+def chat_activity(created_at, content: str) -> Dict[str, Any]:
+    """Поля Chat, которые обновляются при каждом новом сообщении."""
+    return {
+        "updated_at": created_at,
+        "last_message_at": created_at,
+        "message_count": F("message_count") + 1,
+        "last_message_preview": make_preview(content),
+    }
+
+
+def create_message(**fields):
+    """Создает сообщение и в той же транзакции обновляет активность чата."""
+    from chatbot.models import Chat, Message
+
+    with transaction.atomic():
+        message = Message.objects.create(**fields)
+        Chat.objects.filter(id=message.chat_id).update(
+            **chat_activity(message.created_at, message.content)
+        )
+    return message
+
+
+def _insert_sql() -> str:
+    """
+    Один оператор: обновление активности чата, проверка владельца и вставка.
+
+    UPDATE в CTE возвращает строку чата только владельцу, поэтому без прав
+    INSERT ничего не вставляет. Блокировка строки чата держится лишь на
+    время оператора, а не через переход между потоком и event loop.
+    """
+    from chatbot.models import Chat, Message
+
+    chat_table = Chat._meta.db_table
+    message_table = Message._meta.db_table
+    return f"""
+        WITH chat AS (
+            UPDATE {chat_table}
+            SET updated_at = %(now)s,
+                last_message_at = %(now)s,
+                message_count = message_count + 1,
+                last_message_preview = %(preview)s
+            WHERE id = %(chat_id)s AND owner_id = %(user_id)s
+            RETURNING id
+        )
+        INSERT INTO {message_table} (
+            id, chat_id, sender_id, content, message_type,
+            is_edited, deleted_for_owner, is_draft, thinking, created_at, updated_at
+        )
+        SELECT
+            %(message_id)s, chat.id, %(user_id)s, %(content)s, 'text',
+            false, false, false, '', %(now)s, %(now)s
+        FROM chat
+        RETURNING id
+    """
+
+
+def save_user_message(chat_id: str, user, content: str):
+    """
+    Сохраняет сообщение пользователя и обновляет активность чата.
+
+    В PostgreSQL это один оператор без select_for_update. На других СУБД
+    (SQLite в тестах) - INSERT и UPDATE с условием на владельца в одной
+    транзакции.
+
+    Raises:
+        ChatAccessDenied: чата нет или пользователь им не владеет
+    """
+    from chatbot.models import Chat, Message
+
+    now = timezone.now()
+    message = Message(
+        id=uuid.uuid4(),
+        chat_id=chat_id,
+        sender=user,
+        content=content,
+        message_type="text",
+        created_at=now,
+        updated_at=now,
+    )
+
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                _insert_sql(),
+                {
+                    "now": now,
+                    "chat_id": chat_id,
+                    "user_id": user.id,
+                    "message_id": message.id,
+                    "content": content,
+                    "preview": make_preview(content),
+                },
+            )
+            if cursor.fetchone() is None:
+                raise ChatAccessDenied(chat_id)
+        return message
+
+    # created_at проставляет auto_now_add, поэтому чат обновляем после вставки,
+    # а при отказе в доступе откатываем транзакцию вместе с сообщением
+    with transaction.atomic():
+        message.save(force_insert=True)
+        updated = Chat.objects.filter(id=chat_id, owner=user).update(
+            **chat_activity(message.created_at, content)
+        )
+        if not updated:
+            raise ChatAccessDenied(chat_id)
+    return message
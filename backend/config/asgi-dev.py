@@ -14,6 +14,7 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
 import chatbot.routing
+from chatbot.lifespan import LifespanApp
 from chatbot.middleware import JWTAuthMiddleware
 
 DEBUG_PORT = 5678
@@ -30,5 +31,6 @@ application = ProtocolTypeRouter(
         "websocket": JWTAuthMiddleware(
             URLRouter(chatbot.routing.websocket_urlpatterns)
         ),
+        "lifespan": LifespanApp(),
     }
 )
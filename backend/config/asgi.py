@@ -13,6 +13,7 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
 import chatbot.routing
+from chatbot.lifespan import LifespanApp
 from chatbot.middleware import JWTAuthMiddleware
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
@@ -23,5 +24,6 @@ application = ProtocolTypeRouter(
         "websocket": JWTAuthMiddleware(
             URLRouter(chatbot.routing.websocket_urlpatterns)
         ),
+        "lifespan": LifespanApp(),
     }
 )
@@ -104,6 +104,97 @@ DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
 # Ollama Settings
 OLLAMA_API_URL = "http://ollama:11434/api/generate"
 OLLAMA_TIMEOUT = 300  # Таймаут в секундах (5 минут)
+OLLAMA_POOL_SIZE = 32  # Максимум keep-alive соединений к Ollama на event loop
+OLLAMA_KEEPALIVE_TIMEOUT = 60  # Время жизни простаивающего соединения в секундах
+# Пул серверов Ollama через запятую; пусто - единственный сервер из OLLAMA_API_URL
+OLLAMA_BACKENDS = [
+    url.strip()
+    for url in os.environ.get("OLLAMA_BACKENDS", "").split(",")
+    if url.strip()
+]
+OLLAMA_CIRCUIT_FAILURE_THRESHOLD = 3  # Ошибок подряд до отключения сервера
+OLLAMA_CIRCUIT_RESET_TIMEOUT = 30  # Через сколько секунд проверить отключенный сервер
+OLLAMA_MODELS_REFRESH_INTERVAL = 30  # Период обновления списка моделей сервера (с)
+OLLAMA_HEALTH_CHECK_TIMEOUT = 5  # Таймаут запроса /api/tags в секундах
+
+# Generation Registry Settings
+CHATBOT_REDIS_URL = os.environ.get("CELERY_BROKER_URL", "redis://redis:6379/0")
+AI_GENERATION_LEASE_TTL = 30  # TTL аренды генерации (с), продлевается heartbeat-ом
+
+# Generation DB Pool Settings
+AI_DB_POOL_SIZE = 4  # Потоков (и соединений с БД) для записей генераций на процесс
+AI_DB_CONN_MAX_AGE = 300  # Соединение пула переоткрывается через (секунды)
+AI_DB_HEALTH_CHECK_INTERVAL = 10  # Простоявшее дольше соединение проверяется (секунды)
+
+# Graceful Shutdown Settings
+# По SIGTERM uvicorn до --timeout-graceful-shutdown секунд ждет закрытия
+# соединений, затем генерации дорабатывают AI_DRAIN_TIMEOUT и сохраняются
+# AI_DRAIN_PERSIST_TIMEOUT. Сумма (15 + 60 + 10) должна быть меньше
+# stop_grace_period контейнера (90s в docker-compose), иначе SIGKILL
+# прервет остановку
+AI_DRAIN_TIMEOUT = 60  # Сколько секунд по SIGTERM дорабатывают идущие генерации
+AI_DRAIN_PERSIST_TIMEOUT = 10  # Время на сохранение прерванных после дедлайна ответов
+
+# Generation Mode Settings
+# "inprocess" - генерация в event loop веб-сервера, "celery" - на воркерах
+# очереди AI_GENERATION_QUEUE (celery -A config worker -Q celery,generation)
+AI_GENERATION_MODE = os.environ.get("AI_GENERATION_MODE", "inprocess")
+AI_GENERATION_QUEUE = "generation"  # Очередь Celery для генераций
+AI_GENERATION_QUEUE_LEASE_TTL = 300  # Чат занят, пока задача ждет воркера (с)
+
+# Context Reuse Settings
+AI_CONTEXT_REUSE = True  # Передавать context Ollama в следующий ход диалога
+AI_CONTEXT_TTL = 3600  # Время жизни контекста чата в Redis (секунды)
+AI_CONTEXT_MAX_TOKENS = 32768  # Контекст длиннее не сохраняется
+
+# History Settings
+AI_HISTORY_ENABLED = True  # Собирать историю чата, когда контекста Ollama нет
+AI_HISTORY_TOKEN_BUDGET = 2048  # Бюджет токенов истории по умолчанию
+AI_HISTORY_TOKEN_BUDGETS = {  # Бюджеты токенов истории по моделям
+    "deepseek-r1:1.5b": 4096,
+}
+AI_CHARS_PER_TOKEN = 3  # Оценка символов на токен для бюджета истории
+
+# Scheduler Settings
+AI_MAX_CONCURRENT_GENERATIONS = 32  # Общий потолок одновременных генераций на процесс
+AI_MAX_QUEUE_DEPTH = 50  # Сверх этого новые запросы отклоняются
+AI_MAX_QUEUED_PER_USER = 3  # Ожидающих генераций на пользователя
+AI_MODEL_CONCURRENCY_INITIAL = 2  # Стартовый лимит генераций модели
+AI_MODEL_CONCURRENCY_MIN = 1  # Ниже этого лимит модели не опускается
+AI_MODEL_CONCURRENCY_MAX = 16  # Выше этого лимит модели не растет
+AI_CONCURRENCY_BACKOFF = 0.7  # Множитель лимита при перегрузке модели
+AI_MIN_STREAM_TOKENS_PER_SEC = 5  # Стрим медленнее считается перегрузкой
+
+# Response Cache Settings
+AI_RESPONSE_CACHE_ENABLED = False  # Отвечать на точные повторы промптов из кеша
+AI_RESPONSE_CACHE_TTL = 3600  # Время жизни ответа в кеше (секунды)
+AI_RESPONSE_CACHE_SIZE = 256  # Ответов в LRU-кеше процесса
+
+# Draft Settings
+AI_DRAFT_CHECKPOINT_TOKENS = 64  # Сохранять черновик ответа каждые N токенов
+AI_DRAFT_CHECKPOINT_INTERVAL = 2.0  # ...или каждые T секунд генерации
+
+# WebSocket Auth Cache Settings
+WS_AUTH_CACHE_ENABLED = True  # Кешировать пользователя JWT для рукопожатий веб-сокетов
+WS_AUTH_CACHE_TTL = 300  # Время жизни записи в Redis (секунды, не дольше токена)
+WS_AUTH_CACHE_LOCAL_TTL = 5  # Время жизни записи в памяти процесса (секунды)
+WS_AUTH_CACHE_SIZE = 1024  # Токенов в LRU-кеше процесса
+
+# Presence Settings
+WS_PRESENCE_ENABLED = True  # Учитывать подписчиков чатов в Redis
+WS_PRESENCE_TTL = 30  # Соединение без heartbeat дольше этого не учитывается (секунды)
+AI_PRESENCE_CHECK_INTERVAL = 1.0  # Сколько помнить найденных подписчиков (секунды)
+
+# Streaming Settings
+AI_CHUNK_FLUSH_INTERVAL_MS = 50  # Окно склейки токенов в один ai_chunk (мс)
+AI_CHUNK_FLUSH_BYTES = 512  # Размер буфера, при котором чанк отправляется сразу
+AI_THINKING_STREAM = True  # Слать рассуждения модели (<think>) событиями ai_thinking
+AI_STREAM_RESUME_ENABLED = True  # Писать генерацию в Redis Stream для дочитывания
+AI_STREAM_TTL = 300  # Время жизни стрима после последней записи (секунды)
+AI_RESUME_GRACE = 10  # Ждать переподключения перед отменой генерации (секунды)
+AI_SSE_KEEPALIVE_INTERVAL = 15  # Как часто SSE шлет keepalive без событий (секунды)
+AI_SSE_IDLE_TIMEOUT = 30  # SSE без идущей генерации закрывается через (секунды)
+AI_SSE_TICKET_TTL = 30  # Время жизни одноразового билета на SSE (секунды)
 
 # Chat Settings
 MAX_MESSAGE_LENGTH = 10000  # Максимальная длина сообщения
@@ -186,6 +277,9 @@ CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "Europe/Moscow"
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
 CELERY_WORKER_HIJACK_ROOT_LOGGER = False
+CELERY_TASK_ROUTES = {
+    "chatbot.tasks.generate_ai_response": {"queue": AI_GENERATION_QUEUE},
+}
 
 # Prometheus для Celery
 CELERY_WORKER_PROMETHEUS_PORTS = environ.get(
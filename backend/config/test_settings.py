@@ -26,3 +26,23 @@ CACHES = {
 
 # Отключаем отправку email
 EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+
+# Канальный слой в памяти вместо Redis
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    }
+}
+
+# Отключаем переиспользование контекста Ollama, окно истории, стрим
+# воспроизведения генераций, кеш аутентификации и присутствие в чатах
+# (требуют Redis)
+AI_CONTEXT_REUSE = False
+AI_HISTORY_ENABLED = False
+AI_STREAM_RESUME_ENABLED = False
+WS_AUTH_CACHE_ENABLED = False
+WS_PRESENCE_ENABLED = False
+
+# Записи генераций идут через основной поток: транзакция TestCase видна
+# только его соединению
+AI_DB_POOL_SIZE = 0
@@ -11,6 +11,7 @@ echo "DB did run."
 python3 manage.py collectstatic --no-input
 python3 manage.py makemigrations --no-input
 python3 manage.py migrate --no-input
+python3 manage.py finalize_drafts
 python3 manage.py initdb
 python3 manage.py init_minio
 python manage.py init_tracker --username admin
@@ -11,6 +11,7 @@ echo "DB did run."
 python3 manage.py collectstatic --no-input
 python3 manage.py makemigrations --no-input
 python3 manage.py migrate --no-input
+python3 manage.py finalize_drafts
 python3 manage.py initdb
 python3 manage.py init_minio
 
@@ -27,6 +28,8 @@ curl -X PUT "opensearch:9200/tracker_metrics" -H 'Content-Type: application/json
   "settings": {"refresh_interval": "1s"}
 }'
 
+# Остановка укладывается в stop_grace_period: см. AI_DRAIN_TIMEOUT в config/dev.py
 exec uvicorn config.asgi:application \
   --host 0.0.0.0 \
-  --port 8000
+  --port 8000 \
+  --timeout-graceful-shutdown 15